@@ -0,0 +1,284 @@
+"""
+Failure correlation
+When one GPU of an all-reduce job fails, every worker of the job logs an NCCL
+error, so tainting every node that logged one would take a whole job's worth
+of capacity out of service for a single bad GPU. Pod log faults are therefore
+grouped by the job their pod belongs to for `CORRELATION_WINDOW_SECONDS`
+after the job's first fault, and then attributed:
+
+1. nodes of the job with hardware evidence, a dmesg or DCGM fault logged up
+   to `EVIDENCE_SECONDS` before, are the culprits,
+2. otherwise, a node that failed at least `CORRELATION_LEAD_SECONDS` before
+   all others is the culprit,
+3. otherwise, there is no clear culprit.
+
+Culprits are tainted. The other nodes of the job are suspects, which get
+targeted NCCL tests and are only tainted if they fail them.
+
+The job of a pod is read from the first of `JOB_LABELS` among its stream
+labels, or from its pod's labels and owner otherwise.
+"""
+
+import collections
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from konduktor import kube_client
+from konduktor import logging as konduktor_logging
+from konduktor.controller import faults
+
+# seconds pod faults of a job are collected for, 0 disables correlation
+CORRELATION_WINDOW_SECONDS = float(
+    os.environ.get("KONDUKTOR_CORRELATION_WINDOW_SECONDS", 30)
+)
+# seconds the first node to fail must lead the others by to be the culprit
+CORRELATION_LEAD_SECONDS = float(
+    os.environ.get("KONDUKTOR_CORRELATION_LEAD_SECONDS", 1)
+)
+# pod labels naming the job a pod belongs to, in order of preference
+JOB_LABELS = [
+    "kueue.x-k8s.io/pod-group-name",
+    "jobset.sigs.k8s.io/jobset-name",
+    "training.kubeflow.org/job-name",
+    "batch.kubernetes.io/job-name",
+    "job-name",
+    "skypilot-cluster",
+]
+# seconds hardware faults are kept as evidence for, they are often logged
+# well before the job's pods fail
+EVIDENCE_SECONDS = 600
+# seconds the job of a pod is cached for
+JOB_CACHE_SECONDS = 600
+MAX_JOB_CACHE_SIZE = 100_000
+
+VERDICT_EVIDENCE = "evidence"
+VERDICT_FIRST = "first"
+VERDICT_SINGLE = "single"
+VERDICT_AMBIGUOUS = "ambiguous"
+
+logger = konduktor_logging.get_logger(__name__)
+
+
+def _label_key(label: str) -> str:
+    """Pod label as a loki stream label, e.g. `job-name` -> `job_name`"""
+    return "".join(c if c.isalnum() else "_" for c in label)
+
+
+# `JOB_LABELS` as loki stream labels
+JOB_STREAM_LABELS = list(dict.fromkeys(_label_key(label) for label in JOB_LABELS))
+
+
+class JobResolver:
+    """Finds the job a pod belongs to, caching the pods it read"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (namespace, pod) -> (job, expiry)
+        self._cache: "collections.OrderedDict[Tuple[str, str], Tuple[str, float]]" = (
+            collections.OrderedDict()
+        )
+
+    def job(self, labels: Dict[str, str]) -> str:
+        """Job of the pod that logged a line with stream `labels`, blocking
+
+        Returns:
+            str: `namespace/job`, or `namespace/pod` for pods outside a job
+        """
+        namespace = labels.get("k8s_namespace_name", "")
+        for label in JOB_STREAM_LABELS:
+            job = labels.get(label)
+            if job:
+                return f"{namespace}/{job}"
+        pod = labels.get("k8s_pod_name")
+        if not pod:
+            # every line is its own job, so it is never attributed to others
+            return f"{namespace}/{labels.get('k8s_node_name', '')}"
+        key = (namespace, pod)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        job = f"{namespace}/{self._read_job(namespace, pod)}"
+        with self._lock:
+            self._cache[key] = (job, now + JOB_CACHE_SECONDS)
+            self._cache.move_to_end(key)
+            while len(self._cache) > MAX_JOB_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return job
+
+    def _read_job(self, namespace: str, pod: str) -> str:
+        try:
+            obj = kube_client.core_api().read_namespaced_pod(
+                name=pod,
+                namespace=namespace,
+                _request_timeout=kube_client.API_TIMEOUT,
+            )
+        except kube_client.api_exception() as e:
+            if e.status != 404:
+                logger.warning(f"failed to read pod {namespace}/{pod}: {e}")
+            return pod
+        labels = obj.metadata.labels or {}
+        for label in JOB_LABELS:
+            if labels.get(label):
+                return labels[label]
+        for owner in obj.metadata.owner_references or []:
+            if owner.controller:
+                return f"{owner.kind}/{owner.name}"
+        return pod
+
+
+class Verdict:
+    """Attribution of the faults of a job
+
+    Attributes:
+        job (str): `namespace/job`
+        kind (str): how the culprits were picked, one of `VERDICT_*`
+        culprits (List[faults.Fault]): first fault of every culprit node
+        suspects (List[str]): the job's other nodes
+    """
+
+    __slots__ = ("job", "kind", "culprits", "suspects")
+
+    def __init__(
+        self, job: str, kind: str, culprits: List[faults.Fault], suspects: List[str]
+    ):
+        self.job = job
+        self.kind = kind
+        self.culprits = culprits
+        self.suspects = suspects
+
+    def __repr__(self) -> str:
+        culprits = [fault.node for fault in self.culprits]
+        return (
+            f"{self.job}: culprits {culprits} ({self.kind}), "
+            f"{len(self.suspects)} suspects"
+        )
+
+
+class _Group:
+    __slots__ = ("deadline", "faults")
+
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        # node -> first fault logged on it
+        self.faults: Dict[str, faults.Fault] = {}
+
+
+class Correlator:
+    """Groups pod faults by job and attributes them once a job's window closes
+
+    Args:
+        window (float, optional): seconds the faults of a job are collected for
+        lead (float, optional): seconds the first node to fail must lead the
+            others by to be the culprit
+        evidence (float, optional): seconds hardware faults are kept as
+            evidence for
+    """
+
+    def __init__(
+        self,
+        window: float = CORRELATION_WINDOW_SECONDS,
+        lead: float = CORRELATION_LEAD_SECONDS,
+        evidence: float = EVIDENCE_SECONDS,
+    ):
+        self.window = window
+        self.lead = lead
+        self.evidence_seconds = evidence
+        self._groups: Dict[str, _Group] = {}
+        # node -> log timestamps of hardware faults
+        self._evidence: Dict[str, List[int]] = {}
+
+    def add(self, fault: faults.Fault, job: str):
+        """Adds a pod fault of `job`"""
+        group = self._groups.get(job)
+        if group is None:
+            group = self._groups[job] = _Group(time.monotonic() + self.window)
+        first = group.faults.get(fault.node)
+        if first is None or fault.ts < first.ts:
+            group.faults[fault.node] = fault
+
+    def evidence(self, fault: faults.Fault):
+        """Adds a fault that points at the hardware of its node"""
+        self._evidence.setdefault(fault.node, []).append(fault.ts)
+
+    def ready(self, now: Optional[float] = None) -> List[Verdict]:
+        """Attributes the faults of every job whose window closed"""
+        now = time.monotonic() if now is None else now
+        closed = [job for job, group in self._groups.items() if group.deadline <= now]
+        verdicts = [self._attribute(job, self._groups.pop(job)) for job in closed]
+        self._prune_evidence()
+        return verdicts
+
+    def _attribute(self, job: str, group: _Group) -> Verdict:
+        ordered = sorted(group.faults.values(), key=lambda fault: fault.ts)
+        start = ordered[0].ts - int(self.evidence_seconds * 10**9)
+        end = ordered[-1].ts + int(self.window * 10**9)
+        with_evidence = [
+            fault
+            for fault in ordered
+            if any(start <= ts <= end for ts in self._evidence.get(fault.node, []))
+        ]
+        if with_evidence:
+            kind, culprits = VERDICT_EVIDENCE, with_evidence
+        elif len(ordered) == 1:
+            kind, culprits = VERDICT_SINGLE, ordered
+        elif ordered[1].ts - ordered[0].ts >= self.lead * 10**9:
+            kind, culprits = VERDICT_FIRST, ordered[:1]
+        else:
+            kind, culprits = VERDICT_AMBIGUOUS, []
+        culprit_nodes = {fault.node for fault in culprits}
+        suspects = [fault.node for fault in ordered if fault.node not in culprit_nodes]
+        return Verdict(job, kind, culprits, suspects)
+
+    def _prune_evidence(self):
+        oldest = time.time_ns() - int(self.evidence_seconds * 10**9)
+        for node in list(self._evidence):
+            recent = [ts for ts in self._evidence[node] if ts >= oldest]
+            if recent:
+                self._evidence[node] = recent
+            else:
+                del self._evidence[node]
+
+    def dump(self) -> Dict[str, Any]:
+        """Open groups and evidence as JSON, see `restore`"""
+        return {
+            "groups": {
+                job: [fault.to_dict() for fault in group.faults.values()]
+                for job, group in self._groups.items()
+            },
+            "evidence": self._evidence,
+        }
+
+    def restore(self, dumped: Dict[str, Any]):
+        """Restores the groups and evidence of `dump`, giving every group a
+        full window to collect the faults logged while we were down
+        """
+        for job, group_faults in dumped.get("groups", {}).items():
+            for fault in group_faults:
+                self.add(faults.Fault.from_dict(fault), job)
+        for node, timestamps in dumped.get("evidence", {}).items():
+            self._evidence.setdefault(node, []).extend(timestamps)
+
+
+if __name__ == "__main__":
+    # a 64 node job where one GPU fails and the other workers time out
+    correlator = Correlator(window=0)
+    ts = time.time_ns()
+    for i in range(64):
+        delay = 0 if i == 17 else 30 * 10**9 + i * 10**6
+        correlator.add(
+            faults.Fault(f"node-{i}", faults.SOURCE_POD, "NCCL", ts + delay, ""),
+            "default/llama",
+        )
+    print(correlator.ready()[0])
+    # the same job when the workers fail together, but one logged an Xid
+    for i in range(64):
+        correlator.add(
+            faults.Fault(f"node-{i}", faults.SOURCE_POD, "NCCL", ts + i * 10**6, ""),
+            "default/llama",
+        )
+    correlator.evidence(faults.Fault("node-40", faults.SOURCE_DMESG, "Xid79", ts, ""))
+    print(correlator.ready()[0])
@@ -0,0 +1,373 @@
+"""
+DCGM anomaly detection
+GPUs often degrade before they log an Xid: PCIe links start replaying packets,
+or a GPU runs much hotter than its peers. This stage reads the DCGM exporter
+metrics from Prometheus (or Thanos) and flags GPUs whose metrics look wrong
+over a sliding window, producing faults for the same taint path as log errors.
+
+All metrics are fetched with a single range query per cycle and turned into a
+GPU x time matrix per metric, so every check is a handful of vectorized NumPy
+operations no matter how many GPUs there are.
+https://docs.nvidia.com/datacenter/dcgm/latest/dcgm-api/dcgm-api-field-ids.html
+"""
+
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import requests
+
+from konduktor import logging as konduktor_logging
+from konduktor.controller import faults
+
+PROMETHEUS_ENDPOINT = os.environ.get(
+    "PROMETHEUS_ENDPOINT",
+    "http://kube-prometheus-stack-prometheus.prometheus.svc.cluster.local:9090",
+)
+QUERY_RANGE_URL = "/api/v1/query_range"
+# label of the DCGM exporter series holding the k8s node name
+DCGM_NODE_LABEL = os.environ.get("DCGM_NODE_LABEL", "Hostname")
+# seconds of metrics each check looks at, and the resolution
+DCGM_WINDOW_SECONDS = int(os.environ.get("DCGM_WINDOW_SECONDS", 600))
+DCGM_STEP_SECONDS = int(os.environ.get("DCGM_STEP_SECONDS", 30))
+QUERY_TIMEOUT = 30
+# seconds between checks
+DCGM_POLL_SECONDS = int(os.environ.get("DCGM_POLL_SECONDS", 60))
+
+# PCIe replays per second, sustained over `PCIE_REPLAY_WINDOW_SECONDS`
+PCIE_REPLAY_RATE = float(os.environ.get("DCGM_PCIE_REPLAY_RATE", 1))
+PCIE_REPLAY_WINDOW_SECONDS = 300
+# robust z-score of a GPU's temperature against GPUs of the same model
+THERMAL_ZSCORE = float(os.environ.get("DCGM_THERMAL_ZSCORE", 4))
+# degrees C above the median, so a tight group does not flag small deviations
+THERMAL_MIN_DELTA = float(os.environ.get("DCGM_THERMAL_MIN_DELTA", 10))
+# fraction of the window a GPU must be an outlier for
+THERMAL_SUSTAINED_FRACTION = 0.8
+# GPUs of a model needed for a meaningful median
+THERMAL_MIN_PEERS = 4
+
+PCIE_REPLAY_COUNTER = "DCGM_FI_DEV_PCIE_REPLAY_COUNTER"
+GPU_TEMP = "DCGM_FI_DEV_GPU_TEMP"
+ROW_REMAP_FAILURE = "DCGM_FI_DEV_ROW_REMAP_FAILURE"
+UNCORRECTABLE_REMAPPED_ROWS = "DCGM_FI_DEV_UNCORRECTABLE_REMAPPED_ROWS"
+METRICS = [
+    PCIE_REPLAY_COUNTER,
+    GPU_TEMP,
+    ROW_REMAP_FAILURE,
+    UNCORRECTABLE_REMAPPED_ROWS,
+]
+
+# fault codes
+PCIE_REPLAYS = "PCIeReplays"
+THERMAL_OUTLIER = "ThermalOutlier"
+ROW_REMAP_FAILED = "RowRemapFailure"
+UNCORRECTABLE_ROWS = "UncorrectableRemappedRows"
+
+logger = konduktor_logging.get_logger(__name__)
+
+_session: Optional[requests.Session] = None
+
+
+class Series:
+    """Samples of one metric for every GPU, aligned on a common time grid
+
+    Attributes:
+        gpus (List[Dict[str, str]]): labels of each GPU, one per row
+        times (np.ndarray): unix timestamp of each column
+        values (np.ndarray): gpus x times, NaN where a sample is missing
+    """
+
+    __slots__ = ("gpus", "times", "values")
+
+    def __init__(
+        self, gpus: List[Dict[str, str]], times: np.ndarray, values: np.ndarray
+    ):
+        self.gpus = gpus
+        self.times = times
+        self.values = values
+
+
+def query_range(
+    query: str, start: float, end: float, step: int
+) -> List[Dict[str, Any]]:
+    """Runs a PromQL range query
+
+    Returns:
+        List[Dict[str, Any]]: matrix result, empty if the query failed
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+    params: Dict[str, Any] = {"query": query, "start": start, "end": end, "step": step}
+    try:
+        response = _session.get(
+            f"{PROMETHEUS_ENDPOINT}{QUERY_RANGE_URL}",
+            params=params,
+            timeout=QUERY_TIMEOUT,
+        )
+    except requests.RequestException as e:
+        logger.error(f"prometheus query failed {params}: {e}")
+        return []
+    if response.status_code != 200:
+        logger.error(f"prometheus query failed {params}: {response.text}")
+        return []
+    return response.json()["data"]["result"]
+
+
+def to_series(
+    result: List[Dict[str, Any]], start: float, end: float, step: int
+) -> Dict[str, Series]:
+    """Groups a matrix result by metric name into aligned GPU x time arrays"""
+    times = np.arange(start, end + step / 2, step)
+    by_metric: Dict[str, List[Dict[str, Any]]] = {}
+    for row in result:
+        by_metric.setdefault(row["metric"]["__name__"], []).append(row)
+    series = {}
+    for name, rows in by_metric.items():
+        values = np.full((len(rows), len(times)), np.nan)
+        for i, row in enumerate(rows):
+            samples = np.array(row["values"], dtype=float).reshape(-1, 2)
+            columns = np.rint((samples[:, 0] - start) / step).astype(int)
+            valid = (columns >= 0) & (columns < len(times))
+            values[i, columns[valid]] = samples[valid, 1]
+        gpus = [row["metric"] for row in rows]
+        series[name] = Series(gpus, times, values)
+    return series
+
+
+def _rate(counter: np.ndarray, step: int) -> np.ndarray:
+    """Per second increase of counters, counter resets count as no increase"""
+    increase = np.diff(counter, axis=1)
+    increase[increase < 0] = 0
+    return increase / step
+
+
+def _rolling_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """Mean of every `window` consecutive columns, ignoring NaNs"""
+    window = max(1, min(window, values.shape[1]))
+    present = ~np.isnan(values)
+    sums = np.cumsum(np.where(present, values, 0), axis=1)
+    counts = np.cumsum(present, axis=1)
+    sums = np.concatenate([np.zeros((len(values), 1)), sums], axis=1)
+    counts = np.concatenate([np.zeros((len(values), 1)), counts], axis=1)
+    window_sums = sums[:, window:] - sums[:, :-window]
+    window_counts = counts[:, window:] - counts[:, :-window]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return window_sums / window_counts
+
+
+def _last_ts(times: np.ndarray, flagged: np.ndarray) -> int:
+    """Nanosecond timestamp of the last flagged column"""
+    return int(times[np.flatnonzero(flagged)[-1]] * 10**9)
+
+
+def _fault(gpu: Dict[str, str], code: str, ts: int, log: str) -> Optional[faults.Fault]:
+    node = gpu.get(DCGM_NODE_LABEL)
+    if not node:
+        return None
+    description = f"GPU {gpu.get('gpu', '?')} ({gpu.get('UUID', 'unknown')}): {log}"
+    return faults.Fault(node, faults.SOURCE_DCGM, code, ts, description)
+
+
+def pcie_replays(series: Series, step: int) -> List[faults.Fault]:
+    """GPUs replaying PCIe packets faster than `PCIE_REPLAY_RATE` on average
+    over any `PCIE_REPLAY_WINDOW_SECONDS`
+    """
+    if series.values.shape[1] < 2:
+        return []
+    rates = _rolling_mean(
+        _rate(series.values, step), PCIE_REPLAY_WINDOW_SECONDS // step
+    )
+    flagged = rates > PCIE_REPLAY_RATE
+    found = []
+    for i in np.flatnonzero(flagged.any(axis=1)):
+        times = series.times[-flagged.shape[1] :]
+        fault = _fault(
+            series.gpus[i],
+            PCIE_REPLAYS,
+            _last_ts(times, flagged[i]),
+            f"PCIe replay rate {np.nanmax(rates[i]):.1f}/s",
+        )
+        if fault:
+            found.append(fault)
+    return found
+
+
+def thermal_outliers(series: Series) -> List[faults.Fault]:
+    """GPUs running hotter than other GPUs of the same model for most of the
+    window, by their robust z-score against the median and MAD
+    """
+    found = []
+    models = np.array([gpu.get("modelName", "") for gpu in series.gpus])
+    for model in np.unique(models):
+        rows = np.flatnonzero(models == model)
+        if len(rows) < THERMAL_MIN_PEERS:
+            continue
+        temps = series.values[rows]
+        present = ~np.isnan(temps)
+        # timesteps where no GPU of the model reported are left out
+        columns = present.any(axis=0)
+        if not columns.any():
+            continue
+        temps = temps[:, columns]
+        present = present[:, columns]
+        median = np.nanmedian(temps, axis=0)
+        mad = np.nanmedian(np.abs(temps - median), axis=0)
+        # consistent with the standard deviation of a normal distribution
+        scale = np.maximum(1.4826 * mad, 1.0)
+        with np.errstate(invalid="ignore"):
+            zscores = (temps - median) / scale
+            outlier = (zscores > THERMAL_ZSCORE) & (temps - median > THERMAL_MIN_DELTA)
+        sustained = outlier.sum(axis=1) >= THERMAL_SUSTAINED_FRACTION * present.sum(
+            axis=1
+        )
+        times = series.times[columns]
+        for j in np.flatnonzero(sustained & outlier.any(axis=1)):
+            fault = _fault(
+                series.gpus[rows[j]],
+                THERMAL_OUTLIER,
+                _last_ts(times, outlier[j]),
+                f"temperature {np.nanmax(temps[j]):.0f}C, "
+                f"{model} median {np.nanmedian(median):.0f}C",
+            )
+            if fault:
+                found.append(fault)
+    return found
+
+
+def memory_errors(
+    remap_failure: Optional[Series], uncorrectable: Optional[Series]
+) -> List[faults.Fault]:
+    """GPUs that failed to remap a memory row, or remapped rows after
+    uncorrectable errors within the window
+    """
+    found = []
+    if remap_failure is not None:
+        failed = np.nan_to_num(remap_failure.values) > 0
+        for i in np.flatnonzero(failed.any(axis=1)):
+            fault = _fault(
+                remap_failure.gpus[i],
+                ROW_REMAP_FAILED,
+                _last_ts(remap_failure.times, failed[i]),
+                "row remapping failed",
+            )
+            if fault:
+                found.append(fault)
+    if uncorrectable is not None and uncorrectable.values.shape[1] >= 2:
+        increase = np.nanmax(uncorrectable.values, axis=1) - np.nanmin(
+            uncorrectable.values, axis=1
+        )
+        for i in np.flatnonzero(np.nan_to_num(increase) > 0):
+            fault = _fault(
+                uncorrectable.gpus[i],
+                UNCORRECTABLE_ROWS,
+                int(uncorrectable.times[-1] * 10**9),
+                f"{increase[i]:.0f} rows remapped after uncorrectable errors",
+            )
+            if fault:
+                found.append(fault)
+    return found
+
+
+def analyze(series: Dict[str, Series], step: int) -> List[faults.Fault]:
+    """Runs every check on aligned DCGM series"""
+    found: List[faults.Fault] = []
+    if PCIE_REPLAY_COUNTER in series:
+        found += pcie_replays(series[PCIE_REPLAY_COUNTER], step)
+    if GPU_TEMP in series:
+        found += thermal_outliers(series[GPU_TEMP])
+    found += memory_errors(
+        series.get(ROW_REMAP_FAILURE), series.get(UNCORRECTABLE_REMAPPED_ROWS)
+    )
+    return found
+
+
+def detect(
+    now: Optional[float] = None,
+    window: int = DCGM_WINDOW_SECONDS,
+    step: int = DCGM_STEP_SECONDS,
+) -> List[faults.Fault]:
+    """Queries the last `window` seconds of DCGM metrics and returns the
+    faults found
+
+    Args:
+        now (Optional[float], optional): end of the window as a unix
+            timestamp. Defaults to now.
+        window (int, optional): seconds of metrics to analyze
+        step (int, optional): seconds between samples
+
+    Returns:
+        List[faults.Fault]: one fault per anomalous GPU and check
+    """
+    end = float(int(now if now is not None else time.time()) // step * step)
+    start = end - window
+    query = '{__name__=~"' + "|".join(METRICS) + '"}'
+    result = query_range(query, start, end, step)
+    if not result:
+        return []
+    found = analyze(to_series(result, start, end, step), step)
+    for fault in found:
+        logger.info(f"node `{fault.node}` has DCGM anomaly {fault.code}: {fault.log}")
+    return found
+
+
+if __name__ == "__main__":
+    # replays a recorded-style fixture from a fake Prometheus:
+    # 64 nodes x 8 GPUs, one with PCIe replays and one running hot
+    import http.server
+    import threading
+    import urllib.parse
+
+    rng = np.random.default_rng(0)
+    step, window, end = 30, 600, 1_700_000_000.0
+    times = np.arange(end - window, end + 1, step)
+    fixture: List[Dict[str, Any]] = []
+    for n in range(64):
+        for g in range(8):
+            labels = {
+                "gpu": str(g),
+                "UUID": f"GPU-{n}-{g}",
+                "modelName": "NVIDIA H100 80GB HBM3",
+                DCGM_NODE_LABEL: f"node-{n}",
+            }
+            temp = 60 + rng.normal(0, 2, len(times)) + (25 if (n, g) == (7, 3) else 0)
+            replays = np.cumsum(
+                rng.poisson(5 if (n, g) == (12, 0) else 0.001, len(times)) * step
+            )
+            for name, values in {GPU_TEMP: temp, PCIE_REPLAY_COUNTER: replays}.items():
+                fixture.append(
+                    {
+                        "metric": {"__name__": name, **labels},
+                        "values": [[t, str(v)] for t, v in zip(times, values)],
+                    }
+                )
+    body = json.dumps(
+        {"status": "success", "data": {"resultType": "matrix", "result": fixture}}
+    ).encode()
+
+    class FakePrometheus(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            assert urllib.parse.urlparse(self.path).path == QUERY_RANGE_URL
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakePrometheus)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    PROMETHEUS_ENDPOINT = f"http://127.0.0.1:{server.server_port}"
+
+    started = time.perf_counter()
+    found = detect(now=end, window=window, step=step)
+    elapsed = time.perf_counter() - started
+    print(f"{len(fixture)} series in {elapsed * 1000:.0f}ms: {found}")
+    started = time.perf_counter()
+    series = to_series(fixture, end - window, end, step)
+    analyze(series, step)
+    print(f"analysis alone {(time.perf_counter() - started) * 1000:.0f}ms")
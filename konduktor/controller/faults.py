@@ -0,0 +1,227 @@
+"""
+Fault events
+A fault is a single error log line attributed to a node. Consecutive queries
+and reconnecting tails can return the same line more than once, and a faulty
+GPU can log the same error many times per second, so faults go through a
+`FaultStore` that drops events it has already handled, applies debounce rules
+(e.g. only act on 3 Xid 13s within 10 minutes) and lets each node be
+remediated once until it is forgotten again.
+"""
+
+import collections
+import os
+import time
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from konduktor import logging as konduktor_logging
+
+SOURCE_POD = "pod"
+SOURCE_DMESG = "dmesg"
+SOURCE_DCGM = "dcgm"
+SOURCE_CHECK = "check"
+
+# seconds an event or remediated node is remembered for
+FAULT_TTL = int(os.environ.get("KONDUKTOR_FAULT_TTL", 600))
+# max events remembered, least recently seen are dropped first
+MAX_FAULT_EVENTS = 100_000
+# comma separated `code:count/seconds`, a fault with `code` is only acted on
+# once `count` of them were logged on the same node within `seconds`.
+# Xid 13, 31 and 43 are often caused by the application rather than the GPU.
+FAULT_DEBOUNCE_RULES = os.environ.get(
+    "KONDUKTOR_FAULT_DEBOUNCE_RULES", "Xid13:3/600,Xid31:3/600,Xid43:3/600"
+)
+
+logger = konduktor_logging.get_logger(__name__)
+
+
+class Fault:
+    """An error logged on a node
+
+    Attributes:
+        node (str): k8s node name
+        source (str): `SOURCE_POD`, `SOURCE_DMESG`, `SOURCE_DCGM` or
+            `SOURCE_CHECK`
+        code (str): what matched, e.g. `Xid79`, `SXid12028`, a regex or a
+            DCGM check
+        ts (int): log timestamp in nanoseconds
+        log (str): the log line
+        labels (Optional[Dict[str, str]]): loki stream labels of the line
+    """
+
+    __slots__ = ("node", "source", "code", "ts", "log", "labels")
+
+    def __init__(
+        self,
+        node: str,
+        source: str,
+        code: str,
+        ts: int,
+        log: str,
+        labels: Optional[Dict[str, str]] = None,
+    ):
+        self.node = node
+        self.source = source
+        self.code = code
+        self.ts = ts
+        self.log = log
+        self.labels = labels
+
+    @property
+    def key(self) -> Tuple[str, str, str, int]:
+        return (self.node, self.source, self.code, self.ts)
+
+    def __repr__(self) -> str:
+        return f"{self.source} {self.code} on {self.node} at {self.ts}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Fault":
+        return cls(**data)
+
+
+class DebounceRule:
+    """Act on `code` only once `count` occurrences were logged within `window`
+    seconds on the same node
+    """
+
+    __slots__ = ("code", "count", "window")
+
+    def __init__(self, code: str, count: int, window: float):
+        self.code = code
+        self.count = count
+        self.window = window
+
+
+def parse_rules(rules: str) -> Dict[str, DebounceRule]:
+    """Parses `code:count/seconds,...` into rules by code"""
+    parsed = {}
+    for rule in filter(None, (rule.strip() for rule in rules.split(","))):
+        code, _, threshold = rule.rpartition(":")
+        count, _, window = threshold.partition("/")
+        parsed[code] = DebounceRule(code, int(count), int(window))
+    return parsed
+
+
+class _TTLCache:
+    """Bounded LRU of keys that expire `ttl` seconds after they are added"""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._expiry: "collections.OrderedDict[Hashable, float]" = (
+            collections.OrderedDict()
+        )
+
+    def __contains__(self, key: Hashable) -> bool:
+        expiry = self._expiry.get(key)
+        if expiry is None:
+            return False
+        if expiry < time.monotonic():
+            del self._expiry[key]
+            return False
+        self._expiry.move_to_end(key)
+        return True
+
+    def add(self, key: Hashable, ttl: Optional[float] = None):
+        self._expiry[key] = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._expiry.move_to_end(key)
+        while len(self._expiry) > self.max_size:
+            self._expiry.popitem(last=False)
+
+    def discard(self, key: Hashable):
+        self._expiry.pop(key, None)
+
+    def remaining(self) -> Dict[Hashable, float]:
+        """Seconds until each unexpired key expires"""
+        now = time.monotonic()
+        return {
+            key: expiry - now for key, expiry in self._expiry.items() if expiry > now
+        }
+
+
+class FaultStore:
+    """Decides which faults should be remediated
+
+    Args:
+        ttl (float, optional): seconds events and remediated nodes are
+            remembered for
+        max_events (int, optional): max events remembered
+        rules (Optional[Dict[str, DebounceRule]], optional): debounce rules by
+            fault code. Defaults to `FAULT_DEBOUNCE_RULES`.
+    """
+
+    def __init__(
+        self,
+        ttl: float = FAULT_TTL,
+        max_events: int = MAX_FAULT_EVENTS,
+        rules: Optional[Dict[str, DebounceRule]] = None,
+    ):
+        self.rules = parse_rules(FAULT_DEBOUNCE_RULES) if rules is None else rules
+        self._events = _TTLCache(ttl, max_events)
+        self._remediated = _TTLCache(ttl, max_events)
+        # (node, code) -> log timestamps within the rule's window
+        self._occurrences: Dict[Tuple[str, str], List[int]] = {}
+
+    def add(self, fault: Fault) -> bool:
+        """Records a fault
+
+        Returns:
+            bool: True if the fault's node should be remediated now
+        """
+        if fault.key in self._events:
+            return False
+        self._events.add(fault.key)
+
+        rule = self.rules.get(fault.code)
+        if rule is not None and not self._threshold_reached(fault, rule):
+            logger.debug(f"debouncing {fault}")
+            return False
+
+        if fault.node in self._remediated:
+            return False
+        self._remediated.add(fault.node)
+        return True
+
+    def _threshold_reached(self, fault: Fault, rule: DebounceRule) -> bool:
+        key = (fault.node, fault.code)
+        occurrences = self._occurrences.get(key, [])
+        occurrences.append(fault.ts)
+        # lines from different streams can arrive out of order
+        window_start = max(occurrences) - rule.window * 10**9
+        occurrences = [ts for ts in occurrences if ts >= window_start]
+        if len(occurrences) < rule.count:
+            self._occurrences[key] = occurrences
+            return False
+        self._occurrences.pop(key, None)
+        return True
+
+    def forget(self, nodes: List[str]):
+        """Allows remediating `nodes` again, e.g. once they pass health checks"""
+        for node in nodes:
+            self._remediated.discard(node)
+
+    def dump(self) -> Dict[str, Any]:
+        """Remediated nodes and debounce counts as JSON, see `restore`"""
+        now = time.time()
+        return {
+            # wall clock expiry, monotonic clocks restart with the process
+            "remediated": {
+                node: now + remaining
+                for node, remaining in self._remediated.remaining().items()
+            },
+            "occurrences": [
+                [node, code, occurrences]
+                for (node, code), occurrences in self._occurrences.items()
+            ],
+        }
+
+    def restore(self, dumped: Dict[str, Any]):
+        """Restores the remediated nodes and debounce counts of `dump`"""
+        now = time.time()
+        for node, expiry in dumped.get("remediated", {}).items():
+            if expiry > now:
+                self._remediated.add(node, expiry - now)
+        for node, code, occurrences in dumped.get("occurrences", []):
+            self._occurrences[(node, code)] = occurrences
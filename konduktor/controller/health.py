@@ -0,0 +1,130 @@
+"""
+Health check scheduling
+Decides which NCCL tests to run to bring tainted (suspect) nodes back into
+service. Every suspect first runs a single node test. Those that pass are then
+paired with known-good nodes for an inter-node test, so a failing pair points
+at the suspect. When there are not enough known-good nodes, suspects are paired
+with each other; a passing pair clears both nodes, which then serve as
+known-good partners in the next round, while a failing pair is retried against
+known-good nodes. The pool of known-good nodes therefore doubles every round
+and all suspects are isolated in O(log n) rounds.
+
+A test that cannot measure the bandwidth, e.g. because its pods never got
+scheduled or it timed out, is inconclusive rather than failed: the nodes it
+tested are neither cleared nor blamed. Likewise, suspects that only ever
+failed alongside each other, with no known-good node left to tell them apart,
+are inconclusive.
+
+The tests themselves are passed in, so scheduling can be exercised without a
+cluster.
+"""
+
+import concurrent.futures
+import os
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from konduktor import logging as konduktor_logging
+
+# max NCCL tests running at once
+HEALTH_CHECK_CONCURRENCY = int(os.environ.get("HEALTH_CHECK_CONCURRENCY", 8))
+
+logger = konduktor_logging.get_logger(__name__)
+
+# True if a test passed, False if it measured a failure and None if it was
+# inconclusive
+Result = Optional[bool]
+NodeTest = Callable[[str], Result]
+PairTest = Callable[[str, str], Result]
+
+
+def _run_all(
+    test: Callable[..., Result], args: Sequence[Tuple[str, ...]], concurrency: int
+) -> List[Result]:
+    """Runs `test` for every set of `args` concurrently, errors are inconclusive"""
+    if not args:
+        return []
+
+    def run(test_args: Tuple[str, ...]) -> Result:
+        try:
+            return test(*test_args)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.error(f"health check on {test_args} failed: {e}")
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(run, args))
+
+
+def check(
+    suspects: List[str],
+    healthy: List[str],
+    single_test: NodeTest,
+    pair_test: PairTest,
+    concurrency: int = HEALTH_CHECK_CONCURRENCY,
+) -> Dict[str, Result]:
+    """Runs NCCL tests on the suspect nodes
+
+    Args:
+        suspects (List[str]): tainted nodes to test
+        healthy (List[str]): known-good nodes to pair suspects with
+        single_test (NodeTest): single node NCCL test
+        pair_test (PairTest): inter-node NCCL test between two nodes
+        concurrency (int, optional): max tests running at once
+
+    Returns:
+        Dict[str, Result]: True for suspects that passed every test, False for
+            those that failed a test on their own or with a known-good node,
+            None if their tests were inconclusive
+    """
+    results: Dict[str, Result] = dict.fromkeys(suspects)
+    single = _run_all(single_test, [(node,) for node in suspects], concurrency)
+    pending = []
+    for node, ok in zip(suspects, single):
+        if ok:
+            pending.append(node)
+        else:
+            results[node] = ok
+    logger.info(f"{len(pending)}/{len(suspects)} nodes passed single node tests")
+    if not healthy and len(suspects) == 1:
+        # no other node to test the network against
+        results.update(dict.fromkeys(pending, True))
+        return results
+
+    anchors = list(healthy)
+    # failed alongside another suspect, needs a known-good partner
+    ambiguous: Set[str] = set()
+    rounds = 0
+    while pending:
+        # every node takes part in at most one test per round
+        pending.sort(key=lambda node: node not in ambiguous)
+        pairs = list(zip(pending, anchors))
+        unpaired = [node for node in pending[len(pairs) :] if node not in ambiguous]
+        pairs += list(zip(unpaired[::2], unpaired[1::2]))
+        if not pairs:
+            break
+        rounds += 1
+        known_good = set(anchors)
+        for (node_a, node_b), ok in zip(pairs, _run_all(pair_test, pairs, concurrency)):
+            tested = [node for node in (node_a, node_b) if node not in known_good]
+            for node in tested:
+                pending.remove(node)
+            if ok:
+                results.update(dict.fromkeys(tested, True))
+                anchors.extend(tested)
+            elif ok is None:
+                logger.info(f"inter-node test of {tested} was inconclusive")
+            elif len(tested) == 2:
+                ambiguous.update(tested)
+                pending.extend(tested)
+            else:
+                logger.info(f"node {tested[0]} failed inter-node test")
+                results[tested[0]] = False
+    if pending:
+        logger.info(f"no known-good node left to tell apart {pending}")
+    passed = sum(ok is True for ok in results.values())
+    failed = sum(ok is False for ok in results.values())
+    logger.info(
+        f"{passed}/{len(suspects)} nodes passed and {failed} failed health checks "
+        f"in {rounds} pair test rounds"
+    )
+    return results
@@ -0,0 +1,205 @@
+"""
+Node informer
+Keeps a local cache of every node's taints and resourceVersion by listing the
+nodes once and then watching for changes, so the controller can skip no-op
+taint/untaint patches without reading the node from the API server first.
+"""
+
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from konduktor import kube_client
+from konduktor import logging as konduktor_logging
+
+# seconds before the API server ends a watch, after which we resume it
+WATCH_TIMEOUT = 300
+# seconds to wait before relisting after the watch fails
+RETRY_SECONDS = 5
+# seconds `start` waits for the initial listing
+SYNC_TIMEOUT = 30
+
+logger = konduktor_logging.get_logger(__name__)
+
+GPU_RESOURCE = "nvidia.com/gpu"
+# comma separated node labels naming a node's pool, the first one set is used
+NODE_POOL_LABELS = os.environ.get(
+    "KONDUKTOR_NODE_POOL_LABELS",
+    "cloud.google.com/gke-nodepool,eks.amazonaws.com/nodegroup,"
+    "karpenter.sh/nodepool,node.kubernetes.io/instance-type",
+).split(",")
+# pool of nodes without any of `NODE_POOL_LABELS`
+DEFAULT_POOL = "default"
+
+Taints = List[Dict[str, Any]]
+
+
+def serialize_taints(node) -> Taints:
+    """Taints of a V1Node as JSON serializable dicts"""
+    api_client = kube_client.core_api().api_client
+    return [
+        api_client.sanitize_for_serialization(taint) for taint in node.spec.taints or []
+    ]
+
+
+def gpu_count(node) -> int:
+    """Allocatable GPUs of a V1Node"""
+    allocatable = (node.status.allocatable if node.status else None) or {}
+    return int(allocatable.get(GPU_RESOURCE, 0))
+
+
+def node_pool(node) -> str:
+    """Pool of a V1Node, from the first of `NODE_POOL_LABELS` it has"""
+    labels = node.metadata.labels or {}
+    for label in NODE_POOL_LABELS:
+        if labels.get(label):
+            return labels[label]
+    return DEFAULT_POOL
+
+
+def _newer(a: str, b: str) -> bool:
+    """Whether resourceVersion `a` is newer than `b`. resourceVersions are
+    opaque, but are etcd revisions in practice.
+    """
+    try:
+        return int(a) > int(b)
+    except ValueError:
+        return False
+
+
+class NodeInformer:
+    """Watch based cache of node taints"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # node name -> (resourceVersion, taints)
+        self._nodes: Dict[str, Tuple[str, Taints]] = {}
+        # node name -> allocatable GPUs
+        self._gpus: Dict[str, int] = {}
+        # node name -> node pool
+        self._pools: Dict[str, str] = {}
+        self.synced = threading.Event()
+
+    def get(self, node_name: str) -> Optional[Tuple[str, Taints]]:
+        """Cached resourceVersion and taints of a node, None if unknown"""
+        with self._lock:
+            return self._nodes.get(node_name)
+
+    def node_names(self) -> List[str]:
+        with self._lock:
+            return list(self._nodes)
+
+    def gpu_nodes(self) -> List[str]:
+        """Names of the nodes with allocatable GPUs"""
+        with self._lock:
+            return [name for name, gpus in self._gpus.items() if gpus > 0]
+
+    def pools(self) -> Dict[str, str]:
+        """Pool of every node, see `node_pool`"""
+        with self._lock:
+            return dict(self._pools)
+
+    def tainted_nodes(self, key: str) -> List[str]:
+        """Names of the nodes with a taint `key`"""
+        with self._lock:
+            return [
+                name
+                for name, (_, taints) in self._nodes.items()
+                if any(taint["key"] == key for taint in taints)
+            ]
+
+    def update(self, node):
+        """Caches a V1Node, unless we already have a newer version of it"""
+        resource_version = node.metadata.resource_version
+        entry = (resource_version, serialize_taints(node))
+        with self._lock:
+            cached = self._nodes.get(node.metadata.name)
+            if cached is None or not _newer(cached[0], resource_version):
+                self._nodes[node.metadata.name] = entry
+                self._gpus[node.metadata.name] = gpu_count(node)
+                self._pools[node.metadata.name] = node_pool(node)
+
+    def run(self, stop: threading.Event):
+        """Lists and watches nodes until `stop` is set
+
+        Once the watch fails, events may have been missed, so the cache is
+        not synced until the nodes were listed again.
+        """
+        while not stop.is_set():
+            try:
+                resource_version = self._list()
+                while not stop.is_set():
+                    resource_version = self._watch(resource_version, stop)
+            except kube_client.api_exception() as e:
+                self.synced.clear()
+                if e.status == 410:
+                    logger.debug("node watch expired, relisting")
+                    continue
+                logger.warning(f"node watch failed: {e}")
+            except kube_client.max_retry_error() as e:
+                self.synced.clear()
+                logger.warning(f"node watch failed: {e}")
+            except Exception as e:  # pylint: disable=broad-except
+                # e.g. a dropped connection or an undecodable event
+                self.synced.clear()
+                logger.error(f"node watch failed: {e}")
+            stop.wait(RETRY_SECONDS)
+
+    def _list(self) -> str:
+        nodes = kube_client.core_api().list_node(
+            _request_timeout=kube_client.API_TIMEOUT
+        )
+        listed = {
+            node.metadata.name: (node.metadata.resource_version, serialize_taints(node))
+            for node in nodes.items
+        }
+        gpus = {node.metadata.name: gpu_count(node) for node in nodes.items}
+        pools = {node.metadata.name: node_pool(node) for node in nodes.items}
+        with self._lock:
+            self._nodes = listed
+            self._gpus = gpus
+            self._pools = pools
+        self.synced.set()
+        logger.debug(f"node informer synced {len(listed)} nodes")
+        return nodes.metadata.resource_version
+
+    def _watch(self, resource_version: str, stop: threading.Event) -> str:
+        watch = kube_client.watch()
+        for event in watch.stream(
+            kube_client.core_api().list_node,
+            resource_version=resource_version,
+            timeout_seconds=WATCH_TIMEOUT,
+        ):
+            node = event["object"]
+            if event["type"] == "DELETED":
+                with self._lock:
+                    self._nodes.pop(node.metadata.name, None)
+                    self._gpus.pop(node.metadata.name, None)
+                    self._pools.pop(node.metadata.name, None)
+            else:
+                self.update(node)
+            if stop.is_set():
+                watch.stop()
+        return watch.resource_version or resource_version
+
+
+_informer: Optional[NodeInformer] = None
+
+
+def start(stop: threading.Event) -> NodeInformer:
+    """Starts the node informer in the background and waits for it to sync"""
+    global _informer
+    informer = NodeInformer()
+    thread = threading.Thread(target=informer.run, args=(stop,), daemon=True)
+    thread.start()
+    if not informer.synced.wait(SYNC_TIMEOUT):
+        logger.warning("node informer has not synced, reading nodes directly")
+    _informer = informer
+    return informer
+
+
+def get() -> Optional[NodeInformer]:
+    """The running node informer if it has synced, None otherwise"""
+    if _informer is None or not _informer.synced.is_set():
+        return None
+    return _informer
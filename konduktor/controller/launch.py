@@ -1,43 +1,632 @@
 """
 Controller loop
-The controller is run as a deployment and repeatedly polls the logging backend
-for GPU related error logs. When a GPU, CUDA, NCCL error is detected,
+The controller is run as a deployment and continuously ingests GPU related
+error logs from the logging backend. When a GPU, CUDA, NCCL error is detected,
 we check against a set of known patterns(regexes) to see if the error is
 irrecoverable making the node unfit for more work. We can then label/taint
 the node to prevent more pods from being scheduled onto the node.
 
 Sometimes an NCCL error can be raised due to all-reduce style workloads causing
-all workers to fail even though only one is actually faulty. To place workers,
-back into the working pool, we run a health check which just consists of doing NCCL
-test on the tainted nodes
+all workers to fail even though only one is actually faulty. Pod errors are
+therefore correlated by job first, see `correlate`, and only the probable
+culprits are tainted while the other nodes get targeted NCCL tests. To place
+workers back into the working pool, we run a health check which just consists
+of doing NCCL test on the tainted nodes
+
+The controller is an asyncio application with independent tasks for log
+ingestion, classification, remediation and health checking, connected by
+bounded queues. A full queue blocks its producer, and a long running health
+check never delays error detection.
+
+State that must survive restarts, such as how far logs were ingested and which
+faults were remediated, is kept by `state.ControllerState` and flushed in the
+background.
+
+With leader election, replicas hold a Lease per shard and only the holder
+runs the controller, see `leader`. With more than one shard, the nodes are
+split across shards by consistent hashing and each shard only queries logs
+of, remediates and health checks its own nodes, see `shard`.
 """
 
+import asyncio
+import functools
+import os
+import signal
+import sys
+import threading
 import time
-from typing import Set
+from typing import Callable, Dict, List, Optional, Tuple
 
-from konduktor import logging
-from konduktor.controller import constants, parse
+from konduktor import logging, loki_client
+from konduktor.controller import (
+    constants,
+    correlate,
+    dcgm,
+    faults,
+    informer,
+    leader,
+    metrics,
+    parse,
+    remediation,
+    shard,
+    state,
+    tail,
+)
 from konduktor.controller import node as node_control
 
 KONDUKTOR_CONTROLLER_LOG_POLL_SECONDS = 5
 KONDUKTOR_CONTROLLER_HEALTH_CHECK_FREQ = 5
+# `tail` streams logs from loki as they arrive, `poll` queries them periodically
+KONDUKTOR_CONTROLLER_INGEST_MODE = os.environ.get(
+    "KONDUKTOR_CONTROLLER_INGEST_MODE", "tail"
+)
+# flag GPUs whose DCGM metrics in Prometheus look anomalous
+KONDUKTOR_CONTROLLER_DCGM = (
+    os.environ.get("KONDUKTOR_CONTROLLER_DCGM", "false").lower() == "true"
+)
+# hold a Lease so only one replica per shard runs the controller
+KONDUKTOR_CONTROLLER_LEADER_ELECTION = (
+    os.environ.get("KONDUKTOR_CONTROLLER_LEADER_ELECTION", "false").lower() == "true"
+)
+# shards the cluster's nodes are split across, each led by one replica
+KONDUKTOR_CONTROLLER_SHARDS = int(os.environ.get("KONDUKTOR_CONTROLLER_SHARDS", 1))
+# seconds between checks for nodes joining or leaving this replica's shard
+SHARD_REFRESH_SECONDS = 30
+# seconds to wait before listing the nodes of the shard again after a failure
+SHARD_RETRY_SECONDS = 5
+# seconds to wait for tailers to stop before restarting them
+TAILER_JOIN_TIMEOUT = 10
+# max log lines waiting to be classified
+LINE_QUEUE_SIZE = 10000
+# max faulty nodes waiting to be remediated
+FAULT_QUEUE_SIZE = 1000
+# seconds to finish processing queued lines and faults on shutdown
+SHUTDOWN_TIMEOUT = 30
+# max log lines classified between yields to the event loop
+CLASSIFY_BATCH_SIZE = 1000
+# seconds between checks for jobs whose faults can be attributed
+CORRELATE_SECONDS = 1
+# seconds between loop lag and queue size samples
+MONITOR_SECONDS = 1
 
 logger = logging.get_logger("konduktor.controller")
 
+Classifier = Callable[[Dict[str, str], int, str], Optional[faults.Fault]]
+# fault source, stream labels, timestamp, log line
+LogLine = Tuple[str, Dict[str, str], int, str]
+
+# LogQL query, given the nodes to query or None for all, and classifier of
+# each fault source
+SOURCES: Dict[str, Tuple[Callable[[Optional[List[str]]], str], Classifier]] = {
+    faults.SOURCE_POD: (parse.pod_query, parse.pod_error),
+    faults.SOURCE_DMESG: (parse.dmesg_query, parse.dmesg_error),
+}
+
+
+class Controller:
+    """
+    Args:
+        node_shard (Optional[shard.Shard], optional): only handle the nodes of
+            this shard, all nodes if None
+        elector (Optional[leader.Elector], optional): stops the controller
+            once its Lease is lost
+    """
+
+    def __init__(
+        self,
+        node_shard: Optional[shard.Shard] = None,
+        elector: Optional[leader.Elector] = None,
+    ):
+        self.lines: asyncio.Queue[LogLine] = asyncio.Queue(maxsize=LINE_QUEUE_SIZE)
+        self.faults: asyncio.Queue[str] = asyncio.Queue(maxsize=FAULT_QUEUE_SIZE)
+        # untainted nodes of failed jobs waiting for targeted health checks
+        self.suspects: asyncio.Queue[str] = asyncio.Queue(maxsize=FAULT_QUEUE_SIZE)
+        self.store = faults.FaultStore()
+        self.correlator = correlate.Correlator()
+        self.resolver = correlate.JobResolver()
+        self.executor = remediation.RemediationExecutor(
+            shards=1 if node_shard is None else node_shard.count
+        )
+        self.shard = node_shard
+        self.elector = elector
+        shard_index = None if node_shard is None else node_shard.index
+        self.state = state.ControllerState(
+            self.store,
+            self.correlator,
+            state.backend(shard=shard_index),
+            shard_index,
+            self.executor.guard,
+            owns=None if elector is None else elector.holds,
+        )
+        self.stop = asyncio.Event()
+
+    def _owns(self, node: str) -> bool:
+        return self.shard is None or self.shard.owns(node)
+
+    def _owned_nodes(self) -> Optional[List[str]]:
+        """Nodes of this shard, None to handle every node"""
+        if self.shard is None:
+            return None
+        node_informer = informer.get()
+        if node_informer is not None:
+            names = node_informer.node_names()
+        else:
+            names = node_control.list_nodes()
+        nodes = self.shard.nodes(names)
+        metrics.OWNED_NODES.set(len(nodes))
+        return nodes
+
+    def _tailer(
+        self, source: str, nodes: Optional[List[str]], stop: threading.Event
+    ) -> threading.Thread:
+        loop = asyncio.get_running_loop()
+        query, _ = SOURCES[source]
+
+        def on_line(stream: Dict[str, str], ts: int, log_content: str):
+            # blocks the tailer while the queue is full
+            asyncio.run_coroutine_threadsafe(
+                self.lines.put((source, stream, ts, log_content)), loop
+            ).result()
+
+        tailer = tail.LokiTailer(
+            query(nodes), on_line, cursor=self.state.resume_cursor(source)
+        )
+        return threading.Thread(target=tailer.run, args=(stop,), daemon=True)
+
+    async def ingest_tail(self):
+        """Streams log lines from loki as they arrive. The tailers are
+        restarted from the last classified line when the nodes of the shard
+        change.
+        """
+        while not self.stop.is_set():
+            try:
+                nodes = await asyncio.to_thread(self._owned_nodes)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"failed to list the nodes of {self.shard}: {e}")
+                await self._wait_stop(SHARD_RETRY_SECONDS)
+                continue
+            tailers_stop = threading.Event()
+            tailers = [self._tailer(source, nodes, tailers_stop) for source in SOURCES]
+            for tailer in tailers:
+                tailer.start()
+            try:
+                while not await self._wait_stop(SHARD_REFRESH_SECONDS):
+                    if self.shard is None:
+                        continue
+                    try:
+                        owned = await asyncio.to_thread(self._owned_nodes)
+                    except Exception as e:  # pylint: disable=broad-except
+                        # keep tailing the nodes we know of
+                        logger.error(f"failed to list the nodes of {self.shard}: {e}")
+                        continue
+                    if owned != nodes:
+                        logger.info(
+                            f"nodes of {self.shard} changed, restarting tailers"
+                        )
+                        break
+            finally:
+                tailers_stop.set()
+            for tailer in tailers:
+                await asyncio.to_thread(tailer.join, TAILER_JOIN_TIMEOUT)
+
+    async def _wait_stop(self, timeout: float) -> bool:
+        """Waits up to `timeout` seconds for the controller to stop
+
+        Returns:
+            bool: True if the controller is stopping
+        """
+        try:
+            await asyncio.wait_for(self.stop.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.stop.is_set()
+
+    def _poll_start(self, read_ns: int) -> int:
+        """Timestamp the next poll starts from, the floor of the cursor
+        furthest behind so lines loki received late are still read, but no
+        further back than the cursors' lookback before `read_ns`, which every
+        line was read up to, nor than `state.MAX_RESUME_SECONDS` ago
+        """
+        start_ns = read_ns - parse.LOGS_SINCE * 10**9
+        for source in SOURCES:
+            cursor = self.state.cursors.get(source)
+            if cursor is not None:
+                start_ns = min(start_ns, max(cursor.floor, read_ns - cursor.lookback))
+        return max(start_ns, time.time_ns() - state.MAX_RESUME_SECONDS * 10**9)
+
+    async def ingest_poll(self):
+        """Queries loki for log lines every poll period, resuming from the
+        per stream cursors so a failed poll's window is read by the next one
+        """
+        url = f"{parse.LOG_ENDPOINT}{parse.QUERY_URL}"
+        loop = asyncio.get_running_loop()
+        # the first query after a restart covers the time we were down
+        cursors = [self.state.resume_cursor(source) for source in SOURCES]
+        read_ns = time.time_ns()
+        if any(cursors):
+            read_ns = min(cursor.floor for cursor in cursors if cursor)
+        while not self.stop.is_set():
+            cycle_start = loop.time()
+            end_ns = time.time_ns()
+            try:
+                nodes = await asyncio.to_thread(self._owned_nodes)
+                with metrics.timed(metrics.STAGE_QUERY):
+                    results = await asyncio.to_thread(
+                        loki_client.query_range_many,
+                        url,
+                        [query(nodes) for query, _ in SOURCES.values()],
+                        self._poll_start(read_ns),
+                        end_ns,
+                    )
+            except Exception as e:  # pylint: disable=broad-except
+                # the next poll covers this one's window too
+                logger.error(f"failed to poll loki: {e}")
+                results = []
+            if results and all(entries is not None for entries in results):
+                read_ns = end_ns
+            elif results:
+                logger.error("a loki query failed, the next poll retries its window")
+            with metrics.timed(metrics.STAGE_PARSE):
+                lines = [
+                    (source, stream, ts, log_content)
+                    for source, entries in zip(SOURCES, results)
+                    for stream, ts, log_content in entries or []
+                ]
+                # classified lines are skipped by timestamp, see `_classify`
+                lines.sort(key=lambda line: line[2])
+            for line in lines:
+                await self.lines.put(line)
+            elapsed = loop.time() - cycle_start
+            metrics.POLL_OVERRUN_SECONDS.set(
+                max(0.0, elapsed - KONDUKTOR_CONTROLLER_LOG_POLL_SECONDS)
+            )
+            try:
+                await asyncio.wait_for(
+                    self.stop.wait(),
+                    max(0.0, KONDUKTOR_CONTROLLER_LOG_POLL_SECONDS - elapsed),
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def classify(self):
+        while True:
+            # classify whatever is queued as one batch
+            batch = [await self.lines.get()]
+            while len(batch) < CLASSIFY_BATCH_SIZE and not self.lines.empty():
+                batch.append(self.lines.get_nowait())
+            try:
+                with metrics.timed(metrics.STAGE_CLASSIFY):
+                    detected = self._classify(batch)
+                for fault in detected:
+                    try:
+                        await self._handle(fault)
+                    except Exception as e:  # pylint: disable=broad-except
+                        logger.error(f"failed to handle fault {fault}: {e}")
+            finally:
+                for _ in batch:
+                    self.lines.task_done()
+
+    async def _handle(self, fault: faults.Fault):
+        # debounced codes are often caused by the application, so they would
+        # point at every node of a failed job
+        if (
+            fault.source in (faults.SOURCE_DMESG, faults.SOURCE_DCGM)
+            and fault.code not in self.store.rules
+        ):
+            self.correlator.evidence(fault)
+        if fault.source == faults.SOURCE_POD and self.correlator.window > 0:
+            job = await asyncio.to_thread(self.resolver.job, fault.labels or {})
+            self.correlator.add(fault, job)
+            self.state.dirty = True
+            return
+        await self._remediate(fault)
+
+    async def _remediate(self, fault: faults.Fault):
+        # only the first occurrence of a fault is remediated
+        if self.store.add(fault):
+            self.state.record_fault(fault)
+            await self.faults.put(fault.node)
+
+    def _classify(self, batch: List[LogLine]) -> List[faults.Fault]:
+        detected = []
+        for source, stream, ts, log_content in batch:
+            # lines repeated by overlapping polls or classified before a restart
+            if not self.state.advance(source, stream, ts, log_content):
+                continue
+            metrics.LINES.labels(source).inc()
+            try:
+                fault = SOURCES[source][1](stream, ts, log_content)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"failed to classify {source} line {log_content!r}: {e}")
+                continue
+            # the node may have moved to another shard since it was queried
+            if fault is not None and self._owns(fault.node):
+                metrics.FAULTS.labels(fault.source, fault.code, fault.node).inc()
+                detected.append(fault)
+        return detected
+
+    async def detect_dcgm(self):
+        """Checks DCGM metrics for anomalies every `dcgm.DCGM_POLL_SECONDS`"""
+        while not self.stop.is_set():
+            try:
+                detected = await asyncio.to_thread(dcgm.detect)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"DCGM anomaly detection failed: {e}")
+                detected = []
+            for fault in detected:
+                if not self._owns(fault.node):
+                    continue
+                metrics.FAULTS.labels(fault.source, fault.code, fault.node).inc()
+                await self._handle(fault)
+            try:
+                await asyncio.wait_for(self.stop.wait(), dcgm.DCGM_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def correlate(self):
+        """Taints the culprits of jobs whose correlation window closed and
+        queues their other nodes for targeted health checks
+        """
+        while True:
+            await asyncio.sleep(CORRELATE_SECONDS)
+            try:
+                verdicts = self.correlator.ready()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"failed to attribute job failures: {e}")
+                continue
+            for verdict in verdicts:
+                metrics.CORRELATED_JOBS.labels(verdict.kind).inc()
+                logger.info(f"attributed job failure {verdict}")
+                for fault in verdict.culprits:
+                    await self._remediate(fault)
+                for node in verdict.suspects:
+                    await self.suspects.put(node)
+            if verdicts:
+                self.state.dirty = True
+
+    async def check_suspects(self):
+        """Runs NCCL tests on the suspects of failed jobs and taints those
+        that fail
+        """
+        while True:
+            batch = [await self.suspects.get()]
+            while not self.suspects.empty():
+                batch.append(self.suspects.get_nowait())
+            try:
+                results = await asyncio.to_thread(
+                    node_control.check_nodes, sorted(set(batch)), self.state.pending()
+                )
+                self.state.record_health(results)
+                for node, passed in results.items():
+                    # inconclusive tests, e.g. pods that were never scheduled,
+                    # say nothing about the node
+                    if passed is False:
+                        await self._remediate(
+                            faults.Fault(
+                                node,
+                                faults.SOURCE_CHECK,
+                                "NCCLTest",
+                                time.time_ns(),
+                                "failed targeted health check",
+                            )
+                        )
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"targeted health check failed: {e}")
+            finally:
+                for _ in batch:
+                    self.suspects.task_done()
+
+    async def remediate(self):
+        while True:
+            node = await self.faults.get()
+            try:
+                task = await self.executor.submit(node, self.state.reason(node))
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"failed to remediate node {node}: {e}")
+                self.faults.task_done()
+                # a later fault may try again
+                self.store.forget([node])
+                continue
+            task.add_done_callback(functools.partial(self._remediated, node))
+
+    def _remediated(self, node: str, task: "asyncio.Task[str]"):
+        self.faults.task_done()
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            logger.error(f"failed to remediate node {node}: {error}")
+            result = remediation.RESULT_ERROR
+        else:
+            result = task.result()
+        self.state.remediated(node, result)
+        if result in (remediation.RESULT_BLOCKED, remediation.RESULT_ERROR):
+            # a later fault may try again
+            self.store.forget([node])
+
+    async def health_check(self):
+        period = (
+            KONDUKTOR_CONTROLLER_LOG_POLL_SECONDS
+            * KONDUKTOR_CONTROLLER_HEALTH_CHECK_FREQ
+        )
+        while True:
+            await asyncio.sleep(period)
+            try:
+                with metrics.HEALTH_CHECK_SECONDS.time():
+                    results = await asyncio.to_thread(
+                        node_control.health_check, self._owns
+                    )
+                self.state.record_health(results)
+                healthy = [node for node, passed in results.items() if passed]
+                self.store.forget(healthy)
+                for node in healthy:
+                    self.executor.audit.record(
+                        "untaint",
+                        node,
+                        "",
+                        remediation.RESULT_PATCHED,
+                        reason="passed health checks",
+                    )
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"health check failed: {e}")
+
+    async def monitor(self):
+        """Samples event loop lag and queue sizes"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(MONITOR_SECONDS)
+            metrics.LOOP_LAG_SECONDS.set(
+                max(0.0, loop.time() - start - MONITOR_SECONDS)
+            )
+            metrics.QUEUE_SIZE.labels("lines").set(self.lines.qsize())
+            metrics.QUEUE_SIZE.labels("faults").set(self.faults.qsize())
+
+    async def persist(self):
+        """Flushes changed state every `state.STATE_FLUSH_SECONDS`"""
+        while True:
+            await asyncio.sleep(state.STATE_FLUSH_SECONDS)
+            await self._flush()
+
+    async def _flush(self):
+        if self.state.dirty:
+            await asyncio.to_thread(self.state.save, self.state.snapshot())
+
+    async def follow_leader(self):
+        """Stops the controller once the Lease of its shard is lost"""
+        if self.elector is None:
+            return
+        while not self.elector.lost.is_set():
+            await asyncio.sleep(1)
+        logger.error("lost leadership, shutting down")
+        self.stop.set()
+
+    async def _drain(self):
+        await self.lines.join()
+        await self.faults.join()
+
+    async def _supervise(self, tasks: List["asyncio.Task[None]"]) -> bool:
+        """Waits for the controller to stop, stopping it early if a task dies
+
+        Returns:
+            bool: False if a task died
+        """
+        stopping = asyncio.create_task(self.stop.wait())
+        pending = set(tasks)
+        healthy = True
+        while not self.stop.is_set():
+            done, pending = await asyncio.wait(
+                pending | {stopping}, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done - {stopping}:
+                error = None if task.cancelled() else task.exception()
+                if error is not None:
+                    logger.error(
+                        f"{task.get_name()} died, shutting down: {error!r}",
+                        exc_info=error,
+                    )
+                    healthy = False
+                    self.stop.set()
+            pending.discard(stopping)
+        stopping.cancel()
+        return healthy
+
+    async def run(self) -> bool:
+        """Runs until stopped
+
+        Returns:
+            bool: False if the controller stopped because a task died or the
+                Lease of its shard was lost
+        """
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop.set)
+
+        await asyncio.to_thread(self.state.load)
+        for node in self.state.pending():
+            logger.info(f"resuming remediation of node {node}")
+            self.faults.put_nowait(node)
+
+        if KONDUKTOR_CONTROLLER_INGEST_MODE == "poll":
+            ingest = asyncio.create_task(self.ingest_poll(), name="ingest_poll")
+        else:
+            ingest = asyncio.create_task(self.ingest_tail(), name="ingest_tail")
+        detectors = []
+        if KONDUKTOR_CONTROLLER_DCGM:
+            detectors.append(
+                asyncio.create_task(self.detect_dcgm(), name="detect_dcgm")
+            )
+        workers = [
+            asyncio.create_task(worker(), name=worker.__name__)
+            for worker in (
+                self.classify,
+                self.correlate,
+                self.check_suspects,
+                self.remediate,
+                self.health_check,
+                self.monitor,
+                self.persist,
+                self.follow_leader,
+            )
+        ]
+
+        healthy = await self._supervise([ingest, *detectors, *workers])
+        if self.elector is not None and self.elector.lost.is_set():
+            # another replica may lead the shard already, so queued lines and
+            # faults are left to it and our state must not overwrite its own
+            logger.error("shutting down konduktor.controller without draining")
+            tasks = [ingest, *detectors, *workers]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            return False
+        logger.info("shutting down konduktor.controller")
+        for task in [ingest, *detectors]:
+            try:
+                await task
+            except Exception as e:  # pylint: disable=broad-except
+                # supervised, but it may have died while we were stopping
+                logger.error(f"{task.get_name()} failed: {e}")
+        try:
+            await asyncio.wait_for(self._drain(), SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("shutdown timed out with unprocessed log lines")
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await self._flush()
+        return healthy
+
 
 def main():
     logger.info(
         f"starting konduktor.controller ver. {constants.KONDUKTOR_CONTROLLER_VERSION}"
     )
-    while True:
-        for _ in range(KONDUKTOR_CONTROLLER_HEALTH_CHECK_FREQ):
-            time.sleep(KONDUKTOR_CONTROLLER_LOG_POLL_SECONDS)
-            error_by_pod: Set[str] = parse.pod_errors()
-            error_by_dmesg: Set[str] = parse.dmesg_errors()
-            for node in error_by_pod | error_by_dmesg:
-                node_control.taint(node)
-
-        node_control.health_check()
+    metrics.start()
+    informer.start(threading.Event())
+    if not KONDUKTOR_CONTROLLER_LEADER_ELECTION and KONDUKTOR_CONTROLLER_SHARDS == 1:
+        if not asyncio.run(Controller().run()):
+            sys.exit(1)
+        return
+
+    elector = leader.Elector(KONDUKTOR_CONTROLLER_SHARDS)
+    elector_stop = threading.Event()
+    elector_thread = elector.start(elector_stop)
+    logger.info(f"{elector.identity} waiting for a free shard")
+    elector.acquired.wait()
+    node_shard = None
+    if KONDUKTOR_CONTROLLER_SHARDS > 1:
+        node_shard = shard.Shard(elector.shard or 0, KONDUKTOR_CONTROLLER_SHARDS)
+    metrics.LEADER.labels(elector.shard).set(1)
+    try:
+        healthy = asyncio.run(Controller(node_shard, elector).run())
+    finally:
+        # release the Lease so a standby takes over right away
+        elector_stop.set()
+        elector_thread.join()
+        metrics.LEADER.labels(elector.shard).set(0)
+    if not healthy:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,382 @@
+"""
+Leader election
+Controller replicas coordinate through Kubernetes Leases, one per shard,
+named `konduktor-controller-<shard>`. A replica claims the first free shard
+and keeps renewing its Lease; the others wait as hot standbys and take over
+once a Lease has not been renewed for `LEASE_DURATION_SECONDS`, or right away
+when its holder shuts down and releases it. Like client-go, expiry is judged
+by when we last saw the Lease change rather than by its timestamps, so clock
+skew between replicas does not matter.
+https://kubernetes.io/docs/concepts/architecture/leases/
+
+The coordination API is passed in, so election can be exercised without a
+cluster.
+"""
+
+import datetime
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import kubernetes
+
+from konduktor import kube_client
+from konduktor import logging as konduktor_logging
+from konduktor.controller import shard
+
+LEASE_NAMESPACE = os.environ.get("KONDUKTOR_CONTROLLER_NAMESPACE", "konduktor")
+LEASE_PREFIX = "konduktor-controller"
+# seconds a Lease is valid for after it was last renewed
+LEASE_DURATION_SECONDS = int(os.environ.get("KONDUKTOR_CONTROLLER_LEASE_SECONDS", 15))
+# seconds between attempts to claim a shard
+RETRY_SECONDS = 2
+IDENTITY = os.environ.get("POD_NAME") or socket.gethostname()
+
+logger = konduktor_logging.get_logger(__name__)
+
+
+class LeaseLock:
+    """A Lease held by `identity` while it keeps renewing it
+
+    Args:
+        name (str): Lease name
+        identity (str): unique name of this replica
+        api (optional): coordination API. Defaults to
+            `kube_client.coordination_api()`
+        namespace (str, optional): Lease namespace
+        duration (int, optional): seconds the Lease is valid after a renewal
+    """
+
+    def __init__(
+        self,
+        name: str,
+        identity: str,
+        api: Any = None,
+        namespace: str = LEASE_NAMESPACE,
+        duration: int = LEASE_DURATION_SECONDS,
+    ):
+        self.name = name
+        self.identity = identity
+        self.namespace = namespace
+        self.duration = duration
+        self._api = api
+        # holder and renewTime when the Lease last changed, and when we saw it
+        self._observed: Optional[Tuple[Optional[str], Any]] = None
+        self._observed_at = 0.0
+
+    @property
+    def api(self):
+        if self._api is None:
+            self._api = kube_client.coordination_api()
+        return self._api
+
+    def _lease(
+        self, acquire_time: datetime.datetime, transitions: int
+    ) -> kubernetes.client.V1Lease:
+        return kubernetes.client.V1Lease(
+            metadata=kubernetes.client.V1ObjectMeta(
+                name=self.name, namespace=self.namespace
+            ),
+            spec=kubernetes.client.V1LeaseSpec(
+                holder_identity=self.identity,
+                lease_duration_seconds=self.duration,
+                acquire_time=acquire_time,
+                renew_time=datetime.datetime.now(datetime.timezone.utc),
+                lease_transitions=transitions,
+            ),
+        )
+
+    def try_acquire(self) -> bool:
+        """Acquires the Lease if it is free or expired, or renews it if we
+        already hold it
+
+        Returns:
+            bool: True if we hold the Lease
+        """
+        try:
+            lease = self.api.read_namespaced_lease(
+                name=self.name,
+                namespace=self.namespace,
+                _request_timeout=kube_client.API_TIMEOUT,
+            )
+        except kube_client.api_exception() as e:
+            if e.status != 404:
+                raise
+            return self._write(
+                self._lease(datetime.datetime.now(datetime.timezone.utc), 0)
+            )
+
+        spec = lease.spec
+        record = (spec.holder_identity, spec.renew_time)
+        if record != self._observed:
+            self._observed = record
+            self._observed_at = time.monotonic()
+        duration = spec.lease_duration_seconds or self.duration
+        expired = time.monotonic() > self._observed_at + duration
+        if spec.holder_identity == self.identity:
+            body = self._lease(spec.acquire_time, spec.lease_transitions or 0)
+        elif not spec.holder_identity or expired:
+            body = self._lease(
+                datetime.datetime.now(datetime.timezone.utc),
+                (spec.lease_transitions or 0) + 1,
+            )
+        else:
+            return False
+        body.metadata.resource_version = lease.metadata.resource_version
+        return self._write(body)
+
+    def _write(self, body: kubernetes.client.V1Lease) -> bool:
+        """Creates or replaces the Lease, guarded by its resourceVersion
+
+        Returns:
+            bool: False if another replica wrote it first
+        """
+        try:
+            if body.metadata.resource_version is None:
+                self.api.create_namespaced_lease(
+                    namespace=self.namespace,
+                    body=body,
+                    _request_timeout=kube_client.API_TIMEOUT,
+                )
+            else:
+                self.api.replace_namespaced_lease(
+                    name=self.name,
+                    namespace=self.namespace,
+                    body=body,
+                    _request_timeout=kube_client.API_TIMEOUT,
+                )
+        except kube_client.api_exception() as e:
+            if e.status == 409:
+                return False
+            raise
+        self._observed = (self.identity, body.spec.renew_time)
+        self._observed_at = time.monotonic()
+        return True
+
+    def held(self) -> bool:
+        """Whether we still hold the Lease, reading it from the API"""
+        try:
+            lease = self.api.read_namespaced_lease(
+                name=self.name,
+                namespace=self.namespace,
+                _request_timeout=kube_client.API_TIMEOUT,
+            )
+        except kube_client.api_exception() as e:
+            if e.status == 404:
+                return False
+            raise
+        return lease.spec.holder_identity == self.identity
+
+    def release(self):
+        """Gives up the Lease so a standby takes over without waiting for it
+        to expire
+        """
+        try:
+            lease = self.api.read_namespaced_lease(
+                name=self.name,
+                namespace=self.namespace,
+                _request_timeout=kube_client.API_TIMEOUT,
+            )
+            if lease.spec.holder_identity != self.identity:
+                return
+            lease.spec.holder_identity = None
+            self.api.replace_namespaced_lease(
+                name=self.name,
+                namespace=self.namespace,
+                body=lease,
+                _request_timeout=kube_client.API_TIMEOUT,
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning(f"failed to release lease {self.name}: {e}")
+
+
+class Elector:
+    """Claims the Lease of one of `shards` shards and keeps renewing it
+
+    The Lease is renewed every third of its duration. `acquired` is set once
+    a shard was claimed, and `lost` if its Lease could not be renewed within
+    two thirds of its duration, after which another replica may take over.
+
+    Args:
+        shards (int, optional): number of shards
+        identity (str, optional): unique name of this replica
+        api (optional): coordination API. Defaults to
+            `kube_client.coordination_api()`
+        namespace (str, optional): Lease namespace
+        duration (int, optional): seconds a Lease is valid after a renewal
+    """
+
+    def __init__(
+        self,
+        shards: int = 1,
+        identity: str = IDENTITY,
+        api: Any = None,
+        namespace: str = LEASE_NAMESPACE,
+        duration: int = LEASE_DURATION_SECONDS,
+    ):
+        self.identity = identity
+        self.locks = [
+            LeaseLock(f"{LEASE_PREFIX}-{i}", identity, api, namespace, duration)
+            for i in range(shards)
+        ]
+        self.renew_seconds = duration / 3
+        # step down before the Lease expires and a standby takes over
+        self.renew_deadline = duration * 2 / 3
+        self.retry_seconds = min(RETRY_SECONDS, self.renew_seconds)
+        self.shard: Optional[int] = None
+        self.acquired = threading.Event()
+        self.lost = threading.Event()
+
+    def run(self, stop: threading.Event):
+        """Claims and renews a shard until `stop` is set, then releases it"""
+        # replicas start at different shards so they do not all race for one
+        first = shard.HashRing(len(self.locks)).owner(self.identity)
+        order = self.locks[first:] + self.locks[:first]
+        while not stop.is_set() and self.shard is None:
+            for lock in order:
+                if self._try(lock):
+                    self.shard = self.locks.index(lock)
+                    logger.info(f"{self.identity} is leading {lock.name}")
+                    self.acquired.set()
+                    break
+            else:
+                stop.wait(self.retry_seconds)
+        if self.shard is None:
+            return
+
+        lock = self.locks[self.shard]
+        renewed_at = time.monotonic()
+        while not stop.wait(self.renew_seconds):
+            while not self._try(lock):
+                if time.monotonic() - renewed_at > self.renew_deadline:
+                    logger.error(f"{self.identity} lost {lock.name}")
+                    self.lost.set()
+                    return
+                if stop.wait(self.retry_seconds):
+                    break
+            else:
+                renewed_at = time.monotonic()
+        lock.release()
+
+    def holds(self) -> bool:
+        """Whether we still lead our shard, reading its Lease from the API"""
+        if self.shard is None or self.lost.is_set():
+            return False
+        return self.locks[self.shard].held()
+
+    def _try(self, lock: LeaseLock) -> bool:
+        try:
+            return lock.try_acquire()
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning(f"failed to acquire lease {lock.name}: {e}")
+            return False
+
+    def start(self, stop: threading.Event) -> threading.Thread:
+        thread = threading.Thread(target=self.run, args=(stop,), daemon=True)
+        thread.start()
+        return thread
+
+
+class FakeCoordinationApi:
+    """In-memory coordination API for exercising election without a cluster.
+    Writes are checked against resourceVersions like the API server does.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases: Dict[Tuple[str, str], kubernetes.client.V1Lease] = {}
+        self._version = 0
+
+    def _conflict(self, reason: str):
+        return kube_client.api_exception()(status=409, reason=reason)
+
+    def read_namespaced_lease(self, name: str, namespace: str, **kwargs):
+        with self._lock:
+            lease = self._leases.get((namespace, name))
+            if lease is None:
+                raise kube_client.api_exception()(status=404, reason="NotFound")
+            return _copy(lease)
+
+    def create_namespaced_lease(self, namespace: str, body, **kwargs):
+        with self._lock:
+            key = (namespace, body.metadata.name)
+            if key in self._leases:
+                raise self._conflict("AlreadyExists")
+            return self._store(key, body)
+
+    def replace_namespaced_lease(self, name: str, namespace: str, body, **kwargs):
+        with self._lock:
+            key = (namespace, name)
+            current = self._leases.get(key)
+            if current is None:
+                raise kube_client.api_exception()(status=404, reason="NotFound")
+            if body.metadata.resource_version != current.metadata.resource_version:
+                raise self._conflict("Conflict")
+            return self._store(key, body)
+
+    def _store(self, key, body):
+        self._version += 1
+        lease = _copy(body)
+        lease.metadata.resource_version = str(self._version)
+        self._leases[key] = lease
+        return _copy(lease)
+
+
+def _copy(lease: kubernetes.client.V1Lease) -> kubernetes.client.V1Lease:
+    spec = lease.spec
+    return kubernetes.client.V1Lease(
+        metadata=kubernetes.client.V1ObjectMeta(
+            name=lease.metadata.name,
+            namespace=lease.metadata.namespace,
+            resource_version=lease.metadata.resource_version,
+        ),
+        spec=kubernetes.client.V1LeaseSpec(
+            holder_identity=spec.holder_identity,
+            lease_duration_seconds=spec.lease_duration_seconds,
+            acquire_time=spec.acquire_time,
+            renew_time=spec.renew_time,
+            lease_transitions=spec.lease_transitions,
+        ),
+    )
+
+
+if __name__ == "__main__":
+    # 3 replicas compete for 2 shards, then a leader crashes and one shuts down
+    fake_api = FakeCoordinationApi()
+    replicas = []
+    for i in range(3):
+        replica_stop = threading.Event()
+        elector = Elector(2, f"replica-{i}", api=fake_api, duration=3)
+        elector.start(replica_stop)
+        replicas.append((elector, replica_stop))
+    time.sleep(1)
+    leaders = {e.shard: e for e, _ in replicas if e.acquired.is_set()}
+    standby = next(e for e, _ in replicas if not e.acquired.is_set())
+    print(f"leaders {[(s, e.identity) for s, e in leaders.items()]}")
+    assert set(leaders) == {0, 1}
+
+    def failover(elector: Elector, crash: bool) -> float:
+        elector_stop = next(s for e, s in replicas if e is elector)
+        if crash:
+            # stop renewing without releasing the Lease
+            elector.locks[elector.shard or 0].release = lambda: None  # type: ignore
+        start = time.monotonic()
+        elector_stop.set()
+        while not any(
+            e.shard == elector.shard and e is not elector and e.acquired.is_set()
+            for e, _ in replicas
+        ):
+            time.sleep(0.01)
+        return time.monotonic() - start
+
+    print(f"failover after crash: {failover(leaders[0], True):.2f}s")
+    assert standby.shard == 0
+    # bring up another standby to take over from a clean shutdown
+    replica_stop = threading.Event()
+    elector = Elector(2, "replica-3", api=fake_api, duration=3)
+    elector.start(replica_stop)
+    replicas.append((elector, replica_stop))
+    time.sleep(0.5)
+    print(f"failover after shutdown: {failover(leaders[1], False):.2f}s")
@@ -0,0 +1,94 @@
+"""
+Controller metrics
+Prometheus metrics for the controller's hot path, served on
+`KONDUKTOR_CONTROLLER_METRICS_PORT` at `/metrics`. Loki request latency and
+errors are recorded by `konduktor.loki_client` in the same registry.
+"""
+
+import contextlib
+import os
+import time
+from typing import Iterator
+
+import prometheus_client
+
+from konduktor import logging as konduktor_logging
+
+METRICS_PORT = int(os.environ.get("KONDUKTOR_CONTROLLER_METRICS_PORT", 9090))
+
+STAGE_QUERY = "query"
+STAGE_PARSE = "parse"
+STAGE_CLASSIFY = "classify"
+STAGE_PATCH = "patch"
+
+STAGE_SECONDS = prometheus_client.Histogram(
+    "konduktor_controller_stage_seconds",
+    "Time spent in each stage of the controller",
+    ["stage"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30),
+)
+LINES = prometheus_client.Counter(
+    "konduktor_controller_lines_total",
+    "Log lines classified",
+    ["source"],
+)
+FAULTS = prometheus_client.Counter(
+    "konduktor_controller_faults_total",
+    "Faults detected, before deduplication and debouncing",
+    ["source", "code", "node"],
+)
+CORRELATED_JOBS = prometheus_client.Counter(
+    "konduktor_controller_correlated_jobs_total",
+    "Jobs whose pod faults were attributed, by how the culprits were picked",
+    ["verdict"],
+)
+REMEDIATIONS = prometheus_client.Counter(
+    "konduktor_controller_remediations_total",
+    "Node taints added or removed",
+    ["action", "result"],
+)
+QUEUE_SIZE = prometheus_client.Gauge(
+    "konduktor_controller_queue_size",
+    "Items waiting in the controller's queues",
+    ["queue"],
+)
+LOOP_LAG_SECONDS = prometheus_client.Gauge(
+    "konduktor_controller_loop_lag_seconds",
+    "How late the event loop ran a timer, a busy or blocked loop lags",
+)
+POLL_OVERRUN_SECONDS = prometheus_client.Gauge(
+    "konduktor_controller_poll_overrun_seconds",
+    "How much the last poll cycle exceeded the poll period",
+)
+LEADER = prometheus_client.Gauge(
+    "konduktor_controller_leader",
+    "1 while this replica leads `shard`",
+    ["shard"],
+)
+OWNED_NODES = prometheus_client.Gauge(
+    "konduktor_controller_owned_nodes",
+    "Nodes owned by this replica's shard",
+)
+HEALTH_CHECK_SECONDS = prometheus_client.Histogram(
+    "konduktor_controller_health_check_seconds",
+    "Duration of health check rounds",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1200, 3600),
+)
+
+logger = konduktor_logging.get_logger(__name__)
+
+
+@contextlib.contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Records the time spent in the block under `stage`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def start(port: int = METRICS_PORT):
+    """Serves `/metrics` from a background thread"""
+    prometheus_client.start_http_server(port)
+    logger.info(f"serving metrics on :{port}/metrics")
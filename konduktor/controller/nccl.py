@@ -0,0 +1,316 @@
+"""
+NCCL tests
+Runs nccl-tests `all_reduce_perf` on a set of nodes as a Kubernetes Job and
+reports the average bus bandwidth. A single node exercises NVLink, while
+multiple nodes exercise the inter-node network.
+
+Multi-node tests run as an Indexed Job with one pod per node behind a headless
+service. Every pod runs sshd and is only Ready once it accepts connections,
+and pod 0 waits for every pod to be reachable before launching `mpirun` over
+them. The image must therefore ship `sshd`, `mpirun` and the nccl-tests
+binaries, and accept passwordless ssh as root between pods: either with keys
+baked into the image, or from the Secret named by `NCCL_TEST_SSH_SECRET`,
+holding `id_rsa`, `id_rsa.pub` and `authorized_keys`, which is mounted at
+`/root/.ssh`. The result is read from pod 0, after which the Job and service
+are deleted.
+
+A test that never gets all of its pods Ready within
+`NCCL_TEST_SCHEDULE_TIMEOUT`, or whose launcher does not finish in time, has
+no result rather than a failing one. A launcher that failed without reporting
+the bandwidth, e.g. on an NCCL error or an Xid mid test, did run on the nodes
+and fails the test.
+https://github.com/NVIDIA/nccl-tests
+"""
+
+import os
+import re
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from konduktor import kube_client
+from konduktor import logging as konduktor_logging
+
+NCCL_TEST_NAMESPACE = os.environ.get("NCCL_TEST_NAMESPACE", "konduktor")
+NCCL_TEST_IMAGE = os.environ.get(
+    "NCCL_TEST_IMAGE", "ghcr.io/coreweave/nccl-tests:latest"
+)
+GPUS_PER_NODE = int(os.environ.get("NCCL_TEST_GPUS_PER_NODE", 8))
+# Secret with the ssh keys of multi-node tests, mounted at /root/.ssh if set
+NCCL_TEST_SSH_SECRET = os.environ.get("NCCL_TEST_SSH_SECRET")
+# seconds a test may take before it is abandoned
+NCCL_TEST_TIMEOUT = int(os.environ.get("NCCL_TEST_TIMEOUT", 600))
+# seconds the pods of a test may take to be scheduled and Ready
+NCCL_TEST_SCHEDULE_TIMEOUT = int(os.environ.get("NCCL_TEST_SCHEDULE_TIMEOUT", 300))
+POLL_SECONDS = 5
+ALL_REDUCE_ARGS = "-b 512M -e 8G -f 2"
+
+_BUSBW_PATTERN = re.compile(r"#\s*Avg bus bandwidth\s*:\s*([\d.]+)")
+
+logger = konduktor_logging.get_logger(__name__)
+
+
+def parse_busbw(output: str) -> Optional[float]:
+    """Average bus bandwidth in GB/s reported by nccl-tests
+
+    Args:
+        output (str): stdout of an nccl-tests binary
+
+    Returns:
+        Optional[float]: busbw, None if the test did not finish
+    """
+    match = _BUSBW_PATTERN.search(output)
+    if match is None:
+        return None
+    return float(match.group(1))
+
+
+def _command(name: str, num_nodes: int) -> str:
+    if num_nodes == 1:
+        return f"all_reduce_perf {ALL_REDUCE_ARGS} -g {GPUS_PER_NODE}"
+    hostnames = [f"{name}-{i}.{name}" for i in range(num_nodes)]
+    hosts = ",".join(f"{hostname}:{GPUS_PER_NODE}" for hostname in hostnames)
+    return (
+        "ssh-keygen -A && mkdir -p /run/sshd && /usr/sbin/sshd || exit 1; "
+        'if [ "$JOB_COMPLETION_INDEX" = "0" ]; then '
+        # every pod resolves and accepts connections once it is Ready
+        f"for host in {' '.join(hostnames)}; do "
+        'until (echo > "/dev/tcp/$host/22") 2>/dev/null; do sleep 2; done; '
+        "done; "
+        "mpirun --allow-run-as-root --bind-to none "
+        '--mca plm_rsh_args "-o StrictHostKeyChecking=no" '
+        f"-np {num_nodes * GPUS_PER_NODE} -H {hosts} "
+        f"all_reduce_perf {ALL_REDUCE_ARGS} -g 1; "
+        "else sleep infinity; fi"
+    )
+
+
+def _container(name: str, nodes: List[str]) -> Dict[str, Any]:
+    container: Dict[str, Any] = {
+        "name": "nccl-test",
+        "image": NCCL_TEST_IMAGE,
+        "command": ["/bin/bash", "-c"],
+        "args": [_command(name, len(nodes))],
+        "resources": {
+            "limits": {"nvidia.com/gpu": GPUS_PER_NODE},
+        },
+        "securityContext": {"capabilities": {"add": ["IPC_LOCK"]}},
+    }
+    if len(nodes) > 1:
+        container["readinessProbe"] = {
+            "tcpSocket": {"port": 22},
+            "periodSeconds": 2,
+        }
+        if NCCL_TEST_SSH_SECRET:
+            container["volumeMounts"] = [
+                {"name": "ssh", "mountPath": "/root/.ssh", "readOnly": True}
+            ]
+    return container
+
+
+def _job(name: str, nodes: List[str]) -> Dict[str, Any]:
+    labels = {"app": "konduktor-nccl-test", "konduktor-nccl-test": name}
+    return {
+        "apiVersion": "batch/v1",
+        "kind": "Job",
+        "metadata": {"name": name, "labels": labels},
+        "spec": {
+            "completionMode": "Indexed",
+            "completions": len(nodes),
+            "parallelism": len(nodes),
+            "backoffLimit": 0,
+            "activeDeadlineSeconds": NCCL_TEST_TIMEOUT,
+            "template": {
+                "metadata": {"labels": labels},
+                "spec": {
+                    "subdomain": name,
+                    "restartPolicy": "Never",
+                    # the nodes under test are usually tainted as faulty
+                    "tolerations": [{"operator": "Exists"}],
+                    "affinity": {
+                        "nodeAffinity": {
+                            "requiredDuringSchedulingIgnoredDuringExecution": {
+                                "nodeSelectorTerms": [
+                                    {
+                                        "matchFields": [
+                                            {
+                                                "key": "metadata.name",
+                                                "operator": "In",
+                                                "values": nodes,
+                                            }
+                                        ]
+                                    }
+                                ]
+                            }
+                        },
+                        # one pod per node
+                        "podAntiAffinity": {
+                            "requiredDuringSchedulingIgnoredDuringExecution": [
+                                {
+                                    "labelSelector": {"matchLabels": labels},
+                                    "topologyKey": "kubernetes.io/hostname",
+                                }
+                            ]
+                        },
+                    },
+                    "containers": [_container(name, nodes)],
+                    "volumes": (
+                        [
+                            {
+                                "name": "ssh",
+                                "secret": {
+                                    "secretName": NCCL_TEST_SSH_SECRET,
+                                    # ssh refuses keys readable by others
+                                    "defaultMode": 0o600,
+                                },
+                            }
+                        ]
+                        if len(nodes) > 1 and NCCL_TEST_SSH_SECRET
+                        else []
+                    ),
+                },
+            },
+        },
+    }
+
+
+def _service(name: str) -> Dict[str, Any]:
+    return {
+        "apiVersion": "v1",
+        "kind": "Service",
+        "metadata": {"name": name},
+        "spec": {
+            "clusterIP": "None",
+            "selector": {"konduktor-nccl-test": name},
+        },
+    }
+
+
+def _ready(pod) -> bool:
+    """Whether a test pod is Ready, or already done"""
+    if pod.status.phase in ("Succeeded", "Failed"):
+        return True
+    return any(
+        condition.type == "Ready" and condition.status == "True"
+        for condition in pod.status.conditions or []
+    )
+
+
+def _wait_for_pods(name: str, num_nodes: int) -> bool:
+    """Waits for every pod of the test Job to be scheduled and Ready
+
+    Returns:
+        bool: False if they were not Ready within `NCCL_TEST_SCHEDULE_TIMEOUT`
+    """
+    core_api = kube_client.core_api()
+    deadline = time.monotonic() + NCCL_TEST_SCHEDULE_TIMEOUT
+    while time.monotonic() < deadline:
+        pods = core_api.list_namespaced_pod(
+            NCCL_TEST_NAMESPACE,
+            label_selector=f"konduktor-nccl-test={name}",
+            _request_timeout=kube_client.API_TIMEOUT,
+        )
+        if sum(_ready(pod) for pod in pods.items) >= num_nodes:
+            return True
+        time.sleep(POLL_SECONDS)
+    return False
+
+
+def _wait_for_launcher(name: str) -> Optional[Any]:
+    """Waits for pod 0 of the test Job to finish
+
+    Returns:
+        Optional[V1Pod]: pod 0, None if it did not finish in time
+    """
+    core_api = kube_client.core_api()
+    selector = f"konduktor-nccl-test={name},batch.kubernetes.io/job-completion-index=0"
+    deadline = time.monotonic() + NCCL_TEST_TIMEOUT
+    while time.monotonic() < deadline:
+        pods = core_api.list_namespaced_pod(
+            NCCL_TEST_NAMESPACE,
+            label_selector=selector,
+            _request_timeout=kube_client.API_TIMEOUT,
+        )
+        for pod in pods.items:
+            if pod.status.phase in ("Succeeded", "Failed"):
+                return pod
+        time.sleep(POLL_SECONDS)
+    return None
+
+
+def run_test(nodes: List[str]) -> Optional[float]:
+    """Runs `all_reduce_perf` across `nodes`
+
+    Args:
+        nodes (List[str]): k8s node names
+
+    Returns:
+        Optional[float]: busbw in GB/s, 0 if the test failed before reporting
+            it, None if the test did not run, e.g. because its pods were not
+            scheduled or it timed out
+    """
+    core_api = kube_client.core_api()
+    batch_api = kube_client.batch_api()
+    name = f"konduktor-nccl-{uuid.uuid4().hex[:8]}"
+    logger.info(f"running nccl test {name} on {nodes}")
+    try:
+        if len(nodes) > 1:
+            core_api.create_namespaced_service(
+                NCCL_TEST_NAMESPACE,
+                _service(name),
+                _request_timeout=kube_client.API_TIMEOUT,
+            )
+        batch_api.create_namespaced_job(
+            NCCL_TEST_NAMESPACE,
+            _job(name, nodes),
+            _request_timeout=kube_client.API_TIMEOUT,
+        )
+        if not _wait_for_pods(name, len(nodes)):
+            logger.warning(
+                f"pods of nccl test {name} were not ready within "
+                f"{NCCL_TEST_SCHEDULE_TIMEOUT}s"
+            )
+            return None
+        launcher = _wait_for_launcher(name)
+        if launcher is None:
+            logger.warning(f"nccl test {name} timed out")
+            return None
+        output = core_api.read_namespaced_pod_log(
+            launcher.metadata.name,
+            NCCL_TEST_NAMESPACE,
+            _request_timeout=kube_client.API_TIMEOUT,
+        )
+        busbw = parse_busbw(output)
+        if busbw is None and launcher.status.phase == "Failed":
+            logger.warning(f"nccl test {name} on {nodes} failed: {output[-1000:]}")
+            return 0.0
+        logger.info(f"nccl test {name} on {nodes}: busbw {busbw} GB/s")
+        return busbw
+    finally:
+        _delete(name, len(nodes) > 1)
+
+
+def _delete(name: str, service: bool):
+    """Deletes the Job of a test and its service, whichever were created"""
+    deletes = [
+        lambda: kube_client.batch_api().delete_namespaced_job(
+            name,
+            NCCL_TEST_NAMESPACE,
+            propagation_policy="Background",
+            _request_timeout=kube_client.API_TIMEOUT,
+        )
+    ]
+    if service:
+        deletes.append(
+            lambda: kube_client.core_api().delete_namespaced_service(
+                name,
+                NCCL_TEST_NAMESPACE,
+                _request_timeout=kube_client.API_TIMEOUT,
+            )
+        )
+    for delete in deletes:
+        try:
+            delete()
+        except kube_client.api_exception() as e:
+            if e.status != 404:
+                logger.error(f"failed to clean up nccl test {name}: {e}")
@@ -1,17 +1,18 @@
-from typing import List
-
-import kubernetes
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
 from konduktor import kube_client
 from konduktor import logging as konduktor_logging
+from konduktor.controller import health, informer, metrics, nccl
 
 # node taint/label
 NODE_HEALTH_LABEL = "trainy.konduktor.ai/faulty"
+# attempts to patch a node's taints on resourceVersion conflicts
+PATCH_RETRIES = 3
 
 logger = konduktor_logging.get_logger(__name__)
 
 
-def nccl_single_test(node: str, thresh: int = 400):
+def nccl_single_test(node: str, thresh: int = 400) -> Optional[bool]:
     """Runs NCCL test within a node. Tests NVLINK BW
 
     Args:
@@ -19,10 +20,15 @@ def nccl_single_test(node: str, thresh: int = 400):
         thresh (int, optional): minimum busbw to be considered healthy
         H100SXM should report 450GB/s max theoretically. Default 400
 
+    Returns:
+        Optional[bool]: True if the node is healthy, None if the test did
+            not run
     """
+    busbw = nccl.run_test([node])
+    return None if busbw is None else busbw >= thresh
 
 
-def nccl_pair_test(nodeA: str, nodeB: str, thresh: int = 350):
+def nccl_pair_test(nodeA: str, nodeB: str, thresh: int = 350) -> Optional[bool]:
     """Runs NCCL test between a pair of nodes. Tests
     internode bandwidth
 
@@ -32,78 +38,213 @@ def nccl_pair_test(nodeA: str, nodeB: str, thresh: int = 350):
         thresh (int, optional): minimum busbw to be considered healthy
         ConnectX-7 cards have a theoretical max BW of 400GB/s
         Defaults to 350GB/s.
+
+    Returns:
+        Optional[bool]: True if the link between the nodes is healthy, None
+            if the test did not run
     """
-    pass
+    busbw = nccl.run_test([nodeA, nodeB])
+    return None if busbw is None else busbw >= thresh
 
 
-def health_check():
+def _gpu_nodes() -> Tuple[List[str], List[str]]:
+    """Returns:
+    Tuple[List[str], List[str]]: GPU nodes with and without the faulty taint
+    """
+    node_informer = informer.get()
+    if node_informer is not None:
+        gpu_nodes = node_informer.gpu_nodes()
+        tainted = set(node_informer.tainted_nodes(NODE_HEALTH_LABEL))
+    else:
+        nodes = kube_client.core_api().list_node(
+            _request_timeout=kube_client.API_TIMEOUT
+        )
+        gpu_nodes = [
+            node.metadata.name for node in nodes.items if informer.gpu_count(node)
+        ]
+        tainted = {
+            node.metadata.name
+            for node in nodes.items
+            if any(taint.key == NODE_HEALTH_LABEL for taint in node.spec.taints or [])
+        }
+    return (
+        [node for node in gpu_nodes if node in tainted],
+        [node for node in gpu_nodes if node not in tainted],
+    )
+
+
+def node_pools() -> Dict[str, str]:
+    """Pool of every node, from the informer cache if possible"""
+    node_informer = informer.get()
+    if node_informer is not None:
+        return node_informer.pools()
+    nodes = kube_client.core_api().list_node(_request_timeout=kube_client.API_TIMEOUT)
+    return {node.metadata.name: informer.node_pool(node) for node in nodes.items}
+
+
+def health_check(
+    owns: Optional[Callable[[str], bool]] = None,
+) -> Dict[str, Optional[bool]]:
     """Gathers nodes with label/taint `trainy.konduktor.ai/faulty=true:NoSchedule`
     and attempts to run NCCL test on them. Nodes that pass
     have their label/taint removed.
+
+    Args:
+        owns (Optional[Callable[[str], bool]], optional): only test the
+            tainted nodes this returns True for, e.g. those of a shard
+
+    Returns:
+        Dict[str, Optional[bool]]: whether each tested node passed and was
+            untainted, None if its tests were inconclusive
     """
-    pass
+    suspects, healthy = _gpu_nodes()
+    if owns is not None:
+        suspects = [node for node in suspects if owns(node)]
+    if not suspects:
+        return {}
+    logger.info(f"running health checks on {len(suspects)} tainted nodes")
+    results = health.check(suspects, healthy, nccl_single_test, nccl_pair_test)
+    for node_name, passed in results.items():
+        if passed:
+            untaint(node_name)
+    return results
 
 
-def untaint(node_name: str):
-    """Removes label/taint of `trainy.konduktor.ai/faulty=true:NoSchedule`
+def check_nodes(
+    nodes: List[str], faulty: Sequence[str] = ()
+) -> Dict[str, Optional[bool]]:
+    """Runs NCCL tests on untainted `nodes`, e.g. the suspects of a job
+    failure, without changing their taints
 
     Args:
-        node (str): k8s node name
+        nodes (List[str]): k8s node names
+        faulty (Sequence[str], optional): untainted nodes that are about to
+            be tainted, which must not be used as known-good partners
+
+    Returns:
+        Dict[str, Optional[bool]]: whether each node passed, None if its
+            tests were inconclusive
     """
-    core_api = kube_client.core_api()
-    node = core_api.read_node(
-        name=node_name,
-        _request_timeout=kube_client.API_TIMEOUT,
-    )
+    _, healthy = _gpu_nodes()
+    excluded = set(nodes).union(faulty)
+    anchors = [node for node in healthy if node not in excluded]
+    logger.info(f"running targeted health checks on {len(nodes)} nodes")
+    return health.check(nodes, anchors, nccl_single_test, nccl_pair_test)
 
-    if node.spec.taints is not None:
-        node.spec.taints = [
-            taint for taint in node.spec.taints if taint.key != NODE_HEALTH_LABEL
-        ]
 
-    # Patch the node with the new taints
-    core_api.patch_node(
+def _read_taints(node_name: str) -> Tuple[str, informer.Taints]:
+    node = kube_client.core_api().read_node(
         name=node_name,
-        body=node,
         _request_timeout=kube_client.API_TIMEOUT,
     )
+    return node.metadata.resource_version, informer.serialize_taints(node)
 
-    logger.info(f"Node {node_name} taint removed.")
 
+def _node_taints(node_name: str) -> Tuple[str, informer.Taints]:
+    """resourceVersion and taints of a node, from the informer cache if possible"""
+    node_informer = informer.get()
+    cached = node_informer.get(node_name) if node_informer else None
+    if cached is not None:
+        return cached
+    return _read_taints(node_name)
 
-def taint(node_name: str):
-    """Labels/Taints node with `trainy.konduktor.ai/faulty=true:NoSchedule`
+
+def _patch_taints(
+    node_name: str,
+    update: Callable[[informer.Taints], informer.Taints],
+) -> bool:
+    """Patches only the taints of a node, guarded by its resourceVersion
+    so concurrent updates from other controllers are not lost.
 
     Args:
-        node (str): k8s node name
+        node_name (str): k8s node name
+        update (Callable): returns the new taints given the current ones
+
+    Returns:
+        bool: False if the taints were already up to date
     """
     core_api = kube_client.core_api()
-    taint = kubernetes.client.V1Taint(
-        key=NODE_HEALTH_LABEL,
-        value="true",
-        effect="NoSchedule",
-    )
-    node = core_api.read_node(
-        name=node_name,
-        _request_timeout=kube_client.API_TIMEOUT,
-    )
+    resource_version, taints = _node_taints(node_name)
+    for attempt in range(PATCH_RETRIES):
+        new_taints = update(taints)
+        if new_taints == taints:
+            return False
+        body = {
+            "metadata": {"resourceVersion": resource_version},
+            "spec": {"taints": new_taints},
+        }
+        try:
+            with metrics.timed(metrics.STAGE_PATCH):
+                node = core_api.patch_node(
+                    name=node_name,
+                    body=body,
+                    _request_timeout=kube_client.API_TIMEOUT,
+                )
+        except kube_client.api_exception() as e:
+            if e.status != 409 or attempt == PATCH_RETRIES - 1:
+                raise
+            logger.debug(f"conflict patching node {node_name}, retrying")
+            resource_version, taints = _read_taints(node_name)
+            continue
+        node_informer = informer.get()
+        if node_informer is not None:
+            node_informer.update(node)
+        return True
+    return False
 
-    if node.spec.taints is None:
-        node.spec.taints = []
 
-    # duplicate taints are disallowed
-    tainted = any(taint.key == NODE_HEALTH_LABEL for taint in node.spec.taints)
-    if not tainted:
-        node.spec.taints.append(taint)
+def _patch(
+    node_name: str,
+    action: str,
+    update: Callable[[informer.Taints], informer.Taints],
+) -> bool:
+    """`_patch_taints`, counting the outcome under `action`"""
+    try:
+        patched = _patch_taints(node_name, update)
+    except Exception:
+        metrics.REMEDIATIONS.labels(action, "error").inc()
+        raise
+    metrics.REMEDIATIONS.labels(action, "patched" if patched else "noop").inc()
+    return patched
 
-    # Patch the node with the new taints
-    core_api.patch_node(
-        name=node_name,
-        body=node,
-        _request_timeout=kube_client.API_TIMEOUT,
-    )
 
-    logger.info(f"Node {node_name} tainted.")
+def untaint(node_name: str):
+    """Removes label/taint of `trainy.konduktor.ai/faulty=true:NoSchedule`
+
+    Args:
+        node (str): k8s node name
+    """
+
+    def remove(taints: informer.Taints) -> informer.Taints:
+        return [taint for taint in taints if taint["key"] != NODE_HEALTH_LABEL]
+
+    if _patch(node_name, "untaint", remove):
+        logger.info(f"Node {node_name} taint removed.")
+
+
+def taint(node_name: str) -> bool:
+    """Labels/Taints node with `trainy.konduktor.ai/faulty=true:NoSchedule`
+
+    Args:
+        node (str): k8s node name
+
+    Returns:
+        bool: False if the node was already tainted
+    """
+
+    def add(taints: informer.Taints) -> informer.Taints:
+        # duplicate taints are disallowed
+        if any(taint["key"] == NODE_HEALTH_LABEL for taint in taints):
+            return taints
+        return taints + [
+            {"key": NODE_HEALTH_LABEL, "value": "true", "effect": "NoSchedule"}
+        ]
+
+    if _patch(node_name, "taint", add):
+        logger.info(f"Node {node_name} tainted.")
+        return True
+    logger.debug(f"Node {node_name} already tainted.")
+    return False
 
 
 def list_nodes() -> List[str]:
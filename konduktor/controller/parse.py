@@ -1,11 +1,11 @@
 import os
 import re
-from typing import Any, Dict, List, Set
-
-import requests
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set
 
 from konduktor import logging as konduktor_logging
-from konduktor.controller import constants
+from konduktor import loki_client
+from konduktor.controller import constants, correlate, faults, xid
 
 # comma separated list of namespaces to watch for pod errors
 WATCHED_NAMESPACES: List[str] = os.environ.get("WATCHED_NAMESPACES", "default").split(
@@ -21,91 +21,236 @@ LOG_ENDPOINT: str = os.environ.get(
     "http://loki.loki.svc.cluster.local:3100",
 )
 QUERY_URL: str = "/loki/api/v1/query_range"
+# stream labels returned with pod errors, those of the pod and its job
+POD_LABELS: List[str] = [
+    "k8s_namespace_name",
+    "k8s_node_name",
+    "k8s_pod_name",
+    *correlate.JOB_STREAM_LABELS,
+]
+# stream labels returned with dmesg errors, the node and the parsed (S)Xid
+DMESG_LABELS: List[str] = ["k8s_node_name", *xid.LABELS]
 
 logger = konduktor_logging.get_logger(__name__)
 
 
-def _query_range(pattern: str, **label_filters) -> List[Dict[str, Any]]:
-    """Send LogQL query_range to loki
-    https://grafana.com/docs/loki/latest/reference/loki-http-api/#query-logs-within-a-range-of-time
+def _build_query(pattern: str, stages: Sequence[str] = (), **label_filters) -> str:
+    """Builds a LogQL stream selector with a line filter
 
     Args:
         pattern (str): regex pattern to match loglines against
+        stages (Sequence[str], optional): pipeline expressions after the line
+            filter, e.g. more line filters, `| regexp` parsers and `| keep`
+        label_filters: label values to select. A list of values is merged
+            into a single regex matcher, `key=~"a|b|c"`
 
     Returns:
-        List[Dict[str, Any]]: List of loglines
+        str: LogQL query
     """
-    url = f"{LOG_ENDPOINT}{QUERY_URL}"
     formatted_filters = ", ".join(
-        f'{key}="{value}"' for key, value in label_filters.items()
+        f'{key}=~"{"|".join(value)}"' if isinstance(value, list) else f'{key}="{value}"'
+        for key, value in label_filters.items()
     )
-    query = r"{" f"{formatted_filters}" r"}" f"|~ {pattern}"
-    params = {"query": query, "since": f"{LOGS_SINCE}s"}
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        data = response.json()
-        return data["data"]["result"]
-    elif response.status_code == 400:
-        logger.error(f"Bad Request: {response.status_code}")
-        logger.error(response.json())  # Optionally print the error details
-    else:
-        logger.error(f"loki query failed {params}")
-    return []
+    pipeline = "".join(f" {stage}" for stage in stages)
+    return r"{" f"{formatted_filters}" r"}" f" |~ {pattern}{pipeline}"
 
 
-def pod_errors() -> Set[str]:
-    logger.info("querying pod logs")
+def _query_range(query: str) -> Iterator[loki_client.Entry]:
+    """Send LogQL query_range to loki for the past `LOGS_SINCE` seconds
+
+    Args:
+        query (str): LogQL query
+
+    Yields:
+        loki_client.Entry: (labels, ts, line) of each log line
+    """
+    return loki_client.query_range(
+        f"{LOG_ENDPOINT}{QUERY_URL}", query, time.time_ns() - LOGS_SINCE * 10**9
+    )
+
+
+def _unquote(regex: str) -> str:
+    """Strips the LogQL raw string backticks from a regex"""
+    return regex[1:-1] if regex.startswith("`") and regex.endswith("`") else regex
+
+
+_LEADING_FLAGS = re.compile(r"^\(\?([a-zA-Z]+)\)")
+
+
+def _alternation(regexes: List[str]) -> str:
+    """Merges LogQL regexes into a single one matching any of them. Leading
+    flags such as `(?i)` are scoped to their own alternative.
+
+    Returns:
+        str: the regex as a LogQL raw string
+    """
+    groups = []
+    for regex in map(_unquote, regexes):
+        flags = _LEADING_FLAGS.match(regex)
+        if flags:
+            groups.append(f"(?{flags.group(1)}:{regex[flags.end() :]})")
+        else:
+            groups.append(f"(?:{regex})")
+    return f"`{'|'.join(groups)}`"
+
+
+def _keep(labels: List[str]) -> str:
+    """`| keep` stage dropping every stream label but `labels`, so Loki splits
+    and labels the returned streams by those only
+    """
+    return f"| keep {', '.join(labels)}"
+
+
+# client side copies of the pod regexes to attribute merged query results
+_POD_LOG_ERROR_PATTERNS = [
+    (regex, re.compile(_unquote(regex))) for regex in constants.POD_LOG_ERROR_REGEXES
+]
+
+
+def _node_filter(nodes: Optional[List[str]]) -> Dict[str, List[str]]:
+    """Label filter selecting the logs of `nodes`, all nodes if None"""
+    if nodes is None:
+        return {}
+    # dots in node names are escaped in the regex, and again in the LogQL string
+    return {"k8s_node_name": [node.replace(".", "\\\\.") for node in nodes]}
+
+
+def pod_query(nodes: Optional[List[str]] = None) -> str:
+    """Single LogQL query matching every pod log error regex
+    in every watched namespace
+
+    Args:
+        nodes (Optional[List[str]], optional): only query pods on these nodes
+    """
+    return _build_query(
+        _alternation(constants.POD_LOG_ERROR_REGEXES),
+        [_keep(POD_LABELS)],
+        k8s_namespace_name=WATCHED_NAMESPACES,
+        **_node_filter(nodes),
+    )
+
+
+def pod_error_regex(log_content: str) -> Optional[str]:
+    """Returns the first of `POD_LOG_ERROR_REGEXES` matching the line, if any"""
+    for regex, pattern in _POD_LOG_ERROR_PATTERNS:
+        if pattern.search(log_content):
+            return regex
+    return None
+
+
+def pod_error(
+    stream: Dict[str, str], ts: int, log_content: str
+) -> Optional[faults.Fault]:
+    """Classifies a pod log line returned by the `pod_query` query
+
+    Args:
+        stream (Dict[str, str]): loki stream labels of the line
+        ts (int): log timestamp in nanoseconds
+        log_content (str): the log line
+
+    Returns:
+        Optional[faults.Fault]: the fault, None if the line is not an error
+    """
+    regex = pod_error_regex(log_content)
+    log_node = stream.get("k8s_node_name")
+    if regex is None or not log_node:
+        return None
+    logger.info(f"pod error on node `{log_node}` matched {regex}: {log_content}")
+    return faults.Fault(log_node, faults.SOURCE_POD, regex, ts, log_content, stream)
+
+
+def _pod_errors(entries: Iterable[loki_client.Entry]) -> Set[str]:
     bad_nodes = set()
-    for regex in constants.POD_LOG_ERROR_REGEXES:
-        for namespace in WATCHED_NAMESPACES:
-            log_lines = _query_range(regex, k8s_namespace_name=namespace)
-            for line in log_lines:
-                log_node = line["stream"]["k8s_node_name"]
-                bad_nodes.add(log_node)
+    for stream, ts, log_content in entries:
+        fault = pod_error(stream, ts, log_content)
+        if fault:
+            bad_nodes.add(fault.node)
     return bad_nodes
 
 
-def sxid_error(pattern: str, log_content: str) -> int:
-    """Regex pattern match for an xid error, from `log_content` otherwise return 0
-    Example Xid error from dmesg
-    [1235733.431527] NVRM: Xid (PCI:0000:4e:00): 79, pid='<unknown>', name=<unknown>, GPU has fallen off the bus.
-    Example sxid error from dmesg
-    [1235733.431527] nvidia-nvswitch3: SXid (PCI:0000:4e:00.0): 12028, Non-fatal, Link 32 egress non-posted PRIV error (First)
-    """  # noqa: E501
-
-    match = re.search(pattern, log_content)
-    if match:
-        return int(match.group(1))
+def pod_errors() -> Set[str]:
+    logger.info("querying pod logs")
+    return _pod_errors(_query_range(pod_query()))
 
-    return 0
 
+def dmesg_query(nodes: Optional[List[str]] = None) -> str:
+    """LogQL query matching GPU errors in the dmesg logs
 
-def is_sxid_error(log_content: str) -> bool:
-    """Returns (S)Xid error code, zero otherwise"""
-    error_code = sxid_error(r"SXid.*?: (\d+),", log_content) or sxid_error(
-        r"NVRM: Xid.*?: (\d+),", log_content
+    Args:
+        nodes (Optional[List[str]], optional): only query these nodes
+    """
+    return _build_query(
+        _alternation(constants.DMESG_ERROR_REGEXES),
+        [
+            f"!~ `{xid.BENIGN_LOGQL_PATTERN}`",
+            f"| regexp `{xid.LOGQL_PATTERN}`",
+            _keep(DMESG_LABELS),
+        ],
+        k8s_daemonset_name="dmesg",
+        **_node_filter(nodes),
     )
-    return error_code not in constants.ALLOWLISTED_NVSWITCH_SXID_ERRORS
 
 
-def dmesg_errors() -> Set[str]:
-    logger.info("checking dmesg logs")
-    pattern = " or ".join(constants.DMESG_ERROR_REGEXES)
-    log_lines = _query_range(pattern, k8s_daemonset_name="dmesg")
+def dmesg_error(
+    stream: Dict[str, str], ts: int, log_content: str
+) -> Optional[faults.Fault]:
+    """Classifies a dmesg log line returned by the `dmesg_query` query
+
+    Args:
+        stream (Dict[str, str]): loki stream labels of the line
+        ts (int): log timestamp in nanoseconds
+        log_content (str): the log line
+
+    Returns:
+        Optional[faults.Fault]: the fault, None if the line is not an error
+    """
+    log_node = stream.get("k8s_node_name")
+    if not log_node:
+        return None
+    # parsed by loki, unless the line came from elsewhere, e.g. a replay
+    error = xid.from_labels(stream) or xid.classify(log_content)
+    if error is None:
+        logger.info(f"dmesg error on node `{log_node}`: {log_content}")
+        code = faults.SOURCE_DMESG
+    elif not error.remediate:
+        logger.debug(f"ignoring allowlisted {error} on node `{log_node}`")
+        return None
+    else:
+        logger.info(f"node `{log_node}` has {error}: {log_content}")
+        code = f"{error.kind}{error.code}"
+    return faults.Fault(log_node, faults.SOURCE_DMESG, code, ts, log_content)
+
+
+def _dmesg_errors(entries: Iterable[loki_client.Entry]) -> Set[str]:
     bad_nodes = set()
-    for line in log_lines:
-        log_node, log_content = line["stream"]["k8s_node_name"], line["values"][0][1]
-        if is_sxid_error(log_content):
-            logger.info(f"node `{log_node}` has (S)Xid error: {log_content}")
-        else:
-            logger.info(f"dmesg error on node `{log_node}`: {log_content}")
-        bad_nodes.add(log_node)
+    for stream, ts, log_content in entries:
+        fault = dmesg_error(stream, ts, log_content)
+        if fault:
+            bad_nodes.add(fault.node)
     return bad_nodes
 
 
-if __name__ == "__main__":
-    import time
+def dmesg_errors() -> Set[str]:
+    logger.info("checking dmesg logs")
+    return _dmesg_errors(_query_range(dmesg_query()))
 
+
+def errors() -> Set[str]:
+    """Queries pod and dmesg logs concurrently
+
+    Returns:
+        Set[str]: nodes with pod or dmesg errors
+    """
+    logger.info("querying pod and dmesg logs")
+    pod_entries, dmesg_entries = loki_client.query_range_many(
+        f"{LOG_ENDPOINT}{QUERY_URL}",
+        [pod_query(), dmesg_query()],
+        time.time_ns() - LOGS_SINCE * 10**9,
+    )
+    return _pod_errors(pod_entries or []) | _dmesg_errors(dmesg_entries or [])
+
+
+if __name__ == "__main__":
     while True:
         time.sleep(5)
         print(dmesg_errors())
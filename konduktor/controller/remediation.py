@@ -0,0 +1,311 @@
+"""
+Remediation executor
+Taints faulty nodes concurrently while bounding the damage a burst of faults
+can do. A fabric-wide NVSwitch or NCCL event can flag many nodes at once, and
+a misclassified log line can flag healthy ones, so taints
+
+- run up to `REMEDIATION_CONCURRENCY` at a time,
+- are paced by a token bucket of `REMEDIATION_RATE` taints per second with
+  bursts of up to `REMEDIATION_BURST`, which bounds API server load, and
+- are blocked once `REMEDIATION_MAX_POOL_FRACTION` of a node pool was tainted
+  within `REMEDIATION_WINDOW_SECONDS`, which protects capacity. At least one
+  node per pool may always be tainted.
+
+With sharding, every shard's replica only sees its own taints, so each gets
+an equal share of a pool's allowance, but still at least one node. The taints
+counted are persisted with the rest of the controller state, so a restarted
+or failed over replica does not start from a full allowance.
+
+In dry-run mode nodes are not patched, but everything else, including the
+blast radius guard, behaves as if they were. Every action is written to the
+audit log, `konduktor.controller.audit`, as a JSON line, and appended to
+`REMEDIATION_AUDIT_FILE` if set.
+"""
+
+import asyncio
+import collections
+import json
+import os
+import time
+from typing import Callable, Deque, Dict, List, Optional
+
+from konduktor import logging as konduktor_logging
+from konduktor.controller import metrics
+from konduktor.controller import node as node_control
+
+# max taints in flight
+REMEDIATION_CONCURRENCY = int(os.environ.get("KONDUKTOR_REMEDIATION_CONCURRENCY", 8))
+# taints per second, and how many may be made at once after being idle
+REMEDIATION_RATE = float(os.environ.get("KONDUKTOR_REMEDIATION_RATE", 2))
+REMEDIATION_BURST = int(os.environ.get("KONDUKTOR_REMEDIATION_BURST", 10))
+# max fraction of a node pool tainted within the window
+REMEDIATION_MAX_POOL_FRACTION = float(
+    os.environ.get("KONDUKTOR_REMEDIATION_MAX_POOL_FRACTION", 0.2)
+)
+REMEDIATION_WINDOW_SECONDS = int(
+    os.environ.get("KONDUKTOR_REMEDIATION_WINDOW_SECONDS", 3600)
+)
+# log what would be tainted without patching nodes
+REMEDIATION_DRY_RUN = (
+    os.environ.get("KONDUKTOR_REMEDIATION_DRY_RUN", "false").lower() == "true"
+)
+# file the audit log is appended to, only logged if empty
+REMEDIATION_AUDIT_FILE = os.environ.get("KONDUKTOR_REMEDIATION_AUDIT_FILE", "")
+
+# results of a remediation, also the `result` label of `metrics.REMEDIATIONS`
+RESULT_PATCHED = "patched"
+RESULT_NOOP = "noop"
+RESULT_ERROR = "error"
+RESULT_BLOCKED = "blocked"
+RESULT_DRY_RUN = "dry_run"
+
+logger = konduktor_logging.get_logger(__name__)
+audit_logger = konduktor_logging.get_logger("konduktor.controller.audit")
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second, and up to `burst` at once
+
+    Only safe to use from a single event loop.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Waits for a token"""
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BlastRadiusGuard:
+    """Caps the fraction of each node pool tainted within a window
+
+    Args:
+        max_fraction (float): max fraction of a pool tainted within `window`
+        window (float): seconds taints are counted for
+        shards (int, optional): shards tainting nodes of the same pools
+            independently, each is allowed an equal share
+    """
+
+    def __init__(self, max_fraction: float, window: float, shards: int = 1):
+        self.max_fraction = max_fraction
+        self.window = window
+        self.shards = shards
+        # pool -> wall clock times nodes in it were tainted, oldest first
+        self._taints: Dict[str, Deque[float]] = collections.defaultdict(
+            collections.deque
+        )
+
+    def limit(self, pool_size: int) -> int:
+        """Max taints within the window in a pool of `pool_size` nodes"""
+        return max(1, int(self.max_fraction * pool_size / self.shards))
+
+    def reserve(self, pool: str, pool_size: int) -> bool:
+        """Counts a taint in `pool` if it is within the limit
+
+        Returns:
+            bool: False if the taint would exceed the limit
+        """
+        now = time.time()
+        taints = self._taints[pool]
+        while taints and taints[0] < now - self.window:
+            taints.popleft()
+        if len(taints) >= self.limit(pool_size):
+            return False
+        taints.append(now)
+        return True
+
+    def release(self, pool: str):
+        """Uncounts the last reserved taint in `pool`, e.g. if it failed"""
+        if self._taints[pool]:
+            self._taints[pool].pop()
+
+    def dump(self) -> Dict[str, List[float]]:
+        """Times of the taints within the window as JSON, see `restore`"""
+        since = time.time() - self.window
+        return {
+            pool: [ts for ts in taints if ts >= since]
+            for pool, taints in self._taints.items()
+            if taints and taints[-1] >= since
+        }
+
+    def restore(self, dumped: Dict[str, List[float]]):
+        """Counts the taints of `dump` that are still within the window"""
+        since = time.time() - self.window
+        for pool, taints in dumped.items():
+            self._taints[pool] = collections.deque(
+                sorted(ts for ts in taints if ts >= since)
+            )
+
+
+class AuditLog:
+    """JSON lines record of every remediation action
+
+    Args:
+        path (str, optional): file the records are appended to, only logged
+            if empty
+    """
+
+    def __init__(self, path: str = REMEDIATION_AUDIT_FILE):
+        self.path = path
+
+    def record(self, action: str, node: str, pool: str, result: str, **details):
+        entry = json.dumps(
+            {
+                "ts": time.time(),
+                "action": action,
+                "node": node,
+                "pool": pool,
+                "result": result,
+                **details,
+            }
+        )
+        audit_logger.info(entry)
+        if not self.path:
+            return
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(entry + "\n")
+        except OSError as e:
+            logger.error(f"failed to write audit log {self.path}: {e}")
+
+
+class RemediationExecutor:
+    """Taints nodes concurrently within the rate and blast radius limits
+
+    Args:
+        taint (Optional[Callable[[str], bool]], optional): taints a node,
+            returns False if it was already tainted. Defaults to
+            `node_control.taint`.
+        pools (Optional[Callable[[], Dict[str, str]]], optional): returns the
+            pool of every node. Defaults to `node_control.node_pools`.
+        concurrency (int, optional): max taints in flight
+        rate (float, optional): taints per second
+        burst (int, optional): max taints at once after being idle
+        max_pool_fraction (float, optional): max fraction of a node pool
+            tainted within `window`
+        window (float, optional): seconds taints are counted for
+        shards (int, optional): shards the pools' allowance is split across,
+            see `BlastRadiusGuard`
+        dry_run (bool, optional): do not patch nodes
+        audit (Optional[AuditLog], optional): defaults to `AuditLog()`
+    """
+
+    def __init__(
+        self,
+        taint: Optional[Callable[[str], bool]] = None,
+        pools: Optional[Callable[[], Dict[str, str]]] = None,
+        concurrency: int = REMEDIATION_CONCURRENCY,
+        rate: float = REMEDIATION_RATE,
+        burst: int = REMEDIATION_BURST,
+        max_pool_fraction: float = REMEDIATION_MAX_POOL_FRACTION,
+        window: float = REMEDIATION_WINDOW_SECONDS,
+        shards: int = 1,
+        dry_run: bool = REMEDIATION_DRY_RUN,
+        audit: Optional[AuditLog] = None,
+    ):
+        self._taint = node_control.taint if taint is None else taint
+        self._pools = node_control.node_pools if pools is None else pools
+        self._slots = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate, burst)
+        self.guard = BlastRadiusGuard(max_pool_fraction, window, shards)
+        self.dry_run = dry_run
+        self.audit = AuditLog() if audit is None else audit
+        if dry_run:
+            logger.warning("remediation dry-run, nodes will not be tainted")
+
+    async def submit(self, node: str, reason: str = "") -> "asyncio.Task[str]":
+        """Waits for a free slot and starts tainting `node`
+
+        Args:
+            node (str): k8s node name
+            reason (str, optional): why the node is tainted, for the audit log
+
+        Returns:
+            asyncio.Task[str]: resolves to the result, one of `RESULT_*`
+        """
+        await self._slots.acquire()
+        task = asyncio.create_task(self._run(node, reason))
+        task.add_done_callback(lambda _: self._slots.release())
+        return task
+
+    async def _run(self, node: str, reason: str) -> str:
+        try:
+            pools = await asyncio.to_thread(self._pools)
+        except Exception as e:  # pylint: disable=broad-except
+            # the guard still applies to the unknown pool
+            logger.error(f"failed to get the pool of node {node}: {e}")
+            pools = {}
+        pool = pools.get(node, "unknown")
+        pool_size = sum(1 for other in pools.values() if other == pool)
+        if not self.guard.reserve(pool, pool_size):
+            logger.warning(
+                f"not tainting node {node}, {self.guard.limit(pool_size)} of "
+                f"{pool_size} nodes in pool {pool} were already tainted in the "
+                f"last {self.guard.window}s"
+            )
+            result = RESULT_BLOCKED
+        elif self.dry_run:
+            logger.info(f"dry-run: would taint node {node}")
+            result = RESULT_DRY_RUN
+        else:
+            await self.bucket.acquire()
+            try:
+                patched = await asyncio.to_thread(self._taint, node)
+                result = RESULT_PATCHED if patched else RESULT_NOOP
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"failed to taint node {node}: {e}")
+                result = RESULT_ERROR
+            if result != RESULT_PATCHED:
+                self.guard.release(pool)
+        if result in (RESULT_BLOCKED, RESULT_DRY_RUN):
+            # the others are counted by `node_control`
+            metrics.REMEDIATIONS.labels("taint", result).inc()
+        self.audit.record(
+            "taint", node, pool, result, reason=reason, dry_run=self.dry_run
+        )
+        return result
+
+
+if __name__ == "__main__":
+    # a fabric-wide event flags 200 of 1000 nodes across 4 pools
+    fake_pools = {f"node-{i}": f"pool-{i % 4}" for i in range(1000)}
+    tainted: List[str] = []
+
+    def fake_taint(node: str) -> bool:
+        time.sleep(0.05)
+        tainted.append(node)
+        return True
+
+    async def flood():
+        executor = RemediationExecutor(
+            fake_taint,
+            lambda: fake_pools,
+            rate=50,
+            burst=10,
+            max_pool_fraction=0.1,
+            audit=AuditLog(os.devnull),
+        )
+        start = time.perf_counter()
+        tasks = [await executor.submit(f"node-{i}", "NVSwitch") for i in range(200)]
+        results = collections.Counter(await asyncio.gather(*tasks))
+        elapsed = time.perf_counter() - start
+        print(f"{dict(results)} in {elapsed:.2f}s, {len(tainted)} nodes tainted")
+        assert results[RESULT_PATCHED] == 4 * executor.guard.limit(250)
+
+    logger.setLevel("ERROR")
+    audit_logger.setLevel("ERROR")
+    asyncio.run(flood())
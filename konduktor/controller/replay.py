@@ -0,0 +1,908 @@
+"""
+Offline replay
+Replays recorded logs through the whole detection to remediation path,
+`launch.Controller` ingesting from a fake Loki and tainting the nodes of a
+fake Kubernetes API, to measure how fast and how accurately faults are
+detected without a cluster:
+
+- lines/s of the classifiers over the lines the LogQL queries select,
+- detection latency, from the first fault line of a node being queryable to
+  the node being tainted,
+- precision and recall of the tainted nodes against the labelled faulty ones.
+
+Logs are either recorded Loki `query_range` responses (JSON), optionally with
+a top level `"faulty": [<node>, ...]` list labelling the faulty nodes, or raw
+dmesg or pod log files named after their node. Without logs, a synthetic
+cluster is replayed.
+
+Timestamps are shifted to the present and compressed by `--speed`. The log
+time windows of the debounce rules, the correlation lead and the evidence
+window are scaled down with them, wall clock windows such as the correlation
+window are not. The fake Loki only serves `query_range`, so `tail` mode runs
+on its polling fallback. It evaluates stream selectors, line filters and the
+`regexp` and `keep` stages, which set the labels of the streams it returns,
+and ignores any other pipeline stage such as `json` or `line_format`.
+Targeted and periodic NCCL tests fail on the labelled faulty nodes and pass
+on every other node.
+
+Thresholds make the replay exit non-zero, so it can gate CI:
+
+    python -m konduktor.controller.replay dmesg.json --speed 60 \
+        --min-lines-per-second 200000 --min-recall 1 --max-p99-latency 10
+"""
+
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import kubernetes
+import numpy as np
+import prometheus_client
+
+from konduktor import kube_client
+from konduktor import logging as konduktor_logging
+from konduktor.controller import correlate, faults, launch, nccl, parse
+from konduktor.controller import node as node_control
+
+# replay speed, log seconds per wall clock second
+REPLAY_SPEED = 60.0
+# seconds to keep running after the last line, on top of the correlation window
+SETTLE_SECONDS = 5
+# default `limit` of Loki queries
+LOKI_DEFAULT_LIMIT = 100
+# busbw the fake NCCL tests report for healthy nodes, above the thresholds
+HEALTHY_BUSBW = 450.0
+
+logger = konduktor_logging.get_logger(__name__)
+
+# log timestamp in nanoseconds, stream labels, log line
+Entry = Tuple[int, Dict[str, str], str]
+
+_UPTIME = re.compile(r"^\[\s*(\d+(?:\.\d+)?)\]")
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_NS = {"ms": 10**6, "s": 10**9, "m": 60 * 10**9, "h": 3600 * 10**9}
+_SELECTOR = re.compile(r"^\s*\{(?P<matchers>[^}]*)\}(?P<pipeline>.*)$", re.S)
+_MATCHER = re.compile(r'(\w+)\s*(=~|!~|!=|=)\s*"((?:[^"\\]|\\.)*)"')
+_STRING = r'`[^`]*`|"(?:[^"\\]|\\.)*"'
+_STAGE = re.compile(
+    rf"(?P<filter>\|=|\|~|!=|!~)\s*(?P<values>(?:{_STRING})(?:\s+or\s+(?:{_STRING}))*)"
+    rf"|\|\s*regexp\s+(?P<regexp>{_STRING})"
+    r"|\|\s*keep\s+(?P<keep>\w+(?:\s*,\s*\w+)*)",
+    re.S,
+)
+
+
+def _string(literal: str) -> str:
+    """Value of a LogQL string literal, raw or quoted"""
+    if literal.startswith("`"):
+        return literal[1:-1]
+    return json.loads(literal)
+
+
+class _Query:
+    """Stream selector, line filters and `regexp` and `keep` stages of a
+    LogQL query
+    """
+
+    def __init__(self, query: str):
+        match = _SELECTOR.match(query)
+        if match is None:
+            raise ValueError(f"unsupported LogQL query: {query}")
+        self.matchers: List[Tuple[str, str, Any]] = []
+        for label, op, value in _MATCHER.findall(match.group("matchers")):
+            value = _string(f'"{value}"')
+            if op in ("=~", "!~"):
+                value = re.compile(value)
+            self.matchers.append((label, op, value))
+        self.filters: List[Tuple[str, List[Any]]] = []
+        # `regexp` and `keep` stages in order
+        self.stages: List[Tuple[str, Any]] = []
+        for stage in _STAGE.finditer(match.group("pipeline")):
+            if stage.group("filter"):
+                values: List[Any] = [
+                    _string(literal)
+                    for literal in re.findall(_STRING, stage.group("values"))
+                ]
+                if stage.group("filter") in ("|~", "!~"):
+                    values = [re.compile(value) for value in values]
+                self.filters.append((stage.group("filter"), values))
+            elif stage.group("regexp"):
+                self.stages.append(
+                    ("regexp", re.compile(_string(stage.group("regexp"))))
+                )
+            else:
+                keep = {label.strip() for label in stage.group("keep").split(",")}
+                self.stages.append(("keep", keep))
+
+    def selects(self, stream: Dict[str, str]) -> bool:
+        for label, op, value in self.matchers:
+            actual = stream.get(label, "")
+            if op == "=" and actual != value:
+                return False
+            if op == "!=" and actual == value:
+                return False
+            if op == "=~" and not value.fullmatch(actual):
+                return False
+            if op == "!~" and value.fullmatch(actual):
+                return False
+        return True
+
+    def keeps(self, line: str) -> bool:
+        for op, values in self.filters:
+            if op == "|=" and not any(value in line for value in values):
+                return False
+            if op == "!=" and any(value in line for value in values):
+                return False
+            if op == "|~" and not any(value.search(line) for value in values):
+                return False
+            if op == "!~" and any(value.search(line) for value in values):
+                return False
+        return True
+
+    def labels(self, stream: Dict[str, str], line: str) -> Dict[str, str]:
+        """Labels of a selected line after the `regexp` and `keep` stages"""
+        for kind, stage in self.stages:
+            if kind == "regexp":
+                extracted = stage.search(line)
+                if extracted:
+                    # like loki, empty labels are dropped
+                    stream = {
+                        **stream,
+                        **{k: v for k, v in extracted.groupdict().items() if v},
+                    }
+            else:
+                stream = {k: v for k, v in stream.items() if k in stage}
+        return stream
+
+
+class _Selection:
+    """Entries a query selects, oldest first, with their labels after the
+    query's pipeline, interned so equal labels form one stream
+    """
+
+    __slots__ = ("indices", "ts", "stream_ids", "streams")
+
+    def __init__(self):
+        self.indices: List[int] = []
+        self.ts: List[int] = []
+        self.stream_ids: List[int] = []
+        self.streams: List[Dict[str, str]] = []
+
+
+class FakeLoki:
+    """Serves `query_range` over `entries`, each only once the wall clock
+    reaches its timestamp, like Loki would have ingested them
+
+    Args:
+        entries (List[Entry]): log lines to serve
+    """
+
+    def __init__(self, entries: List[Entry]):
+        entries = sorted(entries, key=lambda entry: entry[0])
+        self._ts = [ts for ts, _, _ in entries]
+        self._lines = [line for _, _, line in entries]
+        # streams are interned so each is matched against a query once
+        keys: Dict[str, int] = {}
+        self._streams: List[Dict[str, str]] = []
+        self._stream_ids: List[int] = []
+        for _, stream, _ in entries:
+            key = json.dumps(stream, sort_keys=True)
+            if key not in keys:
+                keys[key] = len(self._streams)
+                self._streams.append(stream)
+            self._stream_ids.append(keys[key])
+        self._lock = threading.Lock()
+        self._selections: Dict[str, _Selection] = {}
+        self.served = 0
+        self.served_bytes = 0
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def endpoint(self) -> str:
+        assert self._server is not None, "fake loki is not started"
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def select(self, query: str) -> _Selection:
+        """The entries `query` selects"""
+        with self._lock:
+            cached = self._selections.get(query)
+        if cached is not None:
+            return cached
+        parsed = _Query(query)
+        selects = [parsed.selects(stream) for stream in self._streams]
+        selection = _Selection()
+        keys: Dict[str, int] = {}
+        for i, stream_id in enumerate(self._stream_ids):
+            line = self._lines[i]
+            if not selects[stream_id] or not parsed.keeps(line):
+                continue
+            labels = parsed.labels(self._streams[stream_id], line)
+            key = json.dumps(labels, sort_keys=True)
+            if key not in keys:
+                keys[key] = len(selection.streams)
+                selection.streams.append(labels)
+            selection.indices.append(i)
+            selection.ts.append(self._ts[i])
+            selection.stream_ids.append(keys[key])
+        with self._lock:
+            self._selections[query] = selection
+        return selection
+
+    def lines(self, query: str) -> List[Entry]:
+        selection = self.select(query)
+        return [
+            (ts, selection.streams[stream_id], self._lines[i])
+            for i, ts, stream_id in zip(
+                selection.indices, selection.ts, selection.stream_ids
+            )
+        ]
+
+    def query_range(self, params: Dict[str, str]) -> Dict[str, Any]:
+        """Response of `query_range` with Loki's parameters and defaults"""
+        now = time.time_ns()
+        end = min(int(params.get("end", now)), now)
+        if "since" in params:
+            start = end - _duration_ns(params["since"])
+        else:
+            start = int(params.get("start", end - 3600 * 10**9))
+        limit = int(params.get("limit", LOKI_DEFAULT_LIMIT))
+        selection = self.select(params["query"])
+        # `end` is exclusive
+        first = bisect.bisect_left(selection.ts, start)
+        window = list(range(first, bisect.bisect_left(selection.ts, end)))
+        if params.get("direction", "backward") == "backward":
+            window = window[::-1]
+        window = window[:limit]
+        streams: Dict[int, List[List[str]]] = {}
+        for j in window:
+            streams.setdefault(selection.stream_ids[j], []).append(
+                [str(selection.ts[j]), self._lines[selection.indices[j]]]
+            )
+        with self._lock:
+            self.served += len(window)
+        return {
+            "status": "success",
+            "data": {
+                "resultType": "streams",
+                "result": [
+                    {"stream": selection.streams[stream_id], "values": values}
+                    for stream_id, values in streams.items()
+                ],
+            },
+        }
+
+    def start(self) -> str:
+        """Serves in the background
+
+        Returns:
+            str: the endpoint
+        """
+        loki = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                if url.path != parse.QUERY_URL:
+                    # no tail websocket, the tailer falls back to polling
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                params = dict(urllib.parse.parse_qsl(url.query))
+                try:
+                    body = json.dumps(loki.query_range(params)).encode()
+                except (KeyError, ValueError) as e:
+                    self.send_error(400, str(e))
+                    return
+                with loki._lock:
+                    loki.served_bytes += len(body)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.endpoint
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def _duration_ns(duration: str) -> int:
+    """Nanoseconds of a Loki duration, e.g. `10s` or `1h30m`"""
+    parts = _DURATION.findall(duration)
+    if not parts:
+        raise ValueError(f"invalid duration {duration}")
+    return int(sum(float(value) * _DURATION_NS[unit] for value, unit in parts))
+
+
+class FakeCoreApi:
+    """In-memory core API with the node and pod calls the controller makes.
+    Node patches are checked against resourceVersions like the API server
+    does, and the first time each node was tainted is recorded.
+
+    Args:
+        nodes (List[str]): names of the GPU nodes
+    """
+
+    def __init__(self, nodes: List[str]):
+        self.api_client = kubernetes.client.ApiClient()
+        self._lock = threading.Lock()
+        self._version = 0
+        # node -> (resourceVersion, taints)
+        self._nodes: Dict[str, Tuple[str, List[Dict[str, str]]]] = {
+            node: ("0", []) for node in nodes
+        }
+        # node -> wall clock nanoseconds it was first tainted at
+        self.tainted: Dict[str, int] = {}
+
+    def _node(self, name: str) -> kubernetes.client.V1Node:
+        resource_version, taints = self._nodes[name]
+        return kubernetes.client.V1Node(
+            metadata=kubernetes.client.V1ObjectMeta(
+                name=name, resource_version=resource_version
+            ),
+            spec=kubernetes.client.V1NodeSpec(
+                taints=[kubernetes.client.V1Taint(**taint) for taint in taints]
+            ),
+            status=kubernetes.client.V1NodeStatus(
+                allocatable={"nvidia.com/gpu": str(nccl.GPUS_PER_NODE)}
+            ),
+        )
+
+    def _not_found(self):
+        return kube_client.api_exception()(status=404, reason="NotFound")
+
+    def list_node(self, **kwargs) -> kubernetes.client.V1NodeList:
+        with self._lock:
+            return kubernetes.client.V1NodeList(
+                metadata=kubernetes.client.V1ListMeta(
+                    resource_version=str(self._version)
+                ),
+                items=[self._node(name) for name in self._nodes],
+            )
+
+    def read_node(self, name: str, **kwargs) -> kubernetes.client.V1Node:
+        with self._lock:
+            if name not in self._nodes:
+                raise self._not_found()
+            return self._node(name)
+
+    def patch_node(
+        self, name: str, body: Dict[str, Any], **kwargs
+    ) -> kubernetes.client.V1Node:
+        with self._lock:
+            if name not in self._nodes:
+                raise self._not_found()
+            resource_version, _ = self._nodes[name]
+            expected = body.get("metadata", {}).get("resourceVersion")
+            if expected is not None and expected != resource_version:
+                raise kube_client.api_exception()(status=409, reason="Conflict")
+            taints = body["spec"]["taints"]
+            self._version += 1
+            self._nodes[name] = (str(self._version), taints)
+            if any(taint["key"] == node_control.NODE_HEALTH_LABEL for taint in taints):
+                self.tainted.setdefault(name, time.time_ns())
+            return self._node(name)
+
+    def read_namespaced_pod(self, name: str, namespace: str, **kwargs):
+        # jobs are resolved from stream labels, or fall back to the pod
+        raise self._not_found()
+
+
+def load(
+    path: str, source: str = faults.SOURCE_DMESG
+) -> Tuple[List[Entry], Optional[Set[str]]]:
+    """Reads recorded logs
+
+    Args:
+        path (str): a Loki `query_range` response or list of streams as
+            `.json`, or a raw log file named after its node
+        source (str, optional): `faults.SOURCE_DMESG` or `faults.SOURCE_POD`,
+            what a raw log file holds
+
+    Returns:
+        Tuple[List[Entry], Optional[Set[str]]]: log lines, and the labelled
+            faulty nodes if the recording has them
+    """
+    if path.endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            data: Any = json.load(f)
+        faulty = None
+        if isinstance(data, dict):
+            if "faulty" in data:
+                faulty = set(data["faulty"])
+            data = data.get("data", data)
+            data = data.get("result", data.get("streams", []))
+        entries = [
+            (int(ts), stream["stream"], line)
+            for stream in data
+            for ts, line in stream["values"]
+        ]
+        return entries, faulty
+
+    node = os.path.splitext(os.path.basename(path))[0]
+    stream = {"k8s_node_name": node}
+    if source == faults.SOURCE_DMESG:
+        stream["k8s_daemonset_name"] = "dmesg"
+    else:
+        stream["k8s_namespace_name"] = parse.WATCHED_NAMESPACES[0]
+        stream["k8s_pod_name"] = node
+    entries = []
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for i, line in enumerate(f):
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            # dmesg uptime, or a millisecond apart
+            uptime = _UPTIME.match(line)
+            ts = int(float(uptime.group(1)) * 10**9) if uptime else i * 10**6
+            entries.append((ts, stream, line))
+    return entries, None
+
+
+def synthetic(
+    num_nodes: int = 64, seconds: int = 600, seed: int = 0
+) -> Tuple[List[Entry], Set[str]]:
+    """Logs of a synthetic cluster with benign noise, hardware failures and
+    two failed jobs, one with a clear culprit and one without
+
+    Returns:
+        Tuple[List[Entry], Set[str]]: log lines and the faulty nodes
+    """
+    rng = random.Random(seed)
+    nodes = [f"replay-node-{i}" for i in range(num_nodes)]
+    entries: List[Entry] = []
+
+    def dmesg(node: str, ts: float, line: str):
+        stream = {"k8s_node_name": node, "k8s_daemonset_name": "dmesg"}
+        entries.append((int(ts * 10**9), stream, f"[{ts:.6f}] {line}"))
+
+    def pod(node: str, ts: float, job: str, line: str):
+        stream = {
+            "k8s_namespace_name": parse.WATCHED_NAMESPACES[0],
+            "k8s_node_name": node,
+            "k8s_pod_name": f"{job}-{node}",
+            "job_name": job,
+        }
+        entries.append((int(ts * 10**9), stream, line))
+
+    noise = [
+        "eth0: renamed from veth{bus}",
+        "IPv6: ADDRCONF(NETDEV_CHANGE): cali{bus}: link becomes ready",
+        "nvidia-nvswitch{bus}: SXid (PCI:0000:{bus:02x}:00.0): 12021, Non-fatal, "
+        "Link 32 egress non-posted PRIV error (First)",
+    ]
+    for node in nodes:
+        for second in range(seconds):
+            if rng.random() < 0.5:
+                line = rng.choice(noise).format(bus=rng.randrange(8))
+                dmesg(node, second + rng.random(), line)
+        # below the debounce threshold of application caused Xids
+        for _ in range(2):
+            dmesg(
+                node,
+                rng.uniform(0, seconds),
+                "NVRM: Xid (PCI:0000:4e:00): 13, pid=1234, Graphics Exception",
+            )
+
+    faulty = set()
+    for node in rng.sample(nodes[num_nodes // 2 :], max(1, num_nodes // 16)):
+        faulty.add(node)
+        dmesg(
+            node,
+            rng.uniform(0, seconds),
+            "NVRM: Xid (PCI:0000:4e:00): 79, pid='<unknown>', name=<unknown>, "
+            "GPU has fallen off the bus.",
+        )
+
+    # one worker fails first and the others time out in their collectives
+    job_nodes, culprit = nodes[:16], nodes[5]
+    faulty.add(culprit)
+    failed_at = seconds / 2
+    for node in job_nodes:
+        delay = 0.0 if node == culprit else 10 + rng.random()
+        pod(node, failed_at + delay, "llama", "CUDA error: invalid device ordinal")
+    # a job whose workers fail together, e.g. an application bug
+    failed_at = seconds * 3 / 4
+    for node in nodes[16:24]:
+        pod(
+            node,
+            failed_at + rng.random() / 10,
+            "mistral",
+            "CUDA error: invalid device ordinal",
+        )
+    return entries, faulty
+
+
+class Report:
+    """Results of a replay
+
+    Attributes:
+        lines (int): log lines replayed
+        classified (int): lines the classifiers were run on offline
+        classify_seconds (float): time the classifiers took on them
+        ingested (int): lines the controller classified, once each
+        served (int): lines the fake Loki returned, including repeats
+        served_bytes (int): size of the fake Loki's responses
+        replay_seconds (float): wall clock time of the replay
+        latencies (Dict[str, float]): seconds from the first fault line of
+            each tainted node being queryable to the node being tainted
+        tainted (Set[str]): nodes tainted during the replay
+        faulty (Optional[Set[str]]): labelled faulty nodes, None if unknown
+    """
+
+    def __init__(
+        self,
+        lines: int,
+        classified: int,
+        classify_seconds: float,
+        ingested: int,
+        served: int,
+        served_bytes: int,
+        replay_seconds: float,
+        latencies: Dict[str, float],
+        tainted: Set[str],
+        faulty: Optional[Set[str]],
+    ):
+        self.lines = lines
+        self.classified = classified
+        self.classify_seconds = classify_seconds
+        self.ingested = ingested
+        self.served = served
+        self.served_bytes = served_bytes
+        self.replay_seconds = replay_seconds
+        self.latencies = latencies
+        self.tainted = tainted
+        self.faulty = faulty
+
+    @property
+    def lines_per_second(self) -> float:
+        if not self.classify_seconds:
+            return 0.0
+        return self.classified / self.classify_seconds
+
+    def latency(self, percentile: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        return float(np.percentile(list(self.latencies.values()), percentile))
+
+    @property
+    def precision(self) -> Optional[float]:
+        if self.faulty is None or not self.tainted:
+            return None
+        return len(self.tainted & self.faulty) / len(self.tainted)
+
+    @property
+    def recall(self) -> Optional[float]:
+        if self.faulty is None or not self.faulty:
+            return None
+        return len(self.tainted & self.faulty) / len(self.faulty)
+
+    def to_dict(self) -> Dict[str, Any]:
+        faulty = self.faulty or set()
+        return {
+            "lines": self.lines,
+            "classified": self.classified,
+            "classify_lines_per_second": self.lines_per_second,
+            "ingested": self.ingested,
+            "served": self.served,
+            "served_bytes": self.served_bytes,
+            "replay_seconds": self.replay_seconds,
+            "latency_seconds": {
+                f"p{percentile}": self.latency(percentile)
+                for percentile in (50, 90, 99, 100)
+            },
+            "precision": self.precision,
+            "recall": self.recall,
+            "tainted": sorted(self.tainted),
+            "false_positives": (
+                sorted(self.tainted - faulty) if self.faulty is not None else []
+            ),
+            "false_negatives": sorted(faulty - self.tainted),
+        }
+
+    def __str__(self) -> str:
+        report = self.to_dict()
+        latency = ", ".join(
+            f"{name} {value:.2f}s" if value is not None else f"{name} -"
+            for name, value in report["latency_seconds"].items()
+        )
+        lines = [
+            f"replayed {self.lines} lines in {self.replay_seconds:.1f}s, "
+            f"loki served {self.served} in {self.served_bytes / 1024:,.0f}KiB",
+            f"classified {self.classified} selected lines at "
+            f"{self.lines_per_second:,.0f} lines/s, the controller {self.ingested}",
+            f"detection latency: {latency}",
+            f"tainted {len(self.tainted)} nodes",
+        ]
+        if self.faulty is not None:
+            lines.append(
+                f"precision {_ratio(self.precision)}, recall {_ratio(self.recall)}, "
+                f"false positives {report['false_positives']}, "
+                f"false negatives {report['false_negatives']}"
+            )
+        return "\n".join(lines)
+
+
+def _ratio(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.3f}"
+
+
+def _replayed(entries: List[Entry], start_ns: int, speed: float) -> List[Entry]:
+    """`entries` shifted to start at `start_ns` and compressed by `speed`"""
+    first = min(ts for ts, _, _ in entries)
+    return [
+        (start_ns + int((ts - first) / speed), stream, line)
+        for ts, stream, line in entries
+    ]
+
+
+def _scaled_rules(speed: float) -> Dict[str, faults.DebounceRule]:
+    """Debounce rules with their log time windows compressed by `speed`"""
+    return {
+        code: faults.DebounceRule(rule.code, rule.count, rule.window / speed)
+        for code, rule in faults.parse_rules(faults.FAULT_DEBOUNCE_RULES).items()
+    }
+
+
+def benchmark_classify(
+    loki: FakeLoki, rules: Optional[Dict[str, faults.DebounceRule]] = None
+) -> Tuple[int, float, Dict[str, int]]:
+    """Runs the classifiers over the lines each source's query selects
+
+    Args:
+        loki (FakeLoki): serves the lines
+        rules (Optional[Dict[str, faults.DebounceRule]], optional): debounce
+            rules deciding which faults are acted on
+
+    Returns:
+        Tuple[int, float, Dict[str, int]]: lines classified, seconds taken,
+            and the timestamp of the first fault acted on for every node
+    """
+    detected: List[faults.Fault] = []
+    classified, elapsed = 0, 0.0
+    for query, classifier in launch.SOURCES.values():
+        lines = loki.lines(query(None))
+        start = time.perf_counter()
+        results = [classifier(stream, ts, line) for ts, stream, line in lines]
+        elapsed += time.perf_counter() - start
+        classified += len(lines)
+        detected.extend(fault for fault in results if fault is not None)
+
+    # pod faults are correlated first, so their nodes are tainted, if at
+    # all, for the first of them
+    store = faults.FaultStore(rules=rules)
+    first_fault: Dict[str, int] = {}
+    for fault in sorted(detected, key=lambda fault: fault.ts):
+        if fault.source == faults.SOURCE_POD or store.add(fault):
+            first_fault.setdefault(fault.node, fault.ts)
+    return classified, elapsed, first_fault
+
+
+def _nodes(entries: List[Entry]) -> List[str]:
+    return sorted({stream["k8s_node_name"] for _, stream, _ in entries} - {""})
+
+
+def _lines_classified() -> float:
+    return sum(
+        prometheus_client.REGISTRY.get_sample_value(
+            "konduktor_controller_lines_total", {"source": source}
+        )
+        or 0
+        for source in launch.SOURCES
+    )
+
+
+async def _run_controller(
+    speed: float, correlation_window: Optional[float], until_ns: int, settle: float
+):
+    controller = launch.Controller()
+    # replays start fresh and leave no state behind
+    controller.state.backend = None
+    controller.store.rules = _scaled_rules(speed)
+    controller.correlator.lead /= speed
+    controller.correlator.evidence_seconds /= speed
+    if correlation_window is not None:
+        controller.correlator.window = correlation_window
+
+    async def stop_after_last_line():
+        await asyncio.sleep(max(0.0, (until_ns - time.time_ns()) / 10**9))
+        await asyncio.sleep(controller.correlator.window + settle)
+        controller.stop.set()
+
+    stopper = asyncio.create_task(stop_after_last_line())
+    await controller.run()
+    stopper.cancel()
+
+
+def replay(
+    entries: List[Entry],
+    faulty: Optional[Set[str]] = None,
+    speed: float = REPLAY_SPEED,
+    mode: str = "tail",
+    correlation_window: Optional[float] = None,
+    settle: float = SETTLE_SECONDS,
+) -> Report:
+    """Replays `entries` through a controller against a fake Loki and API
+
+    Args:
+        entries (List[Entry]): recorded log lines
+        faulty (Optional[Set[str]], optional): labelled faulty nodes
+        speed (float, optional): log seconds replayed per second
+        mode (str, optional): ingest mode, `tail` or `poll`
+        correlation_window (Optional[float], optional): overrides
+            `correlate.CORRELATION_WINDOW_SECONDS`
+        settle (float, optional): seconds to keep running after the last line
+            and the correlation window
+
+    Returns:
+        Report: throughput, latency and accuracy of the replay
+    """
+    if not entries:
+        raise ValueError("nothing to replay")
+    start_ns = time.time_ns()
+    replayed = _replayed(entries, start_ns, speed)
+    loki = FakeLoki(replayed)
+    api = FakeCoreApi(_nodes(replayed))
+    classified, classify_seconds, first_fault = benchmark_classify(
+        loki, _scaled_rules(speed)
+    )
+    faulty_nodes = faulty or set()
+
+    def fake_nccl_test(nodes: List[str]) -> Optional[float]:
+        return 0.0 if faulty_nodes.intersection(nodes) else HEALTHY_BUSBW
+
+    saved = (
+        parse.LOG_ENDPOINT,
+        kube_client._core_api,
+        nccl.run_test,
+        launch.KONDUKTOR_CONTROLLER_INGEST_MODE,
+    )
+    parse.LOG_ENDPOINT = loki.start()
+    kube_client._core_api = api
+    nccl.run_test = fake_nccl_test
+    launch.KONDUKTOR_CONTROLLER_INGEST_MODE = mode
+    lines_before = _lines_classified()
+    replay_start = time.perf_counter()
+    try:
+        until_ns = max(ts for ts, _, _ in replayed)
+        asyncio.run(_run_controller(speed, correlation_window, until_ns, settle))
+    finally:
+        (
+            parse.LOG_ENDPOINT,
+            kube_client._core_api,
+            nccl.run_test,
+            launch.KONDUKTOR_CONTROLLER_INGEST_MODE,
+        ) = saved
+        loki.stop()
+    replay_seconds = time.perf_counter() - replay_start
+    ingested = int(_lines_classified() - lines_before)
+    if ingested < classified:
+        logger.warning(
+            f"the controller classified {ingested} of {classified} selected lines"
+        )
+
+    latencies = {
+        node: (tainted_at - first_fault[node]) / 10**9
+        for node, tainted_at in api.tainted.items()
+        if node in first_fault
+    }
+    return Report(
+        len(entries),
+        classified,
+        classify_seconds,
+        ingested,
+        loki.served,
+        loki.served_bytes,
+        replay_seconds,
+        latencies,
+        set(api.tainted),
+        faulty,
+    )
+
+
+def _quiet(level: int):
+    """Sets the level of every konduktor logger, the classifiers log every
+    fault they find
+    """
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("konduktor"):
+            logging.getLogger(name).setLevel(level)
+
+
+def _failures(report: Report, args: argparse.Namespace) -> List[str]:
+    checks: List[Tuple[str, Optional[float], Optional[float], Callable]] = [
+        ("lines/s", args.min_lines_per_second, report.lines_per_second, float.__lt__),
+        ("precision", args.min_precision, report.precision, float.__lt__),
+        ("recall", args.min_recall, report.recall, float.__lt__),
+        ("p99 latency", args.max_p99_latency, report.latency(99), float.__gt__),
+    ]
+    failures = []
+    for name, threshold, value, fails in checks:
+        if threshold is None:
+            continue
+        if value is None or fails(float(value), float(threshold)):
+            failures.append(f"{name} {value} does not meet {threshold}")
+    return failures
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m konduktor.controller.replay",
+        description="Replays recorded logs through the controller offline",
+    )
+    parser.add_argument(
+        "logs",
+        nargs="*",
+        help="Loki query_range responses (.json) or raw log files named after "
+        "their node, a synthetic cluster if none",
+    )
+    parser.add_argument(
+        "--source",
+        choices=[faults.SOURCE_DMESG, faults.SOURCE_POD],
+        default=faults.SOURCE_DMESG,
+        help="what the raw log files hold",
+    )
+    parser.add_argument(
+        "--faulty", default=None, help="comma separated labelled faulty nodes"
+    )
+    parser.add_argument("--speed", type=float, default=REPLAY_SPEED)
+    parser.add_argument("--mode", choices=["tail", "poll"], default="tail")
+    parser.add_argument(
+        "--correlation-window",
+        type=float,
+        default=None,
+        help=f"defaults to {correlate.CORRELATION_WINDOW_SECONDS}s",
+    )
+    parser.add_argument("--synthetic-nodes", type=int, default=64)
+    parser.add_argument("--min-lines-per-second", type=float, default=None)
+    parser.add_argument("--min-precision", type=float, default=None)
+    parser.add_argument("--min-recall", type=float, default=None)
+    parser.add_argument("--max-p99-latency", type=float, default=None)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    _quiet(logging.INFO if args.verbose else logging.WARNING)
+    faulty: Optional[Set[str]] = None
+    if args.logs:
+        entries: List[Entry] = []
+        for path in args.logs:
+            loaded, labelled = load(path, args.source)
+            entries.extend(loaded)
+            if labelled is not None:
+                faulty = (faulty or set()) | labelled
+    else:
+        entries, faulty = synthetic(args.synthetic_nodes)
+    if args.faulty is not None:
+        faulty = (faulty or set()) | set(filter(None, args.faulty.split(",")))
+
+    report = replay(entries, faulty, args.speed, args.mode, args.correlation_window)
+    print(json.dumps(report.to_dict(), indent=2) if args.json else report)
+    failures = _failures(report, args)
+    for failure in failures:
+        print(f"FAILED: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""
+Sharding
+Splits the nodes of a large cluster across `KONDUKTOR_CONTROLLER_SHARDS`
+controller replicas. Nodes are placed on a consistent hash ring, so every
+replica agrees on the owner of a node without coordinating, and changing the
+number of shards only moves about 1/n of the nodes. Each shard only queries
+the logs of, remediates and health checks its own nodes.
+"""
+
+import bisect
+import hashlib
+from typing import Iterable, List, Tuple
+
+# points per shard on the ring, more points spread nodes more evenly
+VIRTUAL_NODES = 128
+
+
+def _hash(key: str) -> int:
+    """Stable 64 bit hash, `hash()` is randomized per process"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hash ring of `shards` shards
+
+    Args:
+        shards (int): number of shards
+        virtual_nodes (int, optional): points per shard on the ring
+    """
+
+    def __init__(self, shards: int, virtual_nodes: int = VIRTUAL_NODES):
+        points: List[Tuple[int, int]] = sorted(
+            (_hash(f"shard-{shard}-{i}"), shard)
+            for shard in range(shards)
+            for i in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def owner(self, key: str) -> int:
+        """Shard owning `key`, the first point clockwise of its hash"""
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[i]
+
+
+class Shard:
+    """The nodes owned by shard `index` of `count`"""
+
+    def __init__(self, index: int, count: int):
+        self.index = index
+        self.count = count
+        self.ring = HashRing(count)
+
+    def __repr__(self) -> str:
+        return f"shard {self.index}/{self.count}"
+
+    def owns(self, node: str) -> bool:
+        return self.count == 1 or self.ring.owner(node) == self.index
+
+    def nodes(self, nodes: Iterable[str]) -> List[str]:
+        """The owned nodes among `nodes`, sorted"""
+        return sorted(node for node in nodes if self.owns(node))
+
+
+if __name__ == "__main__":
+    # balance across shards and nodes moved when adding a shard
+    import collections
+
+    names = [f"gpu-node-{i}" for i in range(4000)]
+    for shards in (2, 4, 8, 16):
+        ring, grown = HashRing(shards), HashRing(shards + 1)
+        counts = collections.Counter(ring.owner(name) for name in names)
+        moved = sum(ring.owner(name) != grown.owner(name) for name in names)
+        print(
+            f"{shards} shards: {min(counts.values())}-{max(counts.values())} "
+            f"nodes per shard, adding one moves {moved / len(names):.1%}"
+        )
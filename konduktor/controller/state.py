@@ -0,0 +1,408 @@
+"""
+Controller state
+Persists what the controller would otherwise forget when it restarts: how far
+each log source was ingested, the faults it acted on and why, and the results
+of health checks. State changes in memory on the hot path and is flushed in
+the background every `STATE_FLUSH_SECONDS` and on shutdown, so classifying a
+line never waits on a write.
+
+State is kept as JSON in a ConfigMap, or in a local file when the controller
+cannot use one, e.g. when run remotely without access to its namespace. File
+writes go through a temporary file that is renamed over the old state, so a
+crash mid write leaves the previous state intact.
+
+Faults are recorded as pending before the cursor moves past them and are only
+marked done once their node is tainted, so a restart resumes ingesting right
+after the last classified line and re-queues remediations that did not finish.
+"""
+
+import collections
+import json
+import os
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from konduktor import kube_client
+from konduktor import logging as konduktor_logging
+from konduktor.controller import correlate, faults, remediation, tail
+
+# `configmap`, `file` or `none`
+STATE_BACKEND = os.environ.get("KONDUKTOR_CONTROLLER_STATE", "configmap")
+STATE_NAMESPACE = os.environ.get("KONDUKTOR_CONTROLLER_NAMESPACE", "konduktor")
+STATE_CONFIGMAP = "konduktor-controller-state"
+STATE_FILE = os.environ.get(
+    "KONDUKTOR_CONTROLLER_STATE_FILE",
+    os.path.expanduser("~/.konduktor/controller_state.json"),
+)
+# seconds between flushes of changed state
+STATE_FLUSH_SECONDS = int(os.environ.get("KONDUKTOR_CONTROLLER_STATE_FLUSH", 5))
+# how far back a restarted controller resumes ingesting from at most
+MAX_RESUME_SECONDS = int(os.environ.get("KONDUKTOR_CONTROLLER_MAX_RESUME", 3600))
+# faults kept in the history, ConfigMaps are limited to 1MiB
+MAX_FAULT_HISTORY = 500
+# characters of each fault's log line kept in the history
+MAX_LOG_CHARS = 512
+
+# status of a fault until its node was remediated, then the remediation result
+FAULT_PENDING = "pending"
+
+_DATA_KEY = "state.json"
+_STATE_VERSION = 1
+
+logger = konduktor_logging.get_logger(__name__)
+
+
+class FileBackend:
+    """Keeps state in a local JSON file"""
+
+    def __init__(self, path: str = STATE_FILE):
+        self.path = path
+
+    def __repr__(self) -> str:
+        return f"file {self.path}"
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, state: Dict[str, Any]):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class ConfigMapBackend:
+    """Keeps state in a ConfigMap
+
+    Writes are guarded by the resourceVersion the ConfigMap was loaded or last
+    written at, so a replica that lost its shard cannot overwrite the state of
+    the replica that took over. A replica that still holds its shard
+    `refresh`es the resourceVersion and writes again.
+    """
+
+    def __init__(self, namespace: str = STATE_NAMESPACE, name: str = STATE_CONFIGMAP):
+        self.namespace = namespace
+        self.name = name
+        # None until loaded, then None if the ConfigMap does not exist yet
+        self.resource_version: Optional[str] = None
+
+    def __repr__(self) -> str:
+        return f"configmap {self.namespace}/{self.name}"
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        try:
+            config_map = kube_client.core_api().read_namespaced_config_map(
+                name=self.name,
+                namespace=self.namespace,
+                _request_timeout=kube_client.API_TIMEOUT,
+            )
+        except kube_client.api_exception() as e:
+            if e.status == 404:
+                self.resource_version = None
+                return None
+            raise
+        self.resource_version = config_map.metadata.resource_version
+        data = (config_map.data or {}).get(_DATA_KEY)
+        return json.loads(data) if data else None
+
+    def refresh(self):
+        """Re-reads the resourceVersion of the ConfigMap, so the next save
+        overwrites whatever was written to it since
+        """
+        try:
+            config_map = kube_client.core_api().read_namespaced_config_map(
+                name=self.name,
+                namespace=self.namespace,
+                _request_timeout=kube_client.API_TIMEOUT,
+            )
+        except kube_client.api_exception() as e:
+            if e.status == 404:
+                self.resource_version = None
+                return
+            raise
+        self.resource_version = config_map.metadata.resource_version
+
+    def save(self, state: Dict[str, Any]):
+        """Writes `state` if the ConfigMap did not change since it was loaded
+        or last written
+
+        Raises:
+            kubernetes.client.rest.ApiException: with status 409 if another
+                replica wrote the ConfigMap in the meantime
+        """
+        body = {
+            "metadata": {
+                "name": self.name,
+                "namespace": self.namespace,
+                "resourceVersion": self.resource_version,
+            },
+            "data": {_DATA_KEY: json.dumps(state, separators=(",", ":"))},
+        }
+        core_api = kube_client.core_api()
+        if self.resource_version is None:
+            config_map = core_api.create_namespaced_config_map(
+                namespace=self.namespace,
+                body=body,
+                _request_timeout=kube_client.API_TIMEOUT,
+            )
+        else:
+            config_map = core_api.replace_namespaced_config_map(
+                name=self.name,
+                namespace=self.namespace,
+                body=body,
+                _request_timeout=kube_client.API_TIMEOUT,
+            )
+        self.resource_version = config_map.metadata.resource_version
+
+
+def backend(kind: str = STATE_BACKEND, shard: Optional[int] = None):
+    """The state backend named `kind`, None if state is not persisted
+
+    Args:
+        kind (str, optional): `configmap`, `file` or `none`
+        shard (Optional[int], optional): keep the state of this shard apart
+            from the other shards'
+    """
+    if kind == "configmap":
+        if shard is None:
+            return ConfigMapBackend()
+        return ConfigMapBackend(name=f"{STATE_CONFIGMAP}-{shard}")
+    if kind == "file":
+        if shard is None:
+            return FileBackend()
+        root, ext = os.path.splitext(STATE_FILE)
+        return FileBackend(f"{root}-{shard}{ext}")
+    if kind != "none":
+        logger.warning(f"unknown state backend {kind}, state is not persisted")
+    return None
+
+
+class ControllerState:
+    """In-memory controller state that is flushed to a backend
+
+    Args:
+        store (faults.FaultStore): fault store whose remediated nodes and
+            debounce counts are persisted
+        correlator (correlate.Correlator): correlator whose open jobs are
+            persisted
+        guard (Optional[remediation.BlastRadiusGuard], optional): blast
+            radius guard whose recent taints are persisted
+        state_backend (optional): `FileBackend`, `ConfigMapBackend` or None to
+            keep state in memory only
+        shard (Optional[int], optional): shard whose state this is, see
+            `backend`
+        owns (Optional[Callable[[], bool]], optional): whether this replica
+            still holds the Lease of its shard, see `leader.Elector.holds`.
+            None without leader election.
+    """
+
+    def __init__(
+        self,
+        store: faults.FaultStore,
+        correlator: correlate.Correlator,
+        state_backend=None,
+        shard: Optional[int] = None,
+        guard: Optional[remediation.BlastRadiusGuard] = None,
+        owns: Optional[Callable[[], bool]] = None,
+    ):
+        self.store = store
+        self.correlator = correlator
+        self.guard = guard
+        self.backend = state_backend
+        self.shard = shard
+        self.owns = owns
+        # fault source -> last classified line of each stream
+        self.cursors: Dict[str, tail.LogCursor] = {}
+        self.faults: Deque[Dict[str, Any]] = collections.deque(maxlen=MAX_FAULT_HISTORY)
+        # node -> {"ts": seconds, "passed": bool or None} of its last health check
+        self.health: Dict[str, Dict[str, Any]] = {}
+        self.dirty = False
+
+    def load(self):
+        """Restores the last flushed state. Falls back to a local file if the
+        ConfigMap cannot be read.
+        """
+        if self.backend is None:
+            return
+        start = time.perf_counter()
+        try:
+            state = self.backend.load()
+        except Exception as e:  # pylint: disable=broad-except
+            if not isinstance(self.backend, ConfigMapBackend):
+                logger.error(
+                    f"failed to load controller state from {self.backend}: {e}"
+                )
+                return
+            logger.warning(
+                f"failed to load controller state from {self.backend}, "
+                f"falling back to a local file: {e}"
+            )
+            self.backend = backend("file", self.shard)
+            self.load()
+            return
+        if state is None:
+            logger.info(f"no controller state in {self.backend}, starting fresh")
+            return
+        if state.get("version") != _STATE_VERSION:
+            logger.warning(
+                f"ignoring controller state version {state.get('version')} "
+                f"in {self.backend}"
+            )
+            return
+        self.cursors = {
+            source: tail.LogCursor.from_dict(cursor)
+            for source, cursor in state.get("cursors", {}).items()
+        }
+        self.faults.extend(state.get("faults", []))
+        self.health = state.get("health", {})
+        self.store.restore(state.get("store", {}))
+        self.correlator.restore(state.get("correlator", {}))
+        if self.guard is not None:
+            self.guard.restore(state.get("guard", {}))
+        logger.info(
+            f"restored controller state from {self.backend} in "
+            f"{(time.perf_counter() - start) * 1000:.1f}ms: "
+            f"{len(self.faults)} faults, {len(self.pending())} pending"
+        )
+
+    def resume_cursor(self, source: str) -> Optional[tail.LogCursor]:
+        """Copy of the cursor to resume ingesting `source` from, None if it
+        was never ingested or is older than `MAX_RESUME_SECONDS`
+        """
+        cursor = self.cursors.get(source)
+        if cursor is None:
+            return None
+        if cursor.ts < time.time_ns() - MAX_RESUME_SECONDS * 10**9:
+            logger.warning(
+                f"{source} logs were last ingested more than "
+                f"{MAX_RESUME_SECONDS}s ago, resuming from {MAX_RESUME_SECONDS}s ago"
+            )
+            return None
+        return cursor.copy()
+
+    def advance(self, source: str, stream: Dict[str, str], ts: int, line: str) -> bool:
+        """Moves the cursor of `source` over a classified line
+
+        Returns:
+            bool: False if the line was classified before
+        """
+        cursor = self.cursors.get(source)
+        if cursor is None:
+            # lines of other streams may still arrive up to the lookback behind
+            cursor = self.cursors[source] = tail.LogCursor(0)
+        if not cursor.advance(stream, ts, line):
+            return False
+        self.dirty = True
+        return True
+
+    def record_fault(self, fault: faults.Fault):
+        """Records a fault whose node is about to be remediated"""
+        self.faults.append(
+            {
+                "node": fault.node,
+                "source": fault.source,
+                "code": fault.code,
+                "ts": fault.ts,
+                "log": fault.log[:MAX_LOG_CHARS],
+                "status": FAULT_PENDING,
+            }
+        )
+        self.dirty = True
+
+    def remediated(self, node: str, result: str):
+        """Marks the pending faults of `node` with the result of its
+        remediation, see `remediation.RESULT_*`
+        """
+        for fault in self.faults:
+            if fault["node"] == node and fault["status"] == FAULT_PENDING:
+                fault["status"] = result
+        self.dirty = True
+
+    def reason(self, node: str) -> str:
+        """Codes of the pending faults of `node`"""
+        return ",".join(
+            dict.fromkeys(
+                fault["code"]
+                for fault in self.faults
+                if fault["node"] == node and fault["status"] == FAULT_PENDING
+            )
+        )
+
+    def pending(self) -> List[str]:
+        """Nodes with faults that were not remediated yet"""
+        return list(
+            dict.fromkeys(
+                fault["node"]
+                for fault in self.faults
+                if fault["status"] == FAULT_PENDING
+            )
+        )
+
+    def record_health(self, results: Dict[str, Optional[bool]]):
+        """Records the health check result of every tested node, None if it
+        was inconclusive
+        """
+        now = time.time()
+        for node, passed in results.items():
+            self.health[node] = {"ts": now, "passed": passed}
+        self.dirty = True
+
+    def snapshot(self) -> Dict[str, Any]:
+        """JSON serializable copy of the state, which is then safe to save
+        from another thread
+        """
+        self.dirty = False
+        return {
+            "version": _STATE_VERSION,
+            "cursors": {
+                source: cursor.to_dict() for source, cursor in self.cursors.items()
+            },
+            "faults": [dict(fault) for fault in self.faults],
+            "health": dict(self.health),
+            "store": self.store.dump(),
+            "correlator": self.correlator.dump(),
+            "guard": {} if self.guard is None else self.guard.dump(),
+        }
+
+    def save(self, snapshot: Dict[str, Any]):
+        """Writes a `snapshot` to the backend, blocking"""
+        if self.backend is None:
+            return
+        try:
+            self.backend.save(snapshot)
+        except Exception as e:  # pylint: disable=broad-except
+            if isinstance(e, kube_client.api_exception()) and e.status == 409:
+                self._conflict()
+                return
+            logger.error(f"failed to save controller state to {self.backend}: {e}")
+            # retried on the next flush
+            self.dirty = True
+
+    def _conflict(self):
+        """Handles a write to the ConfigMap since we loaded or last wrote it.
+        The state is only left to the writer if it took over our shard,
+        otherwise, e.g. after a manual edit, it is overwritten on the next
+        flush.
+        """
+        try:
+            if self.owns is not None and not self.owns():
+                logger.error(
+                    f"controller state in {self.backend} was written by the "
+                    "replica that took over our shard, not overwriting it"
+                )
+                return
+            logger.warning(
+                f"controller state in {self.backend} was written by someone "
+                "else, overwriting it on the next flush"
+            )
+            self.backend.refresh()
+        except Exception as e:  # pylint: disable=broad-except
+            logger.error(f"failed to resolve the conflict on {self.backend}: {e}")
+        self.dirty = True
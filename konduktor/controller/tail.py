@@ -0,0 +1,274 @@
+"""
+Streaming log ingestion
+Subscribes to Loki's tail websocket so log lines reach the classifiers as soon
+as they are ingested, instead of re-scanning a fixed window every poll. If the
+websocket is unavailable, we fall back to `query_range` polling. Ingestion is
+tracked per stream by a `LogCursor`, so lines that arrive late and out of order
+across streams are not skipped, and lines are never repeated.
+https://grafana.com/docs/loki/latest/reference/loki-http-api/#stream-logs
+"""
+
+import json
+import threading
+import time
+import urllib.parse
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import requests
+import websocket
+
+from konduktor import logging as konduktor_logging
+from konduktor import loki_client
+from konduktor.controller import metrics, parse
+
+TAIL_URL: str = "/loki/api/v1/tail"
+# seconds to wait for a message before checking whether we should stop
+TAIL_RECV_TIMEOUT: int = 5
+# seconds to poll `query_range` for before retrying the websocket
+FALLBACK_SECONDS: int = 30
+FALLBACK_POLL_SECONDS: int = 1
+FALLBACK_LIMIT: int = 1000
+# max lines from before the tail connected that loki sends
+TAIL_LIMIT: int = 5000
+# seconds lines of one stream may arrive behind newer lines of other streams
+LOOKBACK_SECONDS: int = 60
+
+logger = konduktor_logging.get_logger(__name__)
+
+LineHandler = Callable[[Dict[str, str], int, str], None]
+
+
+class LogCursor:
+    """Position of ingestion in every stream of a query
+
+    Loki orders lines within a stream but not across streams, so a line of one
+    stream can arrive after newer lines of another. Every stream therefore has
+    its own cursor, the newest timestamp ingested from it along with the lines
+    seen at exactly that timestamp, so resuming neither skips nor repeats
+    lines. Lines up to `lookback` nanoseconds older than the newest line of any
+    stream are accepted, and ingestion resumes from that far back.
+
+    Args:
+        start_ns (int): timestamp to start from
+        lookback (int, optional): nanoseconds lines may arrive late by
+    """
+
+    def __init__(self, start_ns: int, lookback: int = LOOKBACK_SECONDS * 10**9):
+        self.start = start_ns
+        # newest timestamp ingested from any stream
+        self.ts = start_ns
+        self.lookback = lookback
+        # stream labels as JSON -> (newest timestamp, lines seen at it)
+        self._streams: Dict[str, Tuple[int, Set[str]]] = {}
+        self._pruned_at = start_ns
+
+    @property
+    def floor(self) -> int:
+        """Oldest timestamp still accepted, which ingestion resumes from"""
+        return max(self.start, self.ts - self.lookback)
+
+    def advance(self, stream: Dict[str, str], ts: int, line: str) -> bool:
+        """Moves the cursor of the entry's stream over it
+
+        Returns:
+            bool: True if the entry has not been seen before
+        """
+        if ts < self.floor:
+            return False
+        key = json.dumps(stream, sort_keys=True)
+        last = self._streams.get(key)
+        if last is not None:
+            last_ts, seen = last
+            if ts < last_ts:
+                return False
+            if ts == last_ts:
+                if line in seen:
+                    return False
+                seen.add(line)
+                return True
+        self._streams[key] = (ts, {line})
+        if ts > self.ts:
+            self.ts = ts
+            if ts - self._pruned_at > self.lookback:
+                self._prune()
+        return True
+
+    def _prune(self):
+        """Forgets streams with nothing newer than the floor, every line they
+        could still log is newer than their cursor
+        """
+        floor = self.floor
+        self._streams = {
+            key: last for key, last in self._streams.items() if last[0] >= floor
+        }
+        self._pruned_at = self.ts
+
+    def copy(self) -> "LogCursor":
+        return LogCursor.from_dict(self.to_dict())
+
+    def to_dict(self) -> Dict[str, Any]:
+        self._prune()
+        return {
+            "start": self.start,
+            "ts": self.ts,
+            "lookback": self.lookback,
+            "streams": [
+                [key, ts, sorted(seen)] for key, (ts, seen) in self._streams.items()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "LogCursor":
+        ts = int(data["ts"])
+        cursor = cls(int(data.get("start", 0)), int(data.get("lookback", 0)))
+        if "lookback" not in data:
+            # a single cursor of every stream, from before streams were tracked
+            cursor.lookback = LOOKBACK_SECONDS * 10**9
+            for key, line in data.get("seen", []):
+                cursor._streams.setdefault(key, (ts, set()))[1].add(line)
+        cursor.ts = ts
+        cursor._pruned_at = ts
+        for key, last_ts, seen in data.get("streams", []):
+            cursor._streams[key] = (int(last_ts), set(seen))
+        return cursor
+
+
+class LokiTailer:
+    """Streams the lines matching a LogQL query into `on_line`
+
+    Args:
+        query (str): LogQL query to tail
+        on_line (LineHandler): called with the stream labels, nanosecond
+            timestamp and content of every new line
+        start_ns (int, optional): timestamp to start from. Defaults to
+            `parse.LOGS_SINCE` seconds ago.
+        cursor (Optional[LogCursor], optional): resume right after this
+            cursor instead of from `start_ns`
+        endpoint (str, optional): loki endpoint. Defaults to `parse.LOG_ENDPOINT`
+    """
+
+    def __init__(
+        self,
+        query: str,
+        on_line: LineHandler,
+        start_ns: Optional[int] = None,
+        endpoint: Optional[str] = None,
+        cursor: Optional[LogCursor] = None,
+    ):
+        if start_ns is None:
+            start_ns = time.time_ns() - parse.LOGS_SINCE * 10**9
+        self.query = query
+        self.on_line = on_line
+        self.endpoint = parse.LOG_ENDPOINT if endpoint is None else endpoint
+        self.cursor = LogCursor(start_ns) if cursor is None else cursor
+
+    def run(self, stop: threading.Event):
+        """Tails until `stop` is set, polling whenever the websocket is down"""
+        while not stop.is_set():
+            try:
+                try:
+                    self._tail(stop)
+                except (websocket.WebSocketException, OSError) as e:
+                    logger.warning(f"loki tail failed, falling back to polling: {e}")
+                    self._poll(stop)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"loki tailer failed, restarting: {e}")
+                stop.wait(FALLBACK_POLL_SECONDS)
+
+    def _tail_url(self) -> str:
+        params = urllib.parse.urlencode(
+            {
+                "query": self.query,
+                "start": self.cursor.floor,
+                "limit": TAIL_LIMIT,
+                "delay_for": 0,
+            }
+        )
+        ws_endpoint = self.endpoint.replace("https://", "wss://", 1).replace(
+            "http://", "ws://", 1
+        )
+        return f"{ws_endpoint}{TAIL_URL}?{params}"
+
+    def _tail(self, stop: threading.Event):
+        ws = websocket.create_connection(self._tail_url(), timeout=TAIL_RECV_TIMEOUT)
+        logger.info(f"tailing loki: {self.query}")
+        try:
+            while not stop.is_set():
+                try:
+                    message = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    continue
+                if not message:
+                    raise websocket.WebSocketConnectionClosedException(
+                        "loki closed the tail"
+                    )
+                with metrics.timed(metrics.STAGE_PARSE):
+                    data = json.loads(message)
+                dropped = data.get("dropped_entries") or []
+                if dropped:
+                    logger.warning(f"loki tail dropped {len(dropped)} entries")
+                self._ingest(
+                    (stream["stream"], int(ts), line)
+                    for stream in data.get("streams") or []
+                    for ts, line in stream["values"]
+                )
+        finally:
+            ws.close()
+
+    def _poll(self, stop: threading.Event):
+        """Polls `query_range` from the cursor's floor for `FALLBACK_SECONDS`,
+        paging forward until the lines up to now are read
+        """
+        deadline = time.monotonic() + FALLBACK_SECONDS
+        while not stop.is_set() and time.monotonic() < deadline:
+            start = self.cursor.floor
+            end = time.time_ns()
+            while not stop.is_set() and start < end:
+                entries = self._query(start, end)
+                if entries is None:
+                    break
+                if self._ingest(entries) < FALLBACK_LIMIT:
+                    break
+                # a full page, read the next one right away
+                last = max(ts for _, ts, _ in entries)
+                start = last if last > start else start + 1
+            stop.wait(FALLBACK_POLL_SECONDS)
+
+    def _query(self, start: int, end: int) -> Optional[List[loki_client.Entry]]:
+        """Lines from `start` to `end`, oldest first, None if the query failed"""
+        params = {
+            "query": self.query,
+            "start": str(start),
+            "end": str(end),
+            "direction": "forward",
+            "limit": str(FALLBACK_LIMIT),
+        }
+        try:
+            response = loki_client.get(
+                f"{self.endpoint}{parse.QUERY_URL}", params, stream=True
+            )
+        except requests.RequestException as e:
+            logger.error(f"loki query failed {params}: {e}")
+            return None
+        with response:
+            if response.status_code != 200:
+                logger.error(f"loki query failed {params}")
+                return None
+            try:
+                with metrics.timed(metrics.STAGE_PARSE):
+                    return list(
+                        loki_client.iter_entries(
+                            response.iter_content(loki_client.CHUNK_BYTES)
+                        )
+                    )
+            except (requests.RequestException, ValueError) as e:
+                logger.error(f"loki query failed reading the response: {e}")
+                return None
+
+    def _ingest(self, entries: Iterable[loki_client.Entry]) -> int:
+        # entries are ordered within each stream only
+        ordered = sorted(entries, key=lambda entry: entry[1])
+        for labels, ts, line in ordered:
+            if self.cursor.advance(labels, ts, line):
+                self.on_line(labels, ts, line)
+        return len(ordered)
@@ -0,0 +1,193 @@
+"""
+(S)Xid classification
+Parses NVIDIA Xid and NVSwitch SXid errors out of dmesg lines in a single pass
+with one precompiled pattern, and assigns each a severity from
+`constants.HARDWARE_XID_ERRORS` and `constants.ALLOWLISTED_NVSWITCH_SXID_ERRORS`.
+https://docs.nvidia.com/deploy/xid-errors/index.html
+
+Example Xid error from dmesg
+[1235733.431527] NVRM: Xid (PCI:0000:4e:00): 79, pid='<unknown>', name=<unknown>, GPU has fallen off the bus.
+Example sxid error from dmesg
+[1235733.431527] nvidia-nvswitch3: SXid (PCI:0000:4e:00.0): 12028, Non-fatal, Link 32 egress non-posted PRIV error (First)
+"""  # noqa: E501
+
+import re
+from typing import Dict, Optional
+
+from konduktor.controller import constants
+
+XID = "Xid"
+SXID = "SXid"
+
+# known harmless, never remediated
+SEVERITY_BENIGN = "benign"
+# listed by NVIDIA as a hardware failure
+SEVERITY_HARDWARE = "hardware"
+# any other (S)Xid, may be caused by the workload or the hardware
+SEVERITY_ERROR = "error"
+
+_XID_PATTERN = re.compile(
+    r"(?:nvidia-nvswitch(?P<device>\d+): )?"
+    r"(?P<kind>SXid|NVRM: Xid) \((?:PCI:)?(?P<pci>[^)]*)\): (?P<code>\d+),"
+)
+# prefix of the labels Loki's `| regexp` stage extracts with `LOGQL_PATTERN`
+LABEL_PREFIX = "xid_"
+# groups of `_XID_PATTERN` extracted as labels. The PCI bus id and device vary
+# per GPU, and as labels would split a node's lines into a stream per GPU.
+_LABEL_GROUPS = ("kind", "code")
+# `_XID_PATTERN` in RE2 syntax, so Loki parses the (S)Xid out of each line
+LOGQL_PATTERN = re.sub(
+    r"\(\?P<(\w+)>",
+    lambda group: (
+        f"(?P<{LABEL_PREFIX}{group.group(1)}>"
+        if group.group(1) in _LABEL_GROUPS
+        else "(?:"
+    ),
+    _XID_PATTERN.pattern,
+)
+# labels `LOGQL_PATTERN` extracts
+LABELS = [f"{LABEL_PREFIX}{group}" for group in _LABEL_GROUPS]
+# RE2 pattern of the known harmless SXids, so Loki drops them
+BENIGN_LOGQL_PATTERN = (
+    r"SXid \((?:PCI:)?[^)]*\): (?:"
+    + "|".join(map(str, sorted(constants.ALLOWLISTED_NVSWITCH_SXID_ERRORS)))
+    + "),"
+)
+
+
+class XidError:
+    """A single (S)Xid error parsed from a log line
+
+    Attributes:
+        kind (str): `XID` or `SXID`
+        code (int): (S)Xid error code
+        pci_bus_id (str): PCI bus id of the reporting device, e.g. 0000:4e:00
+        device_index (Optional[int]): index of the reporting NVSwitch, e.g. 3 for
+            `nvidia-nvswitch3`. Xid lines only carry the PCI bus id.
+        severity (str): one of `SEVERITY_BENIGN`, `SEVERITY_HARDWARE`,
+            `SEVERITY_ERROR`
+    """
+
+    __slots__ = ("kind", "code", "pci_bus_id", "device_index", "severity")
+
+    def __init__(
+        self,
+        kind: str,
+        code: int,
+        pci_bus_id: str,
+        device_index: Optional[int],
+        severity: str,
+    ):
+        self.kind = kind
+        self.code = code
+        self.pci_bus_id = pci_bus_id
+        self.device_index = device_index
+        self.severity = severity
+
+    @property
+    def remediate(self) -> bool:
+        """Whether the error should take the node out of service"""
+        return self.severity != SEVERITY_BENIGN
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.kind} {self.code} ({self.severity}) "
+            f"pci={self.pci_bus_id} device={self.device_index}"
+        )
+
+
+def severity(kind: str, code: int) -> str:
+    if kind == SXID:
+        if code in constants.ALLOWLISTED_NVSWITCH_SXID_ERRORS:
+            return SEVERITY_BENIGN
+        return SEVERITY_ERROR
+    if code in constants.HARDWARE_XID_ERRORS:
+        return SEVERITY_HARDWARE
+    return SEVERITY_ERROR
+
+
+def _error(device: Optional[str], kind: str, pci_bus_id: str, code: str) -> XidError:
+    kind = SXID if kind == SXID else XID
+    error_code = int(code)
+    return XidError(
+        kind,
+        error_code,
+        pci_bus_id,
+        int(device) if device else None,
+        severity(kind, error_code),
+    )
+
+
+def classify(log_content: str) -> Optional[XidError]:
+    """Parses the (S)Xid error in a log line
+
+    Args:
+        log_content (str): a dmesg log line
+
+    Returns:
+        Optional[XidError]: the error, None if the line has no (S)Xid error
+    """
+    # cheap substring check, most lines are not (S)Xid errors
+    if "Xid" not in log_content:
+        return None
+    match = _XID_PATTERN.search(log_content)
+    if match is None:
+        return None
+    return _error(*match.group("device", "kind", "pci", "code"))
+
+
+def from_labels(labels: Dict[str, str]) -> Optional[XidError]:
+    """The (S)Xid error Loki extracted into stream labels with `LOGQL_PATTERN`.
+    Its PCI bus id and device are not extracted.
+
+    Args:
+        labels (Dict[str, str]): loki stream labels of a line
+
+    Returns:
+        Optional[XidError]: the error, None if no error was extracted
+    """
+    kind = labels.get(f"{LABEL_PREFIX}kind")
+    code = labels.get(f"{LABEL_PREFIX}code")
+    if not kind or not code:
+        return None
+    return _error(None, kind, "", code)
+
+
+if __name__ == "__main__":
+    # throughput benchmark over synthetic dmesg lines
+    # python -m konduktor.controller.xid [num_lines]
+    import random
+    import sys
+    import time
+
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    templates = [
+        "[{t}] NVRM: Xid (PCI:0000:{bus:02x}:00): {code}, pid='<unknown>', "
+        "name=<unknown>, GPU has fallen off the bus.",
+        "[{t}] nvidia-nvswitch{bus}: SXid (PCI:0000:{bus:02x}:00.0): {sxid}, "
+        "Non-fatal, Link 32 egress non-posted PRIV error (First)",
+        "[{t}] eth0: renamed from veth{bus}",
+        "[{t}] IPv6: ADDRCONF(NETDEV_CHANGE): cali{bus}: link becomes ready",
+        "[{t}] EXT4-fs (sda1): mounted filesystem with ordered data mode.",
+    ]
+    sxids = list(constants.ALLOWLISTED_NVSWITCH_SXID_ERRORS) + [12028, 20034]
+    lines = [
+        random.choice(templates).format(
+            t=f"{i / 1000:.6f}",
+            bus=random.randrange(8),
+            code=random.choice([13, 31, 43, 48, 79, 94]),
+            sxid=random.choice(sxids),
+        )
+        for i in range(num_lines)
+    ]
+
+    start = time.perf_counter()
+    errors = [classify(line) for line in lines]
+    elapsed = time.perf_counter() - start
+    matched = sum(error is not None for error in errors)
+    remediated = sum(error is not None and error.remediate for error in errors)
+    print(
+        f"classified {num_lines} lines in {elapsed:.2f}s "
+        f"({num_lines / elapsed:,.0f} lines/s), "
+        f"{matched} (S)Xid errors, {remediated} remediated"
+    )
@@ -0,0 +1,223 @@
+"""
+Dashboard latency benchmark
+Measures the latency of `/getJobs` first on an idle dashboard and then while
+Socket.IO clients keep switching namespaces, so the dashboard keeps fetching
+and formatting large batches of logs. The dashboard runs in a subprocess
+against a fake Loki and fake Kubernetes clients, so no cluster is needed.
+
+    python -m konduktor.dashboard.backend.benchmark --clients 20 --seconds 10
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import threading
+import time
+from typing import Any, Dict, List
+
+import aiohttp.web
+import requests
+import socketio
+
+NAMESPACES = [f"bench-{i}" for i in range(10)]
+
+
+def _fake_loki(line_bytes: int, latency: float) -> str:
+    """Serves query_range from a thread, the tail endpoint is left out so
+    tailers fall back to polling
+
+    Returns:
+        str: query_range url
+    """
+    now = time.time_ns()
+    entries = {
+        namespace: [
+            (now - i * 10**10, f"{namespace} {i} " + "x" * line_bytes)
+            for i in range(1000)
+        ]
+        for namespace in NAMESPACES
+    }
+
+    async def query_range(request: aiohttp.web.Request) -> aiohttp.web.Response:
+        await asyncio.sleep(latency)
+        query = request.query["query"]
+        start = int(request.query.get("start", 0))
+        end = int(request.query.get("end", time.time_ns()))
+        limit = int(request.query.get("limit", 100))
+        result = []
+        for namespace, lines in entries.items():
+            if namespace not in query:
+                continue
+            values = [[str(ts), line] for ts, line in lines if start <= ts < end]
+            result.append(
+                {"stream": {"k8s_namespace_name": namespace}, "values": values[:limit]}
+            )
+        return aiohttp.web.json_response(
+            {"status": "success", "data": {"resultType": "streams", "result": result}}
+        )
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/loki/api/v1/query_range", query_range)
+    runner = aiohttp.web.AppRunner(app)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(runner.setup())
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = runner.addresses[0][1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return f"http://127.0.0.1:{port}/loki/api/v1/query_range"
+
+
+class _FakeCustomObjects:
+    def __init__(self, count: int):
+        self.items = [
+            {
+                "metadata": {
+                    "uid": f"uid-{i}",
+                    "name": f"workload-{i}",
+                    "namespace": random.choice(NAMESPACES),
+                    "creationTimestamp": "2024-01-01T00:00:00Z",
+                    "resourceVersion": str(i),
+                },
+                "spec": {"queueName": "bench", "priority": i % 5},
+                "status": {"admission": {}} if i % 2 else {},
+            }
+            for i in range(count)
+        ]
+
+    def list_cluster_custom_object(self, **kwargs) -> Dict[str, Any]:
+        return {"items": self.items, "metadata": {"resourceVersion": "1"}}
+
+
+class _FakeCore:
+    def list_namespace(self):
+        raise NotImplementedError
+
+
+class _IdleWatch:
+    resource_version = None
+
+    def stream(self, func, **kwargs):
+        time.sleep(kwargs.get("timeout_seconds", 300))
+        return iter(())
+
+    def stop(self):
+        pass
+
+
+def _serve(loki_url: str, port: int, workloads: int):
+    os.environ["LOGS_URL"] = loki_url
+    import uvicorn
+
+    from konduktor import kube_client
+
+    kube_client._crd_api = _FakeCustomObjects(workloads)
+    kube_client._core_api = _FakeCore()
+    kube_client._batch_api = object()
+    kube_client.watch = _IdleWatch  # type: ignore[assignment]
+
+    from konduktor.dashboard.backend import main
+
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def _measure(url: str, seconds: float) -> List[float]:
+    """Latencies in milliseconds of back to back requests to `url`"""
+    latencies = []
+    http = requests.Session()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        http.get(url, timeout=30).raise_for_status()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+async def _switch_namespaces(url: str, stop: asyncio.Event, interval: float):
+    client = socketio.AsyncClient()
+    await client.connect(url)
+    while not stop.is_set():
+        await client.emit("update_namespaces", random.sample(NAMESPACES, 2))
+        await asyncio.sleep(interval)
+    await client.disconnect()
+
+
+async def _measure_under_load(
+    url: str, clients: int, seconds: float, interval: float
+) -> List[float]:
+    stop = asyncio.Event()
+    load = [
+        asyncio.create_task(_switch_namespaces(url, stop, interval))
+        for _ in range(clients)
+    ]
+    await asyncio.sleep(1)
+    latencies = await asyncio.to_thread(_measure, f"{url}/getJobs", seconds)
+    stop.set()
+    await asyncio.gather(*load)
+    return latencies
+
+
+def _report(name: str, latencies: List[float]):
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(
+        json.dumps(
+            {
+                "phase": name,
+                "requests": len(latencies),
+                "p50_ms": round(quantiles[49], 2),
+                "p99_ms": round(quantiles[98], 2),
+                "max_ms": round(latencies[-1], 2),
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--workloads", type=int, default=1000)
+    parser.add_argument("--line-bytes", type=int, default=1000)
+    parser.add_argument("--loki-latency", type=float, default=0.2)
+    parser.add_argument(
+        "--interval", type=float, default=0.1, help="seconds between switches"
+    )
+    parser.add_argument("--port", type=int, default=5099)
+    args = parser.parse_args()
+
+    loki_url = _fake_loki(args.line_bytes, args.loki_latency)
+    ctx = multiprocessing.get_context("spawn")
+    server = ctx.Process(
+        target=_serve, args=(loki_url, args.port, args.workloads), daemon=True
+    )
+    server.start()
+    url = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            requests.get(f"{url}/getJobs", timeout=1).raise_for_status()
+            break
+        except requests.RequestException:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+    try:
+        _report("idle", _measure(f"{url}/getJobs", args.seconds))
+        _report(
+            "log load",
+            asyncio.run(
+                _measure_under_load(url, args.clients, args.seconds, args.interval)
+            ),
+        )
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
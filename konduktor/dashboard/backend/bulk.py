@@ -0,0 +1,227 @@
+"""
+Bulk workload actions
+Deletes workloads or sets their priority in bulk, either for a list of names or
+for every cached workload matching the same filters as `/getJobs`. The Kueue
+API calls run concurrently on a bounded thread pool, so clearing out a queue
+of hundreds of workloads takes seconds rather than hundreds of round trips
+from the browser. The HTTP endpoints return every result at once, while the
+`bulk_delete_workloads` and `bulk_update_priority` Socket.IO events send the
+result of each workload to the requesting client as soon as it is known.
+
+Priorities are set with a merge patch of `spec.priority` alone, so concurrent
+changes to the rest of the workload are never overwritten.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import threading
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from kubernetes import client
+
+from konduktor import kube_client
+from konduktor import logging as konduktor_logging
+
+from .sockets import socketio
+from .workloads import GROUP, PLURAL, VERSION, workload_cache
+
+# Kueue API calls run at once
+BULK_WORKERS = int(os.environ.get("BULK_WORKERS", 16))
+# max workloads a single bulk action applies to
+MAX_BULK_WORKLOADS = 5000
+
+logger = konduktor_logging.get_logger(__name__)
+
+_lock = threading.Lock()
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+# (namespace, name) of a workload
+Target = Tuple[str, str]
+
+
+def executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=BULK_WORKERS, thread_name_prefix="bulk"
+            )
+    return _executor
+
+
+def delete_workload(namespace: str, name: str):
+    """Deletes a Kueue workload, blocking"""
+    kube_client.crd_api().delete_namespaced_custom_object(
+        group=GROUP,
+        version=VERSION,
+        namespace=namespace,
+        plural=PLURAL,
+        name=name,
+        body=client.V1DeleteOptions(propagation_policy="Background"),
+        _request_timeout=kube_client.API_TIMEOUT,
+    )
+
+
+def set_priority(namespace: str, name: str, priority: int):
+    """Sets the priority of a Kueue workload with a merge patch, blocking"""
+    kube_client.crd_api().patch_namespaced_custom_object(
+        group=GROUP,
+        version=VERSION,
+        namespace=namespace,
+        plural=PLURAL,
+        name=name,
+        body={"spec": {"priority": priority}},
+        _request_timeout=kube_client.API_TIMEOUT,
+    )
+
+
+def select(data: Dict[str, Any]) -> List[Target]:
+    """Workloads a bulk request applies to
+
+    Args:
+        data (Dict[str, Any]): either `{"workloads": [{"name": ...,
+            "namespace": ...}, ...]}`, or `{"selector": {...}}` with any of
+            the `namespace`, `status` and `localQueueName` filters of
+            `/getJobs`
+
+    Raises:
+        ValueError: if the request names no workloads, workloads that are not
+            objects or have no name, the selector has no filters, or it
+            applies to more than `MAX_BULK_WORKLOADS`
+    """
+    if data.get("workloads"):
+        if not isinstance(data["workloads"], list) or not all(
+            isinstance(workload, dict) for workload in data["workloads"]
+        ):
+            raise ValueError("workloads must be a list of objects")
+        targets = [
+            (workload.get("namespace", "default"), workload.get("name"))
+            for workload in data["workloads"]
+        ]
+        if not all(name for _, name in targets):
+            raise ValueError("every workload needs a name")
+    else:
+        selector = data.get("selector") or {}
+        namespace = selector.get("namespace")
+        status = selector.get("status")
+        queue = selector.get("localQueueName")
+        if namespace is None and status is None and queue is None:
+            raise ValueError("either workloads or a selector with filters is required")
+        rows, _ = workload_cache.query(namespace=namespace, status=status, queue=queue)
+        targets = [(row["namespace"], row["name"]) for row in rows]
+    # the same workload may be listed twice
+    targets = list(dict.fromkeys(targets))
+    if len(targets) > MAX_BULK_WORKLOADS:
+        raise ValueError(
+            f"{len(targets)} workloads selected, at most {MAX_BULK_WORKLOADS} "
+            "can be changed at once"
+        )
+    return targets
+
+
+async def run(
+    action: str,
+    targets: List[Target],
+    call: Callable[[str, str], None],
+    sid: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Calls `call(namespace, name)` for every target on the bulk thread pool
+
+    Every result is sent to `sid` as a `bulk_result` event as soon as it is
+    known, followed by a `bulk_done` event with the summary.
+
+    Args:
+        action (str): name of the action, e.g. `delete`
+        targets (List[Target]): workloads to call `call` for
+        call (Callable[[str, str], None]): blocking Kueue API call
+        sid (Optional[str], optional): Socket.IO client to send results to
+
+    Returns:
+        Dict[str, Any]: summary, with the result of every workload
+    """
+    operation = uuid.uuid4().hex
+    loop = asyncio.get_running_loop()
+
+    async def apply(namespace: str, name: str) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"namespace": namespace, "name": name}
+        try:
+            await loop.run_in_executor(executor(), call, namespace, name)
+            result.update(success=True, status=200)
+        except kube_client.api_exception() as e:
+            result.update(success=False, status=e.status, error=e.reason)
+        except kube_client.max_retry_error() as e:
+            result.update(success=False, status=503, error=str(e))
+        except Exception as e:  # pylint: disable=broad-except
+            # e.g. a timeout, fails this workload rather than the whole action
+            logger.error(f"bulk {action} of {namespace}/{name} failed: {e}")
+            result.update(success=False, status=500, error=str(e))
+        if sid is not None:
+            await socketio.emit(
+                "bulk_result", {"operation": operation, **result}, to=sid
+            )
+        return result
+
+    results = await asyncio.gather(*(apply(*target) for target in targets))
+    failed = sum(not result["success"] for result in results)
+    summary = {
+        "operation": operation,
+        "action": action,
+        "total": len(results),
+        "succeeded": len(results) - failed,
+        "failed": failed,
+    }
+    logger.debug(f"bulk {action}: {summary}")
+    if sid is not None:
+        await socketio.emit("bulk_done", summary, to=sid)
+    return {**summary, "results": results}
+
+
+async def bulk_delete(data: Dict[str, Any], sid: Optional[str] = None):
+    """Deletes the workloads `data` selects, see `select`
+
+    Raises:
+        ValueError: if `data` does not select workloads
+    """
+    return await run("delete", select(data), delete_workload, sid)
+
+
+async def bulk_priority(data: Dict[str, Any], sid: Optional[str] = None):
+    """Sets the priority of the workloads `data` selects to
+    `data["priority"]`, see `select`
+
+    Raises:
+        ValueError: if `data` has no priority or does not select workloads
+    """
+    if data.get("priority") is None:
+        raise ValueError("priority is required")
+    priority = int(data["priority"])
+    return await run(
+        "priority",
+        select(data),
+        lambda namespace, name: set_priority(namespace, name, priority),
+        sid,
+    )
+
+
+@socketio.event
+async def bulk_delete_workloads(sid, data):
+    """Socket.IO variant of `/bulkDelete`, results are sent to the caller"""
+    try:
+        summary = await bulk_delete(data or {}, sid)
+    except ValueError as e:
+        return {"error": str(e)}
+    summary.pop("results")
+    return summary
+
+
+@socketio.event
+async def bulk_update_priority(sid, data):
+    """Socket.IO variant of `/bulkPriority`, results are sent to the caller"""
+    try:
+        summary = await bulk_priority(data or {}, sid)
+    except ValueError as e:
+        return {"error": str(e)}
+    summary.pop("results")
+    return summary
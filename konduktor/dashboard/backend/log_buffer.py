@@ -0,0 +1,259 @@
+"""
+In-memory log buffer
+Keeps the recent logs of a namespace in a bounded, columnar buffer so that
+initial page loads, scroll-back and search are served from memory instead of
+re-querying Loki. Timestamps are an int64 array, stream labels are interned
+and referenced by index, and the text of every line sits in one contiguous
+bytearray. Once the buffer grows past its byte cap, the oldest lines are
+dropped, along with the label sets no line references anymore.
+
+Searches scan the newest lines first, in windows of a bounded number of lines,
+and stop at a deadline, so a slow regex returns the matches found so far
+rather than holding a thread for as long as it takes.
+"""
+
+import array
+import bisect
+import os
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+# bytes of logs kept per namespace
+LOG_BUFFER_BYTES = int(os.environ.get("LOG_BUFFER_BYTES", 16 * 2**20))
+# per line overhead of the timestamp, offset and labels arrays
+_ENTRY_BYTES = 8 + 8 + 4
+# per label set overhead of the dict and its interning key, on top of the
+# characters of its names and values
+_LABEL_SET_BYTES = 256
+# fraction of the cap freed at once, so evictions are amortized
+_EVICT_FRACTION = 0.25
+
+# lines in the first window searched, and in the largest, see
+# `LogBuffer.search`
+_SEARCH_WINDOW_LINES = 1024
+_SEARCH_MAX_WINDOW_LINES = 64 * 1024
+# seconds a search may scan for before returning the matches found so far
+LOG_SEARCH_TIMEOUT_SECONDS = float(os.environ.get("LOG_SEARCH_TIMEOUT_SECONDS", 2))
+# max characters of a search query
+MAX_SEARCH_QUERY_CHARS = 256
+
+# timestamp, stream labels, line
+Entry = Tuple[int, Dict[str, str], str]
+# an entry and the [start, end) character ranges that matched in its line
+Match = Tuple[Entry, List[Tuple[int, int]]]
+
+
+class LogBuffer:
+    """Bounded buffer of log lines, oldest first
+
+    Lines must be appended in timestamp order, which the tails guarantee.
+
+    Args:
+        max_bytes (int, optional): max bytes of text and per line overhead
+    """
+
+    def __init__(self, max_bytes: int = LOG_BUFFER_BYTES):
+        self.max_bytes = max_bytes
+        self._ts = array.array("q")
+        # offset of every line in `_text`, plus `_base`
+        self._starts = array.array("q")
+        self._labels = array.array("i")
+        # lines separated by newlines
+        self._text = bytearray()
+        # bytes evicted from the front of `_text` so far
+        self._base = 0
+        self._label_ids: Dict[Tuple[Tuple[str, str], ...], int] = {}
+        self._label_sets: List[Dict[str, str]] = []
+        # approximate bytes of the interned label sets
+        self._label_bytes = 0
+        # every line logged at or after this timestamp is in the buffer
+        self.complete_since = 0
+
+    def __len__(self) -> int:
+        return len(self._ts)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._text) + len(self._ts) * _ENTRY_BYTES + self._label_bytes
+
+    def _intern(self, labels: Dict[str, str]) -> int:
+        key = tuple(sorted(labels.items()))
+        label_id = self._label_ids.get(key)
+        if label_id is None:
+            label_id = len(self._label_sets)
+            self._label_ids[key] = label_id
+            self._label_sets.append(dict(labels))
+            self._label_bytes += _label_set_bytes(labels)
+        return label_id
+
+    def _compact_labels(self):
+        """Drops the label sets no line references, e.g. of pods that are
+        gone, and renumbers the others
+        """
+        used = sorted(set(self._labels))
+        if len(used) == len(self._label_sets):
+            return
+        ids = {old: new for new, old in enumerate(used)}
+        self._label_sets = [self._label_sets[old] for old in used]
+        self._label_ids = {
+            tuple(sorted(labels.items())): new
+            for new, labels in enumerate(self._label_sets)
+        }
+        self._labels = array.array("i", (ids[old] for old in self._labels))
+        self._label_bytes = sum(map(_label_set_bytes, self._label_sets))
+
+    def append(self, ts: int, labels: Dict[str, str], line: str):
+        self._ts.append(ts)
+        self._starts.append(self._base + len(self._text))
+        self._labels.append(self._intern(labels))
+        self._text += line.encode()
+        self._text += b"\n"
+        if self.nbytes > self.max_bytes:
+            self._evict(int(self.max_bytes * (1 - _EVICT_FRACTION)))
+
+    def _evict(self, target: int):
+        """Drops the oldest lines until at most `target` bytes are used"""
+        excess = self.nbytes - target
+        count = bisect.bisect_left(self._starts, self._base + excess)
+        if count >= len(self._ts):
+            cut = len(self._text)
+        else:
+            cut = self._starts[count] - self._base
+        if count:
+            self.complete_since = max(self.complete_since, self._ts[count - 1] + 1)
+        del self._ts[:count]
+        del self._starts[:count]
+        del self._labels[:count]
+        del self._text[:cut]
+        self._base += cut
+        self._compact_labels()
+
+    def _span(self, i: int) -> Tuple[int, int]:
+        """Byte range of line `i` in `_text`, without its newline"""
+        start = self._starts[i] - self._base
+        if i + 1 < len(self._starts):
+            end = self._starts[i + 1] - self._base - 1
+        else:
+            end = len(self._text) - 1
+        return start, end
+
+    def entry(self, i: int) -> Entry:
+        start, end = self._span(i)
+        line = self._text[start:end].decode(errors="replace")
+        return self._ts[i], self._label_sets[self._labels[i]], line
+
+    def newest(self, limit: int, before: Optional[int] = None) -> List[Entry]:
+        """Up to `limit` of the newest lines logged before `before`, oldest
+        first
+        """
+        end = len(self._ts) if before is None else bisect.bisect_left(self._ts, before)
+        return [self.entry(i) for i in range(max(0, end - limit), end)]
+
+    def since(self, ts: int) -> List[Entry]:
+        """Every line logged after `ts`, oldest first"""
+        start = bisect.bisect_right(self._ts, ts)
+        return [self.entry(i) for i in range(start, len(self._ts))]
+
+    def copy(self) -> "LogBuffer":
+        """Snapshot that can be read from another thread while this buffer
+        keeps changing
+        """
+        snapshot = LogBuffer(self.max_bytes)
+        snapshot._ts = array.array("q", self._ts)
+        snapshot._starts = array.array("q", self._starts)
+        snapshot._labels = array.array("i", self._labels)
+        snapshot._text = bytearray(self._text)
+        snapshot._base = self._base
+        snapshot.complete_since = self.complete_since
+        snapshot._label_sets = list(self._label_sets)
+        snapshot._label_bytes = self._label_bytes
+        return snapshot
+
+    def search(
+        self,
+        pattern: "re.Pattern[bytes]",
+        limit: int,
+        deadline: Optional[float] = None,
+    ) -> Tuple[List[Match], bool]:
+        """Finds the newest `limit` lines matching `pattern`, oldest first
+
+        The contiguous text is scanned backwards in growing windows, so
+        common matches only scan the newest lines.
+
+        Args:
+            pattern (re.Pattern[bytes]): pattern compiled from bytes
+            limit (int): max lines returned
+            deadline (Optional[float], optional): `time.monotonic()` after
+                which no further window is scanned
+
+        Returns:
+            Tuple[List[Match], bool]: matching entries with the character
+            ranges that matched in each line, and whether every line was
+            searched, i.e. the search did not stop at the deadline
+        """
+        spans: Dict[int, List[Tuple[int, int]]] = {}
+        # scan windows of lines from the newest, doubling their size until
+        # enough lines matched
+        end = len(self._ts)
+        window = _SEARCH_WINDOW_LINES
+        complete = True
+        while end > 0 and len(spans) < limit:
+            if deadline is not None and time.monotonic() > deadline:
+                complete = False
+                break
+            start = max(0, end - window)
+            first, _ = self._span(start)
+            _, last = self._span(end - 1)
+            for match in pattern.finditer(self._text, first, last):
+                if match.start() == match.end():
+                    continue
+                i = bisect.bisect_right(self._starts, self._base + match.start()) - 1
+                line_start, line_end = self._span(i)
+                # matches may not cross into the next line
+                if match.end() > line_end:
+                    continue
+                spans.setdefault(i, []).append(
+                    (match.start() - line_start, match.end() - line_start)
+                )
+            end = start
+            window = min(window * 2, _SEARCH_MAX_WINDOW_LINES)
+        matches = []
+        for i in sorted(spans)[-limit:]:
+            line_start, _ = self._span(i)
+            ranges = [
+                (
+                    _char_offset(self._text, line_start, start),
+                    _char_offset(self._text, line_start, end),
+                )
+                for start, end in spans[i]
+            ]
+            matches.append((self.entry(i), ranges))
+        return matches, complete
+
+
+def _label_set_bytes(labels: Dict[str, str]) -> int:
+    return _LABEL_SET_BYTES + sum(len(k) + len(v) for k, v in labels.items())
+
+
+def _char_offset(text: bytearray, line_start: int, byte_offset: int) -> int:
+    """Converts a utf-8 byte offset within a line to a character offset"""
+    return len(text[line_start : line_start + byte_offset].decode(errors="replace"))
+
+
+def search_pattern(
+    query: str, regex: bool = False, ignore_case: bool = True
+) -> "re.Pattern[bytes]":
+    """Compiles a search query for `LogBuffer.search`
+
+    Raises:
+        ValueError: if `query` is longer than `MAX_SEARCH_QUERY_CHARS`
+        re.error: if `regex` is set and `query` is not a valid regex
+    """
+    if len(query) > MAX_SEARCH_QUERY_CHARS:
+        raise ValueError(
+            f"search queries are limited to {MAX_SEARCH_QUERY_CHARS} characters"
+        )
+    source = query.encode() if regex else re.escape(query.encode())
+    flags = re.IGNORECASE if ignore_case else 0
+    return re.compile(source, flags)
@@ -0,0 +1,296 @@
+"""
+Dashboard log queries
+Logs are fetched from Loki with an async HTTP client so that waiting on Loki
+never blocks the event loop serving the REST endpoints and Socket.IO
+heartbeats. Responses are decoded chunk by chunk as they are read, so the
+event loop is never held up decoding a whole page at once and the body is
+never buffered.
+
+Live logs are tailed over Loki's websocket with the same client, on the
+event loop, so a tail takes no thread of its own.
+"""
+
+import asyncio
+import datetime
+import json
+import os
+import time
+import urllib.parse
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+
+import aiohttp
+
+from konduktor import logging as konduktor_logging
+from konduktor import loki_client
+
+from .log_buffer import Entry
+
+QUERY_URL = "/loki/api/v1/query_range"
+TAIL_URL = "/loki/api/v1/tail"
+# "http://loki.loki.svc.cluster.local:3100/loki/api/v1/query_range" for prod
+# "http://localhost:3100/loki/api/v1/query_range" for local
+LOGS_URL = os.environ.get("LOGS_URL", f"http://localhost:3100{QUERY_URL}")
+LOKI_ENDPOINT = LOGS_URL.split(QUERY_URL)[0]
+# max lines per query, Loki rejects more than max_entries_limit_per_query (5000)
+LOGS_PAGE_LIMIT = 1000
+# max lines a tail sends from before it connected
+LOGS_TAIL_LIMIT = 1000
+# seconds between websocket pings of a tail
+LOGS_TAIL_HEARTBEAT_SECONDS = 30
+FORWARD = "forward"
+BACKWARD = "backward"
+
+logger = konduktor_logging.get_logger(__name__)
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def session() -> aiohttp.ClientSession:
+    """Pooled HTTP session, must be used from the event loop it was created on"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=loki_client.POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=loki_client.CONNECT_TIMEOUT,
+                sock_read=loki_client.READ_TIMEOUT,
+            ),
+        )
+    return _session
+
+
+async def close():
+    if _session is not None:
+        await _session.close()
+
+
+def format_log_entry(entry: List[str], namespace: str) -> Dict[str, str]:
+    """
+    Formats a log entry and its corresponding namespace
+
+    Args:
+        entry (List[str]): A list of log entry strings to be formatted.
+        namespace (str): The namespace to apply to each log entry.
+
+    Returns:
+        Dict[str, str]: an object with the following properties:
+        ts (nanoseconds), timestamp, log (message), and namespace
+    """
+    timestamp_ns = entry[0]
+    log_message = entry[1]
+    timestamp_s = int(timestamp_ns) / 1e9
+    dt = datetime.datetime.utcfromtimestamp(timestamp_s)
+    human_readable_time = dt.strftime("%Y-%m-%d %H:%M:%S")
+    formatted_log = {
+        "ts": str(timestamp_ns),
+        "timestamp": human_readable_time,
+        "log": log_message,
+        "namespace": namespace,
+    }
+    return formatted_log
+
+
+def namespace_query(namespaces: Iterable[str]) -> str:
+    namespace_filter = "|".join(sorted(namespaces))
+    return f'{{k8s_namespace_name=~"{namespace_filter}"}}'
+
+
+def format_entries(entries: Iterable[Entry]) -> List[Dict[str, str]]:
+    return [
+        format_log_entry([str(ts), line], labels["k8s_namespace_name"])
+        for ts, labels, line in entries
+    ]
+
+
+def _entry_key(entry: Entry) -> Tuple[Tuple[Tuple[str, str], ...], int, int]:
+    ts, labels, line = entry
+    return tuple(sorted(labels.items())), ts, hash(line)
+
+
+async def _read_entries(response: aiohttp.ClientResponse) -> List[Entry]:
+    """Decodes a query_range response as it is read
+
+    Returns:
+        List[Entry]: entries oldest first
+    """
+    decoder = loki_client.EntryDecoder()
+    entries: List[Entry] = []
+    async for chunk in response.content.iter_chunked(loki_client.CHUNK_BYTES):
+        entries.extend((ts, labels, line) for labels, ts, line in decoder.feed(chunk))
+    entries.extend((ts, labels, line) for labels, ts, line in decoder.close())
+    # sort because sometimes loki API is wrong and logs are out of order
+    entries.sort(key=lambda entry: entry[0])
+    return entries
+
+
+async def _get(url: str, params: Dict[str, Any]) -> Optional[List[Entry]]:
+    """Sends a query_range request, retrying like `loki_client.get`
+
+    Returns:
+        Optional[List[Entry]]: entries oldest first, None if the request failed
+    """
+    path = urllib.parse.urlparse(url).path
+    for attempt in range(loki_client.MAX_RETRIES + 1):
+        start = time.perf_counter()
+        try:
+            async with session().get(url, params=params) as response:
+                if response.status == 200:
+                    entries = await _read_entries(response)
+                else:
+                    body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            loki_client.REQUEST_ERRORS.labels(path, type(e).__name__).inc()
+            logger.debug(f"loki request failed: {e}")
+        else:
+            loki_client.REQUEST_SECONDS.labels(path).observe(
+                time.perf_counter() - start
+            )
+            if response.status == 200:
+                return entries
+            loki_client.REQUEST_ERRORS.labels(path, str(response.status)).inc()
+            if response.status not in loki_client.RETRY_STATUS_CODES:
+                logger.error(f"loki returned {response.status}: {body[:200]!r}")
+                return None
+        if attempt < loki_client.MAX_RETRIES:
+            await asyncio.sleep(loki_client.backoff(attempt))
+    logger.error(f"loki query failed {params}")
+    return None
+
+
+async def iter_logs(
+    namespaces: Iterable[str],
+    start_ns: int,
+    end_ns: int,
+    direction: str = FORWARD,
+    limit: int = LOGS_PAGE_LIMIT,
+) -> AsyncIterator[List[Entry]]:
+    """Pages through every log line of `namespaces` between `start_ns` and
+    `end_ns`, `limit` lines per query
+
+    Each page resumes from the timestamp the previous one ended at rather than
+    one nanosecond past it, so lines sharing that timestamp are not skipped,
+    and the lines already returned at it are dropped.
+
+    Args:
+        namespaces (Iterable[str]): k8s namespaces
+        start_ns (int): nanosecond timestamp to start from, inclusive
+        end_ns (int): nanosecond timestamp to end at, exclusive
+        direction (str, optional): `FORWARD` walks from `start_ns` to
+            `end_ns`, `BACKWARD` from `end_ns` to `start_ns`
+        limit (int, optional): max lines per query
+
+    Yields:
+        List[Entry]: entries oldest first
+    """
+    query = namespace_query(namespaces)
+    logger.debug(f"Loki logs query: {query}")
+    # entries returned at the timestamp the next page starts from
+    boundary: Set[Tuple[Tuple[Tuple[str, str], ...], int, int]] = set()
+    while start_ns < end_ns:
+        params = {
+            "query": query,
+            "start": str(start_ns),
+            "end": str(end_ns),
+            "direction": direction,
+            "limit": str(limit),
+        }
+        entries = await _get(LOGS_URL, params)
+        if entries is None:
+            return
+        keys = [_entry_key(entry) for entry in entries]
+        new = [entry for entry, key in zip(entries, keys) if key not in boundary]
+        if new:
+            yield new
+        if len(entries) < limit:
+            return
+
+        edge_ts = entries[-1][0] if direction == FORWARD else entries[0][0]
+        at_edge = {key for key in keys if key[1] == edge_ts}
+        if not new:
+            # more than `limit` lines share the timestamp, they cannot be paged
+            logger.warning(
+                f"over {limit} log lines at {edge_ts}, skipping the rest of them"
+            )
+            at_edge = set()
+            edge_ts = edge_ts + 1 if direction == FORWARD else edge_ts - 1
+        boundary = at_edge | {key for key in boundary if key[1] == edge_ts}
+        if direction == FORWARD:
+            start_ns = edge_ts
+        else:
+            end_ns = edge_ts + 1
+
+
+def _tail_entries(message: str) -> List[Entry]:
+    """Entries of a tail message, oldest first"""
+    data = json.loads(message)
+    dropped = data.get("dropped_entries") or []
+    if dropped:
+        logger.warning(f"loki tail dropped {len(dropped)} entries")
+    entries = [
+        (int(ts), stream["stream"], line)
+        for stream in data.get("streams") or []
+        for ts, line in stream["values"]
+    ]
+    entries.sort(key=lambda entry: entry[0])
+    return entries
+
+
+async def tail_logs(
+    namespaces: Iterable[str], start_ns: int
+) -> AsyncIterator[List[Entry]]:
+    """Tails the logs of `namespaces` logged from `start_ns` on, until the
+    iterator is closed
+
+    The websocket is reconnected with backoff whenever it fails or Loki
+    closes it, resuming from the newest line received. Lines at that
+    timestamp that were already received are dropped.
+
+    Yields:
+        List[Entry]: entries of a tail message, oldest first
+    """
+    query = namespace_query(namespaces)
+    ws_endpoint = LOKI_ENDPOINT.replace("https://", "wss://", 1).replace(
+        "http://", "ws://", 1
+    )
+    # entries received at `start_ns`
+    boundary: Set[Tuple[Tuple[Tuple[str, str], ...], int, int]] = set()
+    attempt = 0
+    while True:
+        params = {
+            "query": query,
+            "start": str(start_ns),
+            "limit": str(LOGS_TAIL_LIMIT),
+            "delay_for": "0",
+        }
+        try:
+            async with session().ws_connect(
+                f"{ws_endpoint}{TAIL_URL}",
+                params=params,
+                heartbeat=LOGS_TAIL_HEARTBEAT_SECONDS,
+                # a quiet namespace sends nothing for a long time
+                receive_timeout=None,
+            ) as ws:
+                logger.debug(f"tailing loki logs: {query}")
+                async for message in ws:
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    attempt = 0
+                    keys = []
+                    new = []
+                    for entry in _tail_entries(message.data):
+                        key = _entry_key(entry)
+                        if key not in boundary:
+                            keys.append(key)
+                            new.append(entry)
+                    if not new:
+                        continue
+                    newest = new[-1][0]
+                    if newest > start_ns:
+                        start_ns = newest
+                        boundary = set()
+                    boundary.update(key for key in keys if key[1] == start_ns)
+                    yield new
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning(f"loki tail failed: {e}")
+        await asyncio.sleep(loki_client.backoff(attempt))
+        attempt += 1
@@ -1,21 +1,40 @@
-from typing import Any, Dict, List
-
+import asyncio
+import contextlib
+import re
+import threading
+import time
+from typing import List, Optional
+
+import prometheus_client
 import socketio
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from kubernetes import client
 from kubernetes.client.exceptions import ApiException
 
 from konduktor import logging as konduktor_logging
 from konduktor.kube_client import batch_api, core_api, crd_api
 
+from . import bulk, log_buffer, logs
+from .sockets import log_subscriptions, publish_workloads
 from .sockets import socketio as sio
+from .workloads import workload_cache
 
 logger = konduktor_logging.get_logger(__name__)
 
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    stop = threading.Event()
+    publish_workloads()
+    workload_cache.start(stop)
+    yield
+    stop.set()
+    await logs.close()
+
+
 # FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
 # CORS Configuration
@@ -27,6 +46,9 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
+# Loki client request metrics
+app.mount("/metrics", prometheus_client.make_asgi_app())
+
 # Use Kubernetes API clients
 # Initialize BatchV1 and CoreV1 API (native kubernetes)
 batch_client = batch_api()
@@ -47,16 +69,7 @@ async def delete_job(request: Request):
     namespace = data.get("namespace", "default")
 
     try:
-        delete_options = client.V1DeleteOptions(propagation_policy="Background")
-
-        crd_client.delete_namespaced_custom_object(
-            group="kueue.x-k8s.io",
-            version="v1beta1",
-            namespace=namespace,
-            plural="workloads",
-            name=name,
-            body=delete_options,
-        )
+        await asyncio.to_thread(bulk.delete_workload, namespace, name)
         logger.debug(f"Kueue Workload '{name}' deleted successfully.")
 
         return JSONResponse({"success": True, "status": 200})
@@ -66,10 +79,103 @@ async def delete_job(request: Request):
         return JSONResponse({"error": str(e)}, status_code=e.status)
 
 
+@app.post("/bulkDelete")
+async def bulk_delete(request: Request):
+    """Deletes workloads by name or selector, see `bulk.select`. Results are
+    returned once every workload is done, the `bulk_delete_workloads`
+    Socket.IO event streams them as they complete.
+    """
+    data = await request.json()
+    try:
+        summary = await bulk.bulk_delete(data)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse(summary)
+
+
 @app.get("/getJobs")
-async def get_jobs():
-    rows = fetch_jobs()
-    return JSONResponse(rows)
+async def get_jobs(
+    request: Request,
+    namespace: Optional[str] = None,
+    status: Optional[str] = None,
+    localQueueName: Optional[str] = None,
+    offset: int = 0,
+    limit: Optional[int] = None,
+):
+    etag = workload_cache.etag
+    if etag is None:
+        # stale until the cache relists, so never cached
+        headers = {"Cache-Control": "no-store"}
+    else:
+        headers = {"ETag": etag}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+    rows, total = workload_cache.query(
+        namespace=namespace,
+        status=status,
+        queue=localQueueName,
+        offset=offset,
+        limit=limit,
+    )
+    headers["X-Total-Count"] = str(total)
+    return JSONResponse(rows, headers=headers)
+
+
+@app.get("/queueStats")
+async def queue_stats():
+    """Capacity planning aggregates of the cached workloads: admitted and
+    pending counts, wait time percentiles and priority inversions per
+    LocalQueue and ClusterQueue
+    """
+    stats = await asyncio.to_thread(workload_cache.queue_stats)
+    return JSONResponse(stats)
+
+
+@app.get("/getLogs")
+async def get_logs(
+    namespace: List[str] = Query(default=["default"]),
+    before: Optional[int] = None,
+    limit: int = Query(default=logs.LOGS_PAGE_LIMIT, gt=0, le=5000),
+):
+    """Scroll-back: the newest `limit` logs of the namespaces logged before
+    `before` (nanoseconds, as in each log's `ts`), oldest first
+    """
+    if before is None:
+        before = time.time_ns()
+    entries = await log_subscriptions.history(namespace, before, limit)
+    return JSONResponse(logs.format_entries(entries))
+
+
+@app.get("/searchLogs")
+async def search_logs(
+    query: str,
+    namespace: List[str] = Query(default=["default"]),
+    regex: bool = False,
+    ignoreCase: bool = True,
+    limit: int = Query(default=100, gt=0, le=5000),
+):
+    """Searches the logs held in memory for the namespaces being viewed
+
+    Returns the newest `limit` matching logs, oldest first, each with the
+    `[start, end)` character ranges of the matches in its line. Searches
+    that time out return the matches found so far, with an
+    `X-Search-Truncated: true` header.
+    """
+    try:
+        pattern = log_buffer.search_pattern(query, regex, ignoreCase)
+    except re.error as e:
+        return JSONResponse({"error": f"invalid regex: {e}"}, status_code=400)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    matches, complete = await log_subscriptions.search(namespace, pattern, limit)
+    formatted_logs = logs.format_entries(entry for entry, _ in matches)
+    return JSONResponse(
+        [
+            {**formatted, "ranges": ranges}
+            for formatted, (_, ranges) in zip(formatted_logs, matches)
+        ],
+        headers={"X-Search-Truncated": str(not complete).lower()},
+    )
 
 
 @app.get("/getNamespaces")
@@ -93,24 +199,7 @@ async def update_priority(request: Request):
     priority = data.get("priority", 0)
 
     try:
-        job = crd_client.get_namespaced_custom_object(
-            group="kueue.x-k8s.io",
-            version="v1beta1",
-            namespace=namespace,
-            plural="workloads",
-            name=name,
-        )
-
-        job["spec"]["priority"] = priority
-
-        crd_client.patch_namespaced_custom_object(
-            group="kueue.x-k8s.io",
-            version="v1beta1",
-            namespace=namespace,
-            plural="workloads",
-            name=name,
-            body=job,
-        )
+        await asyncio.to_thread(bulk.set_priority, namespace, name, priority)
         return JSONResponse({"success": True, "status": 200})
 
     except ApiException as e:
@@ -118,52 +207,18 @@ async def update_priority(request: Request):
         return JSONResponse({"error": str(e)}, status_code=e.status)
 
 
-# Get a listing of workloads in kueue
-def fetch_jobs():
-    listing = crd_client.list_namespaced_custom_object(
-        group="kueue.x-k8s.io",
-        version="v1beta1",
-        namespace="default",
-        plural="workloads",
-    )
-
-    return format_workloads(listing)
-
-
-def format_workloads(listing: Dict[str, Any]) -> List[Dict[str, Any]]:
-    if not listing:
-        return []
-
-    res = []
-
-    for job in listing["items"]:
-        id = job["metadata"]["uid"]
-        name = job["metadata"]["name"]
-        created_at = job["metadata"]["creationTimestamp"]
-        namespace = job["metadata"]["namespace"]
-        localQueueName = job["spec"].get("queueName", "Unknown")
-        priority = job["spec"]["priority"]
-        active = job["spec"].get("active", 0)
-        status = "ADMITTED" if "admission" in job.get("status", {}) else "PENDING"
-
-        statusVal = 1 if "admission" in job.get("status", {}) else 0
-        order = (statusVal * 10) + priority
-
-        res.append(
-            {
-                "id": id,
-                "name": name,
-                "namespace": namespace,
-                "localQueueName": localQueueName,
-                "priority": priority,
-                "status": status,
-                "active": active,
-                "created_at": created_at,
-                "order": order,
-            }
-        )
-
-    return res
+@app.put("/bulkPriority")
+async def bulk_priority(request: Request):
+    """Sets the `priority` of workloads by name or selector, see
+    `bulk.select`. Results are returned once every workload is done, the
+    `bulk_update_priority` Socket.IO event streams them as they complete.
+    """
+    data = await request.json()
+    try:
+        summary = await bulk.bulk_priority(data)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse(summary)
 
 
 app = socketio.ASGIApp(sio, app)
@@ -0,0 +1,394 @@
+"""
+Kueue queue statistics
+Keeps the fields of every cached workload that capacity planning needs in
+columnar NumPy arrays, creation and admission times, priorities and queue ids,
+one slot per workload. Watch events update a single slot, so aggregating tens
+of thousands of workloads is a few vectorized passes rather than a walk over
+the formatted rows.
+
+Pending workloads do not name their ClusterQueue, so it is learned from the
+admitted workloads of their LocalQueue.
+
+A priority inversion is a pending workload that has been waiting while a
+lower priority workload of the same ClusterQueue was admitted.
+"""
+
+import datetime
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# percentiles of wait times reported for each queue
+PERCENTILES = [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0)]
+# priority inversions listed for each ClusterQueue, highest priority first
+MAX_INVERSIONS = 20
+# queue name of workloads whose queue is not known
+UNKNOWN = "Unknown"
+# slots allocated at first, doubled whenever they run out
+INITIAL_CAPACITY = 1024
+
+_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def _timestamp(value: Optional[str]) -> float:
+    """Seconds since the epoch of a Kubernetes timestamp, NaN if unset"""
+    if not value:
+        return np.nan
+    # fromisoformat only accepts `Z` from python 3.11 on
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def admission_time(job: Dict[str, Any]) -> float:
+    """When a workload was admitted, NaN if it is pending or the time is not
+    known
+    """
+    for condition in job.get("status", {}).get("conditions") or []:
+        if condition.get("type") == "Admitted" and condition.get("status") == "True":
+            return _timestamp(condition.get("lastTransitionTime"))
+    return np.nan
+
+
+class _Interned:
+    """Ids of names, assigned in order of first use"""
+
+    def __init__(self):
+        self.names: List[str] = []
+        self._ids: Dict[str, int] = {}
+
+    def id(self, name: str) -> int:
+        id_ = self._ids.get(name)
+        if id_ is None:
+            id_ = self._ids[name] = len(self.names)
+            self.names.append(name)
+        return id_
+
+
+def _percentiles(
+    groups: np.ndarray, values: np.ndarray, num_groups: int
+) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """Nearest rank percentiles of `values` in each of `num_groups` groups
+
+    Returns:
+        Tuple[np.ndarray, Dict[str, np.ndarray]]: values per group, and each
+        of `PERCENTILES` per group, NaN for empty groups
+    """
+    # stable sorts by value and then group, faster than lexsort
+    order = np.argsort(values, kind="stable")
+    order = order[np.argsort(groups[order], kind="stable")]
+    sorted_values = values[order]
+    counts = np.bincount(groups, minlength=num_groups)
+    starts = np.cumsum(counts) - counts
+    nonempty = counts > 0
+    result = {}
+    for name, q in PERCENTILES:
+        column = np.full(num_groups, np.nan)
+        ranks = starts + np.floor((counts - 1) * q).astype(np.int64)
+        column[nonempty] = sorted_values[ranks[nonempty]]
+        result[name] = column
+    return counts, result
+
+
+def _summary(counts: np.ndarray, percentiles: Dict[str, np.ndarray], group: int):
+    """Wait times of a group as JSON, None if it is empty"""
+    if not counts[group]:
+        return None
+    return {
+        name: round(float(column[group]), 3) for name, column in percentiles.items()
+    }
+
+
+# column -> (dtype, value of unused slots)
+_COLUMNS: Dict[str, Tuple[Any, Any]] = {
+    "used": (bool, False),
+    "admitted": (bool, False),
+    "created_at": (np.float64, np.nan),
+    "admitted_at": (np.float64, np.nan),
+    "priority": (np.int64, 0),
+    "local_queue": (np.int32, 0),
+    "cluster_queue": (np.int32, -1),
+}
+
+
+class QueueColumns:
+    """Columnar copy of the workloads of a `WorkloadCache`, not thread safe
+
+    Attributes:
+        used (np.ndarray): whether a slot holds a workload
+        admitted (np.ndarray): whether the workload was admitted
+        created_at (np.ndarray): creation time in seconds
+        admitted_at (np.ndarray): admission time in seconds, NaN if pending
+            or not known
+        priority (np.ndarray): workload priority
+        local_queue (np.ndarray): id of the `namespace/LocalQueue`
+        cluster_queue (np.ndarray): id of the ClusterQueue it was admitted
+            to, -1 if pending
+    """
+
+    used: np.ndarray
+    admitted: np.ndarray
+    created_at: np.ndarray
+    admitted_at: np.ndarray
+    priority: np.ndarray
+    local_queue: np.ndarray
+    cluster_queue: np.ndarray
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY):
+        self._slots: Dict[str, int] = {}
+        self._free: List[int] = list(range(capacity - 1, -1, -1))
+        # slot -> `namespace/name`, for listing inversions
+        self._names: List[Optional[str]] = [None] * capacity
+        for column, (dtype, fill) in _COLUMNS.items():
+            setattr(self, column, np.full(capacity, fill, dtype=dtype))
+        self._local_queues = _Interned()
+        self._cluster_queues = _Interned()
+        # local queue id -> cluster queue id its workloads were admitted to
+        self._routes: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _grow(self):
+        capacity = len(self.used)
+        self._names.extend([None] * capacity)
+        for column, (dtype, fill) in _COLUMNS.items():
+            grown = np.full(capacity * 2, fill, dtype=dtype)
+            grown[:capacity] = getattr(self, column)
+            setattr(self, column, grown)
+        self._free.extend(range(capacity * 2 - 1, capacity - 1, -1))
+
+    def update(self, uid: str, job: Dict[str, Any]):
+        """Adds or updates the columns of a workload"""
+        slot = self._slots.get(uid)
+        if slot is None:
+            if not self._free:
+                self._grow()
+            slot = self._slots[uid] = self._free.pop()
+        metadata, spec, status = job["metadata"], job["spec"], job.get("status", {})
+        namespace = metadata["namespace"]
+        local_queue = self._local_queues.id(
+            f"{namespace}/{spec.get('queueName', UNKNOWN)}"
+        )
+        cluster_queue = -1
+        cluster_queue_name = (status.get("admission") or {}).get("clusterQueue")
+        if cluster_queue_name:
+            cluster_queue = self._cluster_queues.id(cluster_queue_name)
+            self._routes[local_queue] = cluster_queue
+        self._names[slot] = f"{namespace}/{metadata['name']}"
+        self.used[slot] = True
+        self.admitted[slot] = "admission" in status
+        self.created_at[slot] = _timestamp(metadata.get("creationTimestamp"))
+        self.admitted_at[slot] = admission_time(job)
+        self.priority[slot] = spec.get("priority", 0)
+        self.local_queue[slot] = local_queue
+        self.cluster_queue[slot] = cluster_queue
+
+    def remove(self, uid: str):
+        slot = self._slots.pop(uid, None)
+        if slot is None:
+            return
+        self._names[slot] = None
+        self.used[slot] = False
+        self._free.append(slot)
+
+    def copy(self) -> "QueueColumns":
+        """Copy to aggregate while the original keeps being updated"""
+        copied = QueueColumns(capacity=0)
+        copied._slots = dict(self._slots)
+        copied._free = list(self._free)
+        copied._names = list(self._names)
+        for column in _COLUMNS:
+            setattr(copied, column, getattr(self, column).copy())
+        copied._local_queues.names = list(self._local_queues.names)
+        copied._cluster_queues.names = list(self._cluster_queues.names)
+        copied._routes = dict(self._routes)
+        return copied
+
+    def stats(self, now: Optional[float] = None) -> Dict[str, Any]:
+        """Admitted and pending counts, wait times and priority inversions
+        per LocalQueue and ClusterQueue
+
+        Wait times are in seconds, from creation to admission for admitted
+        workloads and from creation to `now` for pending ones.
+        """
+        now = time.time() if now is None else now
+        slots = np.flatnonzero(self.used)
+        admitted = self.admitted[slots]
+        created_at = self.created_at[slots]
+        admitted_at = self.admitted_at[slots]
+        priority = self.priority[slots]
+        local_queue = self.local_queue[slots]
+
+        local_names = self._local_queues.names
+        cluster_names = [*self._cluster_queues.names, UNKNOWN]
+        unknown = len(cluster_names) - 1
+        routes: np.ndarray = np.full(len(local_names) or 1, unknown, dtype=np.int32)
+        for local, cluster in self._routes.items():
+            routes[local] = cluster
+        cluster_queue = self.cluster_queue[slots]
+        cluster_queue = np.where(cluster_queue >= 0, cluster_queue, routes[local_queue])
+
+        waited = ~np.isnan(created_at) & np.where(
+            admitted, ~np.isnan(admitted_at), True
+        )
+        wait = np.where(admitted, admitted_at, now) - created_at
+
+        def aggregate(groups: np.ndarray, num_groups: int):
+            counts = np.bincount(groups[admitted], minlength=num_groups)
+            pending = np.bincount(groups[~admitted], minlength=num_groups)
+            done = waited & admitted
+            waiting = waited & ~admitted
+            wait_counts, waits = _percentiles(groups[done], wait[done], num_groups)
+            age_counts, ages = _percentiles(groups[waiting], wait[waiting], num_groups)
+            return [
+                {
+                    "admitted": int(counts[group]),
+                    "pending": int(pending[group]),
+                    "waitSeconds": _summary(wait_counts, waits, group),
+                    "pendingSeconds": _summary(age_counts, ages, group),
+                }
+                for group in range(num_groups)
+            ]
+
+        local_stats = aggregate(local_queue, len(local_names))
+        for name, stats, route in zip(local_names, local_stats, routes):
+            namespace, _, queue = name.partition("/")
+            stats.update(
+                namespace=namespace,
+                localQueueName=queue,
+                clusterQueue=cluster_names[route],
+            )
+        cluster_stats = aggregate(cluster_queue, len(cluster_names))
+        for group, (name, stats) in enumerate(zip(cluster_names, cluster_stats)):
+            stats["name"] = name
+            stats["priorityInversions"] = self._inversions(
+                slots,
+                cluster_queue == group,
+                admitted,
+                created_at,
+                admitted_at,
+                priority,
+            )
+        return {
+            "total": int(len(slots)),
+            "admitted": int(admitted.sum()),
+            "pending": int((~admitted).sum()),
+            "localQueues": [
+                stats for stats in local_stats if stats["admitted"] or stats["pending"]
+            ],
+            "clusterQueues": [
+                stats
+                for stats in cluster_stats
+                if stats["admitted"] or stats["pending"]
+            ],
+        }
+
+    def _inversions(
+        self,
+        slots: np.ndarray,
+        in_queue: np.ndarray,
+        admitted: np.ndarray,
+        created_at: np.ndarray,
+        admitted_at: np.ndarray,
+        priority: np.ndarray,
+    ) -> Dict[str, Any]:
+        """Pending workloads of a ClusterQueue that waited while a lower
+        priority workload was admitted
+        """
+        done = in_queue & admitted & ~np.isnan(admitted_at)
+        waiting = in_queue & ~admitted & ~np.isnan(created_at)
+        inversions: Dict[str, Any] = {"count": 0, "workloads": []}
+        if not done.any() or not waiting.any():
+            return inversions
+        order = np.argsort(admitted_at[done], kind="stable")
+        done_slots = slots[done][order]
+        done_at = admitted_at[done][order]
+        done_priority = priority[done][order]
+        # lowest priority admitted from each admission onwards
+        lowest_after = np.minimum.accumulate(done_priority[::-1])[::-1]
+
+        waiting_slots = slots[waiting]
+        waiting_priority = priority[waiting]
+        first = done_at.searchsorted(created_at[waiting], side="right")
+        has_later = first < len(done_at)
+        inverted: np.ndarray = np.zeros(len(first), dtype=bool)
+        inverted[has_later] = (
+            lowest_after[first[has_later]] < waiting_priority[has_later]
+        )
+        inversions["count"] = int(inverted.sum())
+        listed = np.flatnonzero(inverted)
+        listed = listed[np.argsort(-waiting_priority[listed], kind="stable")]
+        for i in listed[:MAX_INVERSIONS]:
+            # the lowest priority workload admitted while this one waited
+            j = first[i] + int(np.argmin(done_priority[first[i] :]))
+            inversions["workloads"].append(
+                {
+                    "pending": self._names[waiting_slots[i]],
+                    "priority": int(waiting_priority[i]),
+                    "admitted": self._names[done_slots[j]],
+                    "admittedPriority": int(done_priority[j]),
+                    "admittedAt": float(done_at[j]),
+                }
+            )
+        return inversions
+
+
+if __name__ == "__main__":
+    import random
+
+    def _iso(ts: float) -> str:
+        return time.strftime(_TIME_FORMAT, time.gmtime(ts))
+
+    random.seed(0)
+    now = time.time()
+    columns = QueueColumns()
+    jobs = []
+    for i in range(50_000):
+        team = i % 20
+        created = now - random.uniform(0, 86400)
+        job: Dict[str, Any] = {
+            "metadata": {
+                "uid": f"uid-{i}",
+                "name": f"workload-{i}",
+                "namespace": f"team-{team}",
+                "creationTimestamp": _iso(created),
+            },
+            "spec": {"queueName": "user-queue", "priority": random.choice([0, 100])},
+            "status": {},
+        }
+        if random.random() < 0.7:
+            admitted_at = created + random.expovariate(1 / 600)
+            job["status"] = {
+                "admission": {"clusterQueue": f"cluster-queue-{team % 4}"},
+                "conditions": [
+                    {
+                        "type": "Admitted",
+                        "status": "True",
+                        "lastTransitionTime": _iso(admitted_at),
+                    }
+                ],
+            }
+        jobs.append(job)
+
+    start = time.perf_counter()
+    for job in jobs:
+        columns.update(job["metadata"]["uid"], job)
+    print(
+        f"added {len(columns)} workloads in "
+        f"{(time.perf_counter() - start) * 1000:.0f}ms"
+    )
+    start = time.perf_counter()
+    for job in jobs[:1000]:
+        job["spec"]["priority"] += 1
+        columns.update(job["metadata"]["uid"], job)
+    print(f"updated 1000 workloads in {(time.perf_counter() - start) * 1000:.1f}ms")
+    start = time.perf_counter()
+    stats = columns.copy().stats()
+    print(f"aggregated in {(time.perf_counter() - start) * 1000:.1f}ms")
+    print({key: stats[key] for key in ("total", "admitted", "pending")})
+    for cluster_queue in stats["clusterQueues"]:
+        print(
+            cluster_queue["name"],
+            cluster_queue["waitSeconds"],
+            f"{cluster_queue['priorityInversions']['count']} inversions",
+        )
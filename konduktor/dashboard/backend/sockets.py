@@ -1,14 +1,17 @@
 import asyncio
-import datetime
-import os
+import heapq
+import re
 import time
-from typing import Dict, List
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
-import requests
 from socketio import AsyncServer  # Import the AsyncServer for ASGI compatibility
 
 from konduktor import logging as konduktor_logging
 
+from . import log_buffer, logs
+from .log_buffer import Entry, LogBuffer, Match
+from .workloads import SYNC, workload_cache
+
 # SocketIO configuration
 socketio = AsyncServer(
     cors_allowed_origins="*", ping_interval=25, ping_timeout=60, async_mode="asgi"
@@ -16,139 +19,381 @@ socketio = AsyncServer(
 
 logger = konduktor_logging.get_logger(__name__)
 
-# Global variables
-CLIENT_CONNECTED = False
-FIRST_RUN = True
-BACKGROUND_TASK_RUNNING = False
-LOG_CHECKPOINT_TIME = None
-SELECTED_NAMESPACES: list[str] = []
-
-# "http://loki.loki.svc.cluster.local:3100/loki/api/v1/query_range" for prod
-# "http://localhost:3100/loki/api/v1/query_range" for local
-LOGS_URL = os.environ.get("LOGS_URL", "http://localhost:3100/loki/api/v1/query_range")
+# clients subscribed to workload changes
+WORKLOADS_ROOM = "workloads"
+
+# seconds of logs sent to a client when it starts viewing a namespace
+LOGS_BACKFILL_SECONDS = 3600
+# max lines of history sent to a client that has no checkpoint
+LOGS_BACKFILL_MAX_LINES = 5000
+# seconds before the oldest line a client has that scroll-back reaches into
+LOGS_HISTORY_SECONDS = 24 * 3600
+# seconds between batches of tailed lines sent to a namespace's viewers
+LOGS_EMIT_SECONDS = 1
+# namespace viewed by clients that did not select any
+DEFAULT_NAMESPACE = "default"
+# searches scanning buffered logs at once, later ones wait for a free slot
+LOG_SEARCH_CONCURRENCY = 4
+
+
+def logs_room(namespace: str) -> str:
+    return f"logs:{namespace}"
+
+
+def _merge_newest(
+    buffers: List[LogBuffer], limit: int, before: Optional[int]
+) -> List[Entry]:
+    """Newest `limit` lines across `buffers` logged before `before`"""
+    entries = heapq.merge(
+        *(buffer.newest(limit, before) for buffer in buffers),
+        key=lambda entry: entry[0],
+    )
+    return list(entries)[-limit:]
 
 
-def format_log_entry(entry: List[str], namespace: str) -> Dict[str, str]:
+def _search(
+    buffers: List[LogBuffer], pattern: "re.Pattern[bytes]", limit: int
+) -> Tuple[List[Match], bool]:
+    """Newest `limit` matches across `buffers`, and whether every line was
+    searched within `log_buffer.LOG_SEARCH_TIMEOUT_SECONDS`
     """
-    Formats a log entry and its corresponding namespace
+    deadline = time.monotonic() + log_buffer.LOG_SEARCH_TIMEOUT_SECONDS
+    results = [buffer.search(pattern, limit, deadline) for buffer in buffers]
+    matches = heapq.merge(
+        *(found for found, _ in results),
+        key=lambda match: match[0][0],
+    )
+    return list(matches)[-limit:], all(complete for _, complete in results)
 
-    Args:
-        entry (List[str]): A list of log entry strings to be formatted.
-        namespace (str): The namespace to apply to each log entry.
 
-    Returns:
-        Dict[str, str]: an object with the following properties:
-        timestamp, log (message), and namespace
-    """
-    timestamp_ns = entry[0]
-    log_message = entry[1]
-    timestamp_s = int(timestamp_ns) / 1e9
-    dt = datetime.datetime.utcfromtimestamp(timestamp_s)
-    human_readable_time = dt.strftime("%Y-%m-%d %H:%M:%S")
-    formatted_log = {
-        "timestamp": human_readable_time,
-        "log": log_message,
-        "namespace": namespace,
-    }
-    return formatted_log
-
-
-def get_logs(FIRST_RUN: bool) -> List[Dict[str, str]]:
-    global LOG_CHECKPOINT_TIME
-
-    logger.debug(f"Selected namespaces: {SELECTED_NAMESPACES}")
-
-    # Use the selected namespaces in the query
-    namespace_filter = (
-        "|".join(SELECTED_NAMESPACES) if SELECTED_NAMESPACES else "default"
-    )
-    query = f'{{k8s_namespace_name=~"{namespace_filter}"}}'
-
-    logger.debug(f"Loki logs query: {query}")
-
-    if FIRST_RUN:
-        # Calculate how many nanoseconds to look back when first time looking at logs
-        # (currently 1 hour)
-        now = int(time.time() * 1e9)
-        one_hour_ago = now - int(3600 * 1e9)
-        start_time = str(one_hour_ago)
-    else:
-        # calculate new start_time based on newest, last message
-        if LOG_CHECKPOINT_TIME is None:
-            LOG_CHECKPOINT_TIME = 0
-        start_time = str(int(LOG_CHECKPOINT_TIME) + 1)
-
-    params = {"query": query, "start": start_time, "limit": "300"}
-
-    url = LOGS_URL
-    response = requests.get(url, params=params)
-    formatted_logs = []
-
-    last = 0
-
-    if response.status_code == 200:
-        data = response.json()
-        rows = data["data"]["result"]
-
-        for row in rows:
-            namespace = row["stream"]["k8s_namespace_name"]
-            for value in row["values"]:
-                last = max(int(value[0]), last)
-                formatted_logs.append(format_log_entry(value, namespace))
-
-    if formatted_logs:
-        # sort because sometimes loki API is wrong and logs are out of order
-        formatted_logs.sort(
-            key=lambda log: datetime.datetime.strptime(
-                log["timestamp"], "%Y-%m-%d %H:%M:%S"
-            )
-        )
-        LOG_CHECKPOINT_TIME = last
+class NamespaceTail:
+    """A single Loki tail of a namespace, shared by every client viewing it
 
-    logger.debug(f"Formatted logs length: {len(formatted_logs)}")
+    The recent logs of the namespace are first loaded into a `LogBuffer`.
+    Tailed lines are received on the event loop, see `logs.tail_logs`, and
+    are added to the buffer and sent to the namespace's room in batches
+    every `LOGS_EMIT_SECONDS`.
+    """
 
-    return formatted_logs
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self.room = logs_room(namespace)
+        self.start_ns = time.time_ns()
+        self.buffer = LogBuffer()
+        # set once the logs from before the tail started are in the buffer
+        self.seeded = asyncio.Event()
+        self._pending: List[Entry] = []
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self._tasks = [
+            asyncio.create_task(self._tail()),
+            asyncio.create_task(self._run()),
+        ]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+
+    async def _tail(self):
+        async for entries in logs.tail_logs([self.namespace], self.start_ns):
+            self._pending.extend(entries)
+
+    async def _run(self):
+        try:
+            await self._seed()
+        finally:
+            self.seeded.set()
+        await self._emit()
+
+    async def _seed(self):
+        """Loads the newest logs from before the tail started, up to the
+        buffer's capacity
+        """
+        window_start = self.start_ns - LOGS_BACKFILL_SECONDS * 10**9
+        pages: List[List[Entry]] = []
+        size = 0
+        async for page in logs.iter_logs(
+            [self.namespace], window_start, self.start_ns, direction=logs.BACKWARD
+        ):
+            pages.append(page)
+            size += sum(len(line) for _, _, line in page)
+            if size >= self.buffer.max_bytes:
+                break
+        else:
+            self.buffer.complete_since = window_start
+        for page in reversed(pages):
+            for entry in page:
+                self.buffer.append(*entry)
+        if not self.buffer.complete_since and pages:
+            self.buffer.complete_since = pages[-1][0][0] + 1
+
+    async def _emit(self):
+        while True:
+            await asyncio.sleep(LOGS_EMIT_SECONDS)
+            if not self._pending:
+                continue
+            batch, self._pending = self._pending, []
+            # each message is in order, but not across messages
+            batch.sort(key=lambda entry: entry[0])
+            for entry in batch:
+                self.buffer.append(*entry)
+            await socketio.emit("log_data", logs.format_entries(batch), room=self.room)
+
+
+class LogSubscriptions:
+    """Tracks the namespaces each client views
+
+    Every distinct namespace is tailed once no matter how many clients view
+    it, and the tail is stopped when its last viewer leaves. A client that
+    starts viewing a namespace is first sent its recent logs from the tail's
+    buffer, starting after the client's checkpoint if it has one.
+    """
 
+    def __init__(self):
+        self.namespaces: Dict[str, Set[str]] = {}
+        # newest log timestamp sent to each client outside of the tails
+        self.checkpoints: Dict[str, int] = {}
+        self._tails: Dict[str, NamespaceTail] = {}
+        # created on first use, within the server's event loop
+        self._searches: Optional[asyncio.Semaphore] = None
+
+    def viewers(self, namespace: str) -> int:
+        return sum(namespace in viewed for viewed in self.namespaces.values())
+
+    async def subscribe(
+        self, sid: str, namespaces: Iterable[str], checkpoint: Optional[int] = None
+    ):
+        """Sets the namespaces `sid` views"""
+        new = set(namespaces) or {DEFAULT_NAMESPACE}
+        old = self.namespaces.get(sid, set())
+        self.namespaces[sid] = new
+        for namespace in old - new:
+            await socketio.leave_room(sid, logs_room(namespace))
+        added = new - old
+        for namespace in added:
+            await socketio.enter_room(sid, logs_room(namespace))
+        self._reconcile()
+        if added:
+            await self._backfill(sid, added, checkpoint)
+
+    async def unsubscribe(self, sid: str):
+        """Forgets `sid`, stopping tails nobody else views"""
+        self.namespaces.pop(sid, None)
+        self.checkpoints.pop(sid, None)
+        self._reconcile()
+
+    def _reconcile(self):
+        viewed = set().union(*self.namespaces.values())
+        for namespace in viewed - self._tails.keys():
+            logger.debug(f"tailing logs of namespace {namespace}")
+            self._tails[namespace] = NamespaceTail(namespace)
+            self._tails[namespace].start()
+        for namespace in self._tails.keys() - viewed:
+            logger.debug(f"no clients view namespace {namespace}, stopping its tail")
+            self._tails.pop(namespace).stop()
+
+    async def _buffers(self, namespaces: Iterable[str]) -> Optional[List[LogBuffer]]:
+        """Buffers of `namespaces`, None unless every namespace is tailed"""
+        tails = [self._tails.get(namespace) for namespace in namespaces]
+        buffers = []
+        for namespace_tail in tails:
+            if namespace_tail is None:
+                return None
+            await namespace_tail.seeded.wait()
+            buffers.append(namespace_tail.buffer)
+        return buffers
+
+    async def _backfill(
+        self, sid: str, namespaces: Set[str], checkpoint: Optional[int]
+    ):
+        """Sends the recent logs of `namespaces` to a new viewer
+
+        Clients resuming from a checkpoint get every line after it in order,
+        from Loki if the buffers do not reach back that far. Others get up to
+        `LOGS_BACKFILL_MAX_LINES` of the newest buffered lines as
+        `log_history`, newest page first, to prepend to what they have.
+        """
+        # everything logged from now on is sent to the rooms
+        now = time.time_ns()
+        buffers = await self._buffers(namespaces)
+        if checkpoint is None:
+            entries = _merge_newest(buffers or [], LOGS_BACKFILL_MAX_LINES, now)
+            for end in range(len(entries), 0, -logs.LOGS_PAGE_LIMIT):
+                page = entries[max(0, end - logs.LOGS_PAGE_LIMIT) : end]
+                await socketio.emit("log_history", logs.format_entries(page), to=sid)
+            if entries:
+                self.checkpoints[sid] = max(
+                    self.checkpoints.get(sid, 0), entries[-1][0]
+                )
+            return
+
+        # lines at the checkpoint itself were all received with it
+        start_ns = max(now - LOGS_BACKFILL_SECONDS * 10**9, checkpoint + 1)
+        if buffers is not None and all(
+            buffer.complete_since <= start_ns for buffer in buffers
+        ):
+            entries = list(
+                heapq.merge(
+                    *(buffer.since(checkpoint) for buffer in buffers),
+                    key=lambda entry: entry[0],
+                )
+            )
+            for i in range(0, len(entries), logs.LOGS_PAGE_LIMIT):
+                await self._send_page(sid, entries[i : i + logs.LOGS_PAGE_LIMIT])
+            return
+        async for page in logs.iter_logs(namespaces, start_ns, now):
+            if not await self._send_page(sid, page):
+                break
+
+    async def _send_page(self, sid: str, page: List[Entry]) -> bool:
+        """Sends a page of logs to `sid`
+
+        Returns:
+            bool: False if `sid` disconnected
+        """
+        if sid not in self.namespaces:
+            return False
+        self.checkpoints[sid] = max(self.checkpoints.get(sid, 0), page[-1][0])
+        await socketio.emit("log_data", logs.format_entries(page), to=sid)
+        return True
+
+    async def history(
+        self, namespaces: List[str], before: int, limit: int
+    ) -> List[Entry]:
+        """Up to `limit` of the newest lines of `namespaces` logged before
+        `before`, from the buffers if they reach back far enough and from Loki
+        otherwise
+        """
+        history_start = before - LOGS_HISTORY_SECONDS * 10**9
+        buffers = await self._buffers(namespaces)
+        if buffers is not None:
+            floor = max(buffer.complete_since for buffer in buffers)
+            entries = [
+                entry
+                for entry in _merge_newest(buffers, limit, before)
+                if entry[0] >= floor
+            ]
+            if len(entries) == limit or floor <= history_start:
+                return entries
+        pages = []
+        size = 0
+        async for page in logs.iter_logs(
+            namespaces, history_start, before, direction=logs.BACKWARD
+        ):
+            pages.append(page)
+            size += len(page)
+            if size >= limit:
+                break
+        entries = [entry for page in reversed(pages) for entry in page]
+        return entries[-limit:]
+
+    async def search(
+        self, namespaces: List[str], pattern: "re.Pattern[bytes]", limit: int
+    ) -> Tuple[List[Match], bool]:
+        """Searches the buffered logs of the viewed `namespaces`
+
+        Returns:
+            Tuple[List[Match], bool]: the matches, and whether every line was
+            searched before the search timed out
+        """
+        if self._searches is None:
+            self._searches = asyncio.Semaphore(LOG_SEARCH_CONCURRENCY)
+        async with self._searches:
+            buffers = [
+                self._tails[namespace].buffer.copy()
+                for namespace in namespaces
+                if namespace in self._tails
+            ]
+            # scanning megabytes of logs would stall the event loop
+            return await asyncio.to_thread(_search, buffers, pattern, limit)
+
+
+log_subscriptions = LogSubscriptions()
 
-async def send_logs():
-    global CLIENT_CONNECTED, FIRST_RUN, BACKGROUND_TASK_RUNNING
-    while CLIENT_CONNECTED:
-        logs = get_logs(FIRST_RUN)
 
-        FIRST_RUN = False  # After the first successful fetch, set to False
-        if logs:
-            await socketio.emit("log_data", logs)
+@socketio.event
+async def connect(sid, environ):
+    logger.debug(f"Client {sid} connected")
+    await log_subscriptions.subscribe(sid, [])
 
-        await asyncio.sleep(5)
 
-    # Background task is no longer running after the loop
-    BACKGROUND_TASK_RUNNING = False
+@socketio.event
+async def update_namespaces(sid, namespaces):
+    """Sets the namespaces whose logs are sent to the client. Takes a list of
+    namespaces, or `{"namespaces": [...], "checkpoint": ts}` to resume from
+    the nanosecond timestamp of the last log the client has.
+    """
+    checkpoint = None
+    if isinstance(namespaces, dict):
+        checkpoint = namespaces.get("checkpoint")
+        namespaces = namespaces.get("namespaces") or []
+    await log_subscriptions.subscribe(
+        sid, namespaces, None if checkpoint is None else int(checkpoint)
+    )
+    logger.debug(f"Client {sid} updated namespaces")
 
 
 @socketio.event
-async def connect(sid, environ):
-    global CLIENT_CONNECTED, FIRST_RUN, BACKGROUND_TASK_RUNNING
-    CLIENT_CONNECTED = True
-    FIRST_RUN = True
-    logger.debug("Client connected")
+async def disconnect(sid):
+    await log_subscriptions.unsubscribe(sid)
+    logger.debug(f"Client {sid} disconnected")
+
 
-    # Start the background task only if it's not already running
-    if not BACKGROUND_TASK_RUNNING:
-        BACKGROUND_TASK_RUNNING = True
-        socketio.start_background_task(send_logs)
+def publish_workloads():
+    """Sends workload cache changes to subscribed clients. Must be called
+    from the event loop, before the cache starts watching.
+    """
+    loop = asyncio.get_running_loop()
+    deltas: asyncio.Queue = asyncio.Queue()
+    workload_cache.add_listener(
+        lambda delta: loop.call_soon_threadsafe(deltas.put_nowait, delta)
+    )
+    socketio.start_background_task(_broadcast_workloads, deltas)
+
+
+async def _broadcast_workloads(deltas: asyncio.Queue):
+    while True:
+        # batch whatever else arrived while we waited
+        batch = [await deltas.get()]
+        while not deltas.empty():
+            batch.append(deltas.get_nowait())
+
+        synced = [i for i, delta in enumerate(batch) if delta["type"] == SYNC]
+        if synced:
+            rows, resource_version = workload_cache.snapshot()
+            await socketio.emit(
+                "workload_snapshot",
+                {"resourceVersion": resource_version, "workloads": rows},
+                room=WORKLOADS_ROOM,
+            )
+            batch = batch[synced[-1] + 1 :]
+        if batch:
+            await socketio.emit("workload_deltas", batch, room=WORKLOADS_ROOM)
 
 
 @socketio.event
-async def update_namespaces(sid, namespaces):
-    global SELECTED_NAMESPACES
-    SELECTED_NAMESPACES = namespaces
-    logger.debug("Updated namespaces")
+async def subscribe_workloads(sid, data=None):
+    """Subscribes to workload deltas. Clients that pass the `resourceVersion`
+    of the last delta they saw only receive the changes since then, otherwise
+    they first receive a snapshot of every workload.
+    """
+    await socketio.enter_room(sid, WORKLOADS_ROOM)
+    resource_version = (data or {}).get("resourceVersion")
+    changes = (
+        workload_cache.changes_since(resource_version) if resource_version else None
+    )
+    if changes is None:
+        rows, resource_version = workload_cache.snapshot()
+        await socketio.emit(
+            "workload_snapshot",
+            {"resourceVersion": resource_version, "workloads": rows},
+            to=sid,
+        )
+    elif changes:
+        await socketio.emit("workload_deltas", changes, to=sid)
 
 
 @socketio.event
-async def disconnect(sid):
-    global CLIENT_CONNECTED, FIRST_RUN, BACKGROUND_TASK_RUNNING
-    CLIENT_CONNECTED = False
-    FIRST_RUN = True
-    BACKGROUND_TASK_RUNNING = False
-    logger.debug("Client disconnected")
+async def unsubscribe_workloads(sid):
+    await socketio.leave_room(sid, WORKLOADS_ROOM)
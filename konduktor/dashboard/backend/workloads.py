@@ -0,0 +1,271 @@
+"""
+Kueue workload cache
+Lists Kueue workloads across all namespaces once and then watches them, keeping
+the formatted rows in memory with indexes by namespace, status and local queue,
+along with the columns `queue_stats` aggregates. Dashboard requests are served
+from the cache without touching the API server.
+"""
+
+import collections
+import threading
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from konduktor import kube_client
+from konduktor import logging as konduktor_logging
+
+from .queue_stats import QueueColumns
+
+GROUP = "kueue.x-k8s.io"
+VERSION = "v1beta1"
+PLURAL = "workloads"
+# seconds before the API server ends a watch, after which we resume it
+WATCH_TIMEOUT = 300
+# seconds to wait before relisting after the watch fails
+RETRY_SECONDS = 5
+# changes kept for clients resuming from a resourceVersion
+HISTORY_SIZE = 10000
+# delta type sent when the cache was relisted and clients need a snapshot
+SYNC = "SYNC"
+
+logger = konduktor_logging.get_logger(__name__)
+
+
+def format_workload(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Formats a Kueue workload as a dashboard row"""
+    status = "ADMITTED" if "admission" in job.get("status", {}) else "PENDING"
+    statusVal = 1 if status == "ADMITTED" else 0
+    priority = job["spec"].get("priority", 0)
+    return {
+        "id": job["metadata"]["uid"],
+        "name": job["metadata"]["name"],
+        "namespace": job["metadata"]["namespace"],
+        "localQueueName": job["spec"].get("queueName", "Unknown"),
+        "priority": priority,
+        "status": status,
+        "active": job["spec"].get("active", 0),
+        "created_at": job["metadata"]["creationTimestamp"],
+        "order": (statusVal * 10) + priority,
+    }
+
+
+Delta = Dict[str, Any]
+Listener = Callable[[Delta], None]
+
+
+class WorkloadCache:
+    """Watch based cache of formatted Kueue workload rows
+
+    Every change is also recorded as a delta,
+    `{"type": ..., "resourceVersion": ..., "workload": row}`, which is passed
+    to the listeners and kept in a bounded history so clients can resume from
+    a resourceVersion.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows: Dict[str, Dict[str, Any]] = {}
+        self._by_namespace: Dict[str, Set[str]] = {}
+        self._by_status: Dict[str, Set[str]] = {}
+        self._by_queue: Dict[str, Set[str]] = {}
+        self._columns = QueueColumns()
+        self.resource_version = ""
+        self.synced = threading.Event()
+        self._history: Deque[Delta] = collections.deque(maxlen=HISTORY_SIZE)
+        self._listeners: List[Listener] = []
+
+    def add_listener(self, listener: Listener):
+        """Calls `listener` with every delta, from the watch thread"""
+        self._listeners.append(listener)
+
+    def _notify(self, delta: Delta):
+        for listener in self._listeners:
+            listener(delta)
+
+    def snapshot(self) -> Tuple[List[Dict[str, Any]], str]:
+        """All rows and the resourceVersion they are current as of"""
+        with self._lock:
+            return list(self._rows.values()), self.resource_version
+
+    def changes_since(self, resource_version: str) -> Optional[List[Delta]]:
+        """Deltas after `resource_version`
+
+        Returns:
+            Optional[List[Delta]]: None if the history does not reach back to
+            `resource_version`, or the cache is not synced, and a snapshot is
+            needed instead
+        """
+        if not self.synced.is_set():
+            return None
+        with self._lock:
+            if resource_version == self.resource_version:
+                return []
+            history = list(self._history)
+        for i, delta in enumerate(history):
+            if delta["resourceVersion"] == resource_version:
+                return history[i + 1 :]
+        return None
+
+    @property
+    def etag(self) -> Optional[str]:
+        """ETag of the cached rows, None while the cache is not synced, as
+        they may be stale under an unchanged resourceVersion
+        """
+        if not self.synced.is_set():
+            return None
+        return f'"{self.resource_version}"'
+
+    def _index(self, row: Dict[str, Any]):
+        uid = row["id"]
+        self._by_namespace.setdefault(row["namespace"], set()).add(uid)
+        self._by_status.setdefault(row["status"], set()).add(uid)
+        self._by_queue.setdefault(row["localQueueName"], set()).add(uid)
+
+    def _unindex(self, row: Dict[str, Any]):
+        uid = row["id"]
+        self._by_namespace.get(row["namespace"], set()).discard(uid)
+        self._by_status.get(row["status"], set()).discard(uid)
+        self._by_queue.get(row["localQueueName"], set()).discard(uid)
+
+    def _apply(self, event_type: str, job: Dict[str, Any]):
+        row = format_workload(job)
+        with self._lock:
+            old = self._rows.pop(row["id"], None)
+            if old is not None:
+                self._unindex(old)
+            if event_type != "DELETED":
+                self._rows[row["id"]] = row
+                self._index(row)
+                self._columns.update(row["id"], job)
+            else:
+                self._columns.remove(row["id"])
+            self.resource_version = job["metadata"]["resourceVersion"]
+            delta = {
+                "type": event_type,
+                "resourceVersion": self.resource_version,
+                "workload": row,
+            }
+            self._history.append(delta)
+        self._notify(delta)
+
+    def query(
+        self,
+        namespace: Optional[str] = None,
+        status: Optional[str] = None,
+        queue: Optional[str] = None,
+        offset: int = 0,
+        limit: Optional[int] = None,
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """Filters and paginates the cached rows, ordered by `order` descending
+
+        Returns:
+            Tuple[List[Dict[str, Any]], int]: page of rows, total matching rows
+        """
+        with self._lock:
+            uids: Optional[Set[str]] = None
+            for index, value in (
+                (self._by_namespace, namespace),
+                (self._by_status, status),
+                (self._by_queue, queue),
+            ):
+                if value is None:
+                    continue
+                matching = index.get(value, set())
+                uids = matching if uids is None else uids & matching
+            if uids is None:
+                rows = list(self._rows.values())
+            else:
+                rows = [self._rows[uid] for uid in uids]
+        rows.sort(key=lambda row: (-row["order"], row["created_at"]))
+        end = None if limit is None else offset + limit
+        return rows[offset:end], len(rows)
+
+    def queue_stats(self) -> Dict[str, Any]:
+        """Admitted and pending counts, wait times and priority inversions
+        per LocalQueue and ClusterQueue, see `QueueColumns.stats`. `synced`
+        is false while they may be stale.
+        """
+        with self._lock:
+            columns = self._columns.copy()
+            resource_version = self.resource_version
+        return {
+            "resourceVersion": resource_version,
+            "synced": self.synced.is_set(),
+            **columns.stats(),
+        }
+
+    def run(self, stop: threading.Event):
+        """Lists and watches workloads until `stop` is set
+
+        Once the watch fails, events may have been missed, so the cache is
+        not synced until the workloads were listed again.
+        """
+        while not stop.is_set():
+            try:
+                resource_version = self._list()
+                while not stop.is_set():
+                    resource_version = self._watch(resource_version, stop)
+            except kube_client.api_exception() as e:
+                self.synced.clear()
+                if e.status == 410:
+                    logger.debug("workload watch expired, relisting")
+                    continue
+                logger.warning(f"workload watch failed: {e}")
+            except kube_client.max_retry_error() as e:
+                self.synced.clear()
+                logger.warning(f"workload watch failed: {e}")
+            except Exception as e:  # pylint: disable=broad-except
+                # e.g. a dropped connection or a malformed workload
+                self.synced.clear()
+                logger.error(f"workload watch failed: {e}")
+            stop.wait(RETRY_SECONDS)
+
+    def _list(self) -> str:
+        listing = kube_client.crd_api().list_cluster_custom_object(
+            group=GROUP,
+            version=VERSION,
+            plural=PLURAL,
+            _request_timeout=kube_client.API_TIMEOUT,
+        )
+        rows = [format_workload(job) for job in listing["items"]]
+        columns = QueueColumns()
+        for row, job in zip(rows, listing["items"]):
+            columns.update(row["id"], job)
+        with self._lock:
+            self._rows = {row["id"]: row for row in rows}
+            self._columns = columns
+            self._by_namespace, self._by_status, self._by_queue = {}, {}, {}
+            for row in rows:
+                self._index(row)
+            self.resource_version = listing["metadata"]["resourceVersion"]
+            # resourceVersions from before the relist may have been missed
+            self._history.clear()
+        self.synced.set()
+        self._notify(
+            {"type": SYNC, "resourceVersion": self.resource_version, "workload": None}
+        )
+        logger.debug(f"workload cache synced {len(rows)} workloads")
+        return listing["metadata"]["resourceVersion"]
+
+    def _watch(self, resource_version: str, stop: threading.Event) -> str:
+        watch = kube_client.watch()
+        for event in watch.stream(
+            kube_client.crd_api().list_cluster_custom_object,
+            group=GROUP,
+            version=VERSION,
+            plural=PLURAL,
+            resource_version=resource_version,
+            timeout_seconds=WATCH_TIMEOUT,
+        ):
+            if event["type"] in ("ADDED", "MODIFIED", "DELETED"):
+                self._apply(event["type"], event["object"])
+            if stop.is_set():
+                watch.stop()
+        return watch.resource_version or resource_version
+
+    def start(self, stop: threading.Event):
+        thread = threading.Thread(target=self.run, args=(stop,), daemon=True)
+        thread.start()
+
+
+# Kueue workloads across all namespaces, shared by the REST and socket handlers
+workload_cache = WorkloadCache()
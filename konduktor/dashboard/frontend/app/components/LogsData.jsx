@@ -68,6 +68,11 @@ function LogsData() {
           socketRef.current.on('log_data', (data) => {
             setLogsData((prevLogs) => [...prevLogs, ...data]);
           });
+
+          // older logs arrive newest page first
+          socketRef.current.on('log_history', (data) => {
+            setLogsData((prevLogs) => [...data, ...prevLogs]);
+          });
     
           socketRef.current.on('disconnect', () => {
             console.log('Disconnected from Next.js Socket.IO server');
@@ -22,39 +22,40 @@ app.prepare().then(() => {
     },
   });
 
-  // Connect to Flask backend only when there are clients connected
-  let activeClients = 0;
-  let fastapiSocket;
+  const backendUrl = process.env.NODE_ENV === 'development'
+    ? 'http://127.0.0.1:5001'
+    : 'http://backend.konduktor-dashboard.svc.cluster.local:5001';
 
+  // Every browser gets its own backend connection, so the backend sees one
+  // client per browser and keeps the namespaces each one follows apart
   io.on('connection', (clientSocket) => {
-    activeClients += 1;
+    const backendSocket = ClientIO(backendUrl);
+    let namespaces = null;
 
-    // Establish a connection to Flask only if this is the first client
-    if (activeClients === 1) {
-      const backendUrl = process.env.NODE_ENV === 'development'
-        ? 'http://127.0.0.1:5001'
-        : 'http://backend.konduktor-dashboard.svc.cluster.local:5001';
-
-      fastapiSocket = ClientIO(backendUrl);
+    // Everything the backend sends, e.g. the log history a browser asked
+    // for, is meant for this browser only, never broadcast
+    backendSocket.onAny((event, ...args) => {
+      clientSocket.emit(event, ...args);
+    });
 
-      fastapiSocket.on('log_data', (data) => {
-        io.emit('log_data', data); // Broadcast to all connected clients
-      });
+    // Forward the browser's events, with their acknowledgements, to the
+    // backend. Events sent before it is connected are buffered.
+    clientSocket.onAny((event, ...args) => {
+      if (event === 'update_namespaces') {
+        namespaces = args[0];
+      }
+      backendSocket.emit(event, ...args);
+    });
 
-      // Receive updated namespaces from the client (forward to Flask)
-      clientSocket.on('update_namespaces', (namespaces) => {
-        fastapiSocket.emit('update_namespaces', namespaces);  // Send to Flask
-      });
-    }
+    // A reconnected backend socket is a new client to the backend
+    backendSocket.io.on('reconnect', () => {
+      if (namespaces !== null) {
+        backendSocket.emit('update_namespaces', namespaces);
+      }
+    });
 
     clientSocket.on('disconnect', () => {
-      activeClients -= 1;
-
-      // Disconnect from Flask when no clients are connected
-      if (activeClients === 0 && fastapiSocket) {
-        fastapiSocket.disconnect();
-        fastapiSocket = null;
-      }
+      backendSocket.disconnect();
     });
   });
 
@@ -12,6 +12,7 @@ API_TIMEOUT = 5
 
 _configured = False
 _core_api = None
+_coordination_api = None
 
 # For dashboard
 _batch_api = None
@@ -43,6 +44,14 @@ def core_api():
     return _core_api
 
 
+def coordination_api():
+    global _coordination_api
+    if _coordination_api is None:
+        _load_config()
+        _coordination_api = kubernetes.client.CoordinationV1Api()
+    return _coordination_api
+
+
 def batch_api():
     global _batch_api
     if _batch_api is None:
@@ -73,3 +82,7 @@ def max_retry_error():
 
 def stream():
     return kubernetes.stream.stream
+
+
+def watch():
+    return kubernetes.watch.Watch()
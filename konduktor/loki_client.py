@@ -0,0 +1,480 @@
+"""Shared HTTP client for Loki used by the controller and the dashboard.
+
+Requests go through a single pooled session with keep-alive, timeouts and
+jittered exponential backoff, and their latency and errors are recorded as
+prometheus metrics.
+
+query_range responses are decoded incrementally as they are read, one entry
+at a time, instead of loading the whole body as nested dicts and lists, so
+peak memory stays flat however large a response is and the first entries are
+classified while the rest are still on the wire.
+"""
+
+import codecs
+import concurrent.futures
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+from typing import (
+    Any,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import prometheus_client
+import requests
+import requests.adapters
+
+from konduktor import logging as konduktor_logging
+
+logger = konduktor_logging.get_logger(__name__)
+
+# (connect, read) timeouts in seconds
+CONNECT_TIMEOUT = float(os.environ.get("LOKI_CONNECT_TIMEOUT", 3))
+READ_TIMEOUT = float(os.environ.get("LOKI_READ_TIMEOUT", 10))
+MAX_RETRIES = int(os.environ.get("LOKI_MAX_RETRIES", 3))
+BACKOFF_SECONDS = 0.2
+MAX_BACKOFF_SECONDS = 5.0
+# max connections kept alive and queries run at once
+POOL_SIZE = int(os.environ.get("LOKI_POOL_SIZE", 10))
+RETRY_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+# bytes read from a response at a time
+CHUNK_BYTES = 64 * 1024
+# max lines per query_range request, longer windows are paged
+QUERY_LIMIT = int(os.environ.get("LOKI_QUERY_LIMIT", 5000))
+
+REQUEST_SECONDS = prometheus_client.Histogram(
+    "konduktor_loki_request_seconds",
+    "Latency of Loki HTTP requests",
+    ["path"],
+)
+REQUEST_ERRORS = prometheus_client.Counter(
+    "konduktor_loki_request_errors_total",
+    "Failed Loki HTTP requests, including retried attempts",
+    ["path", "reason"],
+)
+
+# (labels, ts, line) of a log line, in nanoseconds
+Entry = Tuple[Dict[str, str], int, str]
+
+_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+def session() -> requests.Session:
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE
+            )
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+    return _session
+
+
+def executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=POOL_SIZE, thread_name_prefix="loki"
+            )
+    return _executor
+
+
+def backoff(attempt: int) -> float:
+    """Full jitter exponential backoff"""
+    return random.uniform(0, min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2**attempt))
+
+
+_RESULT = re.compile(r'"result"\s*:\s*\[')
+_SEPARATORS = frozenset(" \t\r\n,")
+_COLON = re.compile(r"\s*:\s*")
+_NOT_CLOSED = object()
+
+
+class EntryDecoder:
+    """Incremental decoder of query_range responses
+
+    Bytes are fed as they are read and every complete `[ts, line]` value is
+    decoded on its own, so only the unread tail of a response is buffered.
+    Entries of a stream share its labels dict.
+
+    Example:
+        decoder = EntryDecoder()
+        for chunk in response.iter_content(CHUNK_BYTES):
+            entries.extend(decoder.feed(chunk))
+        entries.extend(decoder.close())
+    """
+
+    def __init__(self):
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buf = ""
+        self._closed = False
+        self._in_result = False
+        self._done = False
+        # position within a stream object: None between streams, "" between
+        # its members, "values" inside its values
+        self._member: Optional[str] = None
+        self._labels: Optional[Dict[str, str]] = None
+        # values read before the stream's labels
+        self._pending: List[List[str]] = []
+
+    def feed(self, data: bytes) -> List[Entry]:
+        """Decodes the entries completed by `data`
+
+        Raises:
+            ValueError: if the response is not a query_range response
+        """
+        self._buf += self._text.decode(data)
+        return self._decode()
+
+    def close(self) -> List[Entry]:
+        """Decodes the entries left once the whole response was fed
+
+        Raises:
+            ValueError: if the response was truncated or malformed
+        """
+        self._buf += self._text.decode(b"", final=True)
+        self._closed = True
+        entries = self._decode()
+        if not self._done:
+            raise ValueError("incomplete query_range response")
+        return entries
+
+    def _value(self, pos: int) -> Tuple[Any, int]:
+        """Decodes the JSON value at `pos`, `_NOT_CLOSED` if it may continue
+        in data not fed yet
+        """
+        try:
+            value, end = self._json.raw_decode(self._buf, pos)
+        except json.JSONDecodeError:
+            if self._closed:
+                raise ValueError(
+                    f"malformed query_range response at {self._buf[pos : pos + 80]!r}"
+                ) from None
+            return _NOT_CLOSED, pos
+        # a number at the end of the buffer may have more digits to come
+        if end == len(self._buf) and not self._closed:
+            return _NOT_CLOSED, pos
+        return value, end
+
+    def _values(self, pos: int, bulk: bool) -> Tuple[Any, int, bool]:
+        """Decodes the `[ts, line]` values at `pos`, up to every complete one
+        in the buffer at once if `bulk`, otherwise only the first
+
+        Returns:
+            Tuple[Any, int, bool]: the values or `_NOT_CLOSED`, the position
+            after them, and whether decoding in bulk is still worth trying
+        """
+        buf = self._buf
+        if bulk:
+            # a value ends in `"]`, and its list of values in `"]]`. Either
+            # can be part of a line, in which case the cut is inside a string
+            # and fails to decode.
+            last = buf.find('"]]', pos)
+            cut = buf.rfind('"]', pos, len(buf) if last < 0 else last + 2)
+            if cut > pos:
+                try:
+                    return self._json.decode(f"[{buf[pos : cut + 2]}]"), cut + 2, bulk
+                except json.JSONDecodeError:
+                    # decode one by one for the rest of this chunk
+                    bulk = False
+        value, end = self._value(pos)
+        if value is _NOT_CLOSED:
+            return value, pos, bulk
+        return [value], end, bulk
+
+    def _decode(self) -> List[Entry]:
+        entries: List[Entry] = []
+        buf = self._buf
+        pos = 0
+        bulk = True
+        if not self._in_result:
+            match = _RESULT.search(buf)
+            if match is None:
+                # keep enough to match the key split across chunks
+                self._buf = buf[-64:]
+                return entries
+            self._in_result = True
+            pos = match.end()
+        while not self._done:
+            while pos < len(buf) and buf[pos] in _SEPARATORS:
+                pos += 1
+            if pos == len(buf):
+                break
+            char = buf[pos]
+            if self._member is None:
+                if char == "]":
+                    self._done = True
+                elif char != "{":
+                    raise ValueError(f"expected a stream at {buf[pos : pos + 80]!r}")
+                else:
+                    self._member, self._labels = "", None
+                pos += 1
+            elif self._member == "values":
+                if char == "]":
+                    self._member = ""
+                    pos += 1
+                    continue
+                values, pos, bulk = self._values(pos, bulk)
+                if values is _NOT_CLOSED:
+                    break
+                if self._labels is None:
+                    self._pending.extend(values)
+                else:
+                    labels = self._labels
+                    entries.extend((labels, int(ts), line) for ts, line in values)
+            elif char == "}":
+                labels = self._labels or {}
+                entries.extend((labels, int(ts), line) for ts, line in self._pending)
+                self._pending = []
+                self._member = None
+                pos += 1
+            else:
+                key, end = self._value(pos)
+                if key is _NOT_CLOSED:
+                    break
+                colon = _COLON.match(buf, end)
+                if colon is None or colon.end() == len(buf):
+                    if self._closed:
+                        raise ValueError(f"expected a value at {buf[end : end + 80]!r}")
+                    break
+                if key == "values":
+                    if buf[colon.end()] != "[":
+                        raise ValueError("stream values are not a list")
+                    self._member = "values"
+                    pos = colon.end() + 1
+                    continue
+                value, end = self._value(colon.end())
+                if value is _NOT_CLOSED:
+                    break
+                if key == "stream":
+                    self._labels = value
+                pos = end
+        # whatever follows the result, e.g. stats, is not needed
+        self._buf = "" if self._done else buf[pos:]
+        return entries
+
+
+def iter_entries(chunks: Iterable[bytes]) -> Iterator[Entry]:
+    """Decodes a query_range response as its `chunks` are read
+
+    Raises:
+        ValueError: if the response was truncated or malformed
+
+    Yields:
+        Entry: entries in response order, i.e. by stream
+    """
+    decoder = EntryDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.close()
+
+
+def get(url: str, params: Dict[str, Any], stream: bool = False) -> requests.Response:
+    """GET `url`, retrying connection errors, timeouts and 429/5xx responses
+
+    Args:
+        url (str): full url of the loki endpoint
+        params (Dict[str, Any]): query parameters
+        stream (bool, optional): return before the body of a successful
+            response is read, which must then be read or closed
+
+    Raises:
+        requests.RequestException: if the last attempt fails to connect
+
+    Returns:
+        requests.Response: the response of the last attempt
+    """
+    path = urllib.parse.urlparse(url).path
+    for attempt in range(MAX_RETRIES + 1):
+        start = time.perf_counter()
+        try:
+            response = session().get(
+                url,
+                params=params,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                stream=stream,
+            )
+        except requests.RequestException as e:
+            REQUEST_ERRORS.labels(path, type(e).__name__).inc()
+            if attempt == MAX_RETRIES:
+                raise
+            logger.debug(f"loki request failed, retrying: {e}")
+        else:
+            REQUEST_SECONDS.labels(path).observe(time.perf_counter() - start)
+            if response.status_code < 400:
+                return response
+            REQUEST_ERRORS.labels(path, str(response.status_code)).inc()
+            if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_RETRIES:
+                return response
+            logger.debug(f"loki returned {response.status_code}, retrying")
+            response.close()
+        time.sleep(backoff(attempt))
+    raise AssertionError("unreachable")
+
+
+def _page(url: str, params: Dict[str, Any]) -> Generator[Entry, None, bool]:
+    """Entries of a single query_range request, in response order
+
+    Returns:
+        bool: False if the query failed
+    """
+    try:
+        response = get(url, params, stream=True)
+    except requests.RequestException as e:
+        logger.error(f"loki query failed {params}: {e}")
+        return False
+    with response:
+        if response.status_code != 200:
+            if response.status_code == 400:
+                logger.error(f"Bad Request: {response.status_code}")
+                logger.error(response.text)
+            else:
+                logger.error(f"loki query failed {params}")
+            return False
+        try:
+            yield from iter_entries(response.iter_content(CHUNK_BYTES))
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"loki query failed reading the response {params}: {e}")
+            return False
+    return True
+
+
+# sorted labels, timestamp and line of an entry, hashable
+_EntryKey = Tuple[Tuple[Tuple[str, str], ...], int, str]
+
+
+def _entry_key(entry: Entry) -> _EntryKey:
+    labels, ts, line = entry
+    return tuple(sorted(labels.items())), ts, line
+
+
+def query_range(
+    url: str,
+    query: str,
+    start_ns: int,
+    end_ns: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> Generator[Entry, None, bool]:
+    """Send LogQL query_range to loki for every line from `start_ns` to
+    `end_ns`, decoding the responses as they are read
+    https://grafana.com/docs/loki/latest/reference/loki-http-api/#query-logs-within-a-range-of-time
+
+    Pages forward `limit` lines at a time until the window is exhausted, each
+    page resuming from the timestamp the previous one ended at, so lines
+    sharing it are not skipped, and dropping the lines already returned at it.
+
+    Args:
+        url (str): full url of the query_range endpoint
+        query (str): LogQL query
+        start_ns (int): nanosecond timestamp to start from, inclusive
+        end_ns (Optional[int], optional): nanosecond timestamp to end at.
+            Defaults to now.
+        limit (Optional[int], optional): max lines per request. Defaults to
+            `QUERY_LIMIT`.
+
+    Yields:
+        Entry: entries of each page in response order, which is oldest first
+            within each stream, until a query fails
+
+    Returns:
+        bool: False if a query failed before the window was exhausted
+    """
+    if end_ns is None:
+        end_ns = time.time_ns()
+    if limit is None:
+        limit = QUERY_LIMIT
+    # entries returned at the timestamp the next page starts from
+    boundary: Set[_EntryKey] = set()
+    while start_ns < end_ns:
+        params = {
+            "query": query,
+            "start": str(start_ns),
+            "end": str(end_ns),
+            "direction": "forward",
+            "limit": str(limit),
+        }
+        received = new = 0
+        edge_ts = start_ns
+        at_edge: Set[_EntryKey] = set()
+        page = _page(url, params)
+        while True:
+            try:
+                entry = next(page)
+            except StopIteration as done:
+                ok = done.value
+                break
+            received += 1
+            ts = entry[1]
+            if ts >= edge_ts:
+                if ts > edge_ts:
+                    edge_ts, at_edge = ts, set()
+                at_edge.add(_entry_key(entry))
+            if ts == start_ns and _entry_key(entry) in boundary:
+                continue
+            new += 1
+            yield entry
+        if not ok:
+            return False
+        if received < limit:
+            return True
+        if not new:
+            # more than `limit` lines share the timestamp, they cannot be paged
+            logger.warning(
+                f"over {limit} log lines at {edge_ts}, skipping the rest of them"
+            )
+            edge_ts, at_edge = edge_ts + 1, set()
+        boundary = at_edge | {key for key in boundary if key[1] == edge_ts}
+        start_ns = edge_ts
+    return True
+
+
+def _collect(
+    url: str, query: str, start_ns: int, end_ns: int, limit: Optional[int]
+) -> Optional[List[Entry]]:
+    """Entries of `query_range`, None if a query failed"""
+    entries = []
+    pages = query_range(url, query, start_ns, end_ns, limit)
+    while True:
+        try:
+            entries.append(next(pages))
+        except StopIteration as done:
+            return entries if done.value else None
+
+
+def query_range_many(
+    url: str,
+    queries: List[str],
+    start_ns: int,
+    end_ns: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> List[Optional[List[Entry]]]:
+    """Runs independent `query_range` calls concurrently over the same window
+
+    Returns:
+        List[Optional[List[Entry]]]: entries of each query, in order, None
+            for the queries that failed
+    """
+    if end_ns is None:
+        end_ns = time.time_ns()
+    futures = [
+        executor().submit(_collect, url, query, start_ns, end_ns, limit)
+        for query in queries
+    ]
+    return [future.result() for future in futures]
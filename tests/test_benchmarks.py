@@ -0,0 +1,72 @@
+"""Benchmarks of the hot paths, left out of the default run:
+
+    poetry run pytest -m benchmark tests/test_benchmarks.py
+
+Save a run with `--benchmark-autosave` and compare later runs against it with
+`--benchmark-compare` to catch regressions on the same machine.
+"""
+
+import json
+import time
+
+import pytest
+
+from konduktor import loki_client
+from konduktor.controller import launch, replay
+
+
+def _response(lines: int) -> bytes:
+    now = time.time_ns()
+    return json.dumps(
+        {
+            "status": "success",
+            "data": {
+                "resultType": "streams",
+                "result": [
+                    {
+                        "stream": {"k8s_node_name": f"node-{node}"},
+                        "values": [
+                            [str(now + i), f"[{i}] NVRM: Xid (PCI:0000:4e:00): 79, {i}"]
+                            for i in range(lines // 10)
+                        ],
+                    }
+                    for node in range(10)
+                ],
+            },
+        }
+    ).encode()
+
+
+@pytest.fixture(scope="module")
+def response():
+    return _response(200_000)
+
+
+# decoding a query_range response incrementally, compared with json.loads
+@pytest.mark.benchmark(group="decode")
+def test_decode_incrementally(benchmark, response):
+    chunks = [
+        response[i : i + loki_client.CHUNK_BYTES]
+        for i in range(0, len(response), loki_client.CHUNK_BYTES)
+    ]
+    entries = benchmark(lambda: list(loki_client.iter_entries(chunks)))
+    assert len(entries) == 200_000
+
+
+@pytest.mark.benchmark(group="decode")
+def test_decode_json_loads(benchmark, response):
+    benchmark(json.loads, response)
+
+
+@pytest.mark.benchmark(group="classify")
+@pytest.mark.parametrize("source", list(launch.SOURCES))
+def test_classify(benchmark, source):
+    entries, _ = replay.synthetic(num_nodes=32, seconds=300)
+    loki = replay.FakeLoki(replay._replayed(entries, time.time_ns(), 1))
+    query, classifier = launch.SOURCES[source]
+    lines = loki.lines(query(None))
+    benchmark.extra_info["lines"] = len(lines)
+    results = benchmark(
+        lambda: [classifier(stream, ts, line) for ts, stream, line in lines]
+    )
+    assert any(fault is not None for fault in results)
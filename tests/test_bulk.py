@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+import urllib3
+
+from konduktor import kube_client
+from konduktor.dashboard.backend import bulk
+
+
+def test_every_failure_is_reported_for_its_workload():
+    def call(namespace, name):
+        if name == "forbidden":
+            raise kube_client.api_exception()(status=403, reason="Forbidden")
+        if name == "unreachable":
+            raise urllib3.exceptions.MaxRetryError(None, "/", "refused")
+        if name == "timeout":
+            raise TimeoutError("read timed out")
+
+    names = ["ok", "forbidden", "unreachable", "timeout", "also-ok"]
+    summary = asyncio.run(
+        bulk.run("delete", [("default", name) for name in names], call)
+    )
+    assert (summary["total"], summary["succeeded"], summary["failed"]) == (5, 2, 3)
+    results = {result["name"]: result for result in summary["results"]}
+    assert {name: result["status"] for name, result in results.items()} == {
+        "ok": 200,
+        "forbidden": 403,
+        "unreachable": 503,
+        "timeout": 500,
+        "also-ok": 200,
+    }
+    assert results["timeout"]["error"] == "read timed out"
+    assert not results["timeout"]["success"]
+
+
+def test_results_are_sent_to_the_caller(monkeypatch):
+    sent = []
+
+    async def emit(event, data, to=None):
+        sent.append((event, data.get("name"), to))
+
+    monkeypatch.setattr(bulk.socketio, "emit", emit)
+
+    def call(namespace, name):
+        raise ValueError("bad patch")
+
+    asyncio.run(bulk.run("priority", [("default", "a")], call, sid="sid-1"))
+    assert sent == [("bulk_result", "a", "sid-1"), ("bulk_done", None, "sid-1")]
+
+
+@pytest.mark.parametrize(
+    "workloads",
+    [["a"], [{"name": "a"}, None], {"name": "a"}, "a"],
+)
+def test_workloads_that_are_not_objects_are_rejected(workloads):
+    with pytest.raises(ValueError):
+        bulk.select({"workloads": workloads})
+
+
+def test_workloads_are_selected_by_name():
+    data = {"workloads": [{"name": "a"}, {"namespace": "team", "name": "b"}]}
+    assert bulk.select(data) == [("default", "a"), ("team", "b")]
+    with pytest.raises(ValueError):
+        bulk.select({"workloads": [{"namespace": "team"}]})
@@ -0,0 +1,93 @@
+import time
+
+from konduktor.controller import correlate, faults
+
+SECOND = 10**9
+JOB = "default/llama"
+
+
+def _pod_fault(node, ts):
+    return faults.Fault(node, faults.SOURCE_POD, "NCCL", ts, "NCCL error")
+
+
+def _verdict(correlator):
+    verdicts = correlator.ready(now=time.monotonic() + correlator.window)
+    assert len(verdicts) == 1
+    return verdicts[0]
+
+
+def test_hardware_evidence_names_the_culprits():
+    correlator = correlate.Correlator(window=0)
+    now = time.time_ns()
+    for i in range(4):
+        correlator.add(_pod_fault(f"node-{i}", now + i), JOB)
+    correlator.evidence(
+        faults.Fault("node-2", faults.SOURCE_DMESG, "Xid79", now - 60 * SECOND, "")
+    )
+    verdict = _verdict(correlator)
+    assert verdict.kind == correlate.VERDICT_EVIDENCE
+    assert [fault.node for fault in verdict.culprits] == ["node-2"]
+    assert verdict.suspects == ["node-0", "node-1", "node-3"]
+
+
+def test_old_evidence_is_ignored():
+    correlator = correlate.Correlator(window=0, evidence=60)
+    now = time.time_ns()
+    correlator.add(_pod_fault("node-0", now), JOB)
+    correlator.add(_pod_fault("node-1", now + 1), JOB)
+    correlator.evidence(
+        faults.Fault("node-1", faults.SOURCE_DMESG, "Xid79", now - 120 * SECOND, "")
+    )
+    assert _verdict(correlator).kind == correlate.VERDICT_AMBIGUOUS
+
+
+def test_the_first_node_to_fail_is_the_culprit():
+    correlator = correlate.Correlator(window=0, lead=1)
+    now = time.time_ns()
+    correlator.add(_pod_fault("node-3", now), JOB)
+    for i in range(3):
+        correlator.add(_pod_fault(f"node-{i}", now + 30 * SECOND + i), JOB)
+    verdict = _verdict(correlator)
+    assert verdict.kind == correlate.VERDICT_FIRST
+    assert [fault.node for fault in verdict.culprits] == ["node-3"]
+    assert verdict.suspects == ["node-0", "node-1", "node-2"]
+
+
+def test_nodes_failing_together_are_all_suspects():
+    correlator = correlate.Correlator(window=0, lead=1)
+    now = time.time_ns()
+    for i in range(3):
+        correlator.add(_pod_fault(f"node-{i}", now + i * SECOND // 10), JOB)
+    verdict = _verdict(correlator)
+    assert verdict.kind == correlate.VERDICT_AMBIGUOUS
+    assert verdict.culprits == []
+    assert verdict.suspects == ["node-0", "node-1", "node-2"]
+
+
+def test_a_single_failed_node_is_the_culprit():
+    correlator = correlate.Correlator(window=0)
+    now = time.time_ns()
+    correlator.add(_pod_fault("node-0", now), JOB)
+    # repeated faults of a node count once, from the first
+    correlator.add(_pod_fault("node-0", now + SECOND), JOB)
+    verdict = _verdict(correlator)
+    assert verdict.kind == correlate.VERDICT_SINGLE
+    assert [fault.ts for fault in verdict.culprits] == [now]
+    assert verdict.suspects == []
+
+
+def test_jobs_are_attributed_once_their_window_closes():
+    correlator = correlate.Correlator(window=30)
+    correlator.add(_pod_fault("node-0", time.time_ns()), JOB)
+    assert correlator.ready() == []
+    assert len(correlator.ready(now=time.monotonic() + 30)) == 1
+
+
+def test_open_jobs_survive_restarts():
+    correlator = correlate.Correlator(window=0)
+    now = time.time_ns()
+    correlator.add(_pod_fault("node-0", now), JOB)
+    correlator.evidence(faults.Fault("node-0", faults.SOURCE_DMESG, "Xid79", now, ""))
+    restored = correlate.Correlator(window=0)
+    restored.restore(correlator.dump())
+    assert _verdict(restored).kind == correlate.VERDICT_EVIDENCE
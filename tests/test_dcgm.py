@@ -0,0 +1,159 @@
+import numpy as np
+
+from konduktor.controller import dcgm, faults
+
+STEP = 30
+WINDOW = 600
+END = 1_700_000_000.0
+TIMES = np.arange(END - WINDOW, END + STEP / 2, STEP)
+MODEL = "NVIDIA H100 80GB HBM3"
+
+
+def _gpus(count, model=MODEL):
+    return [
+        {
+            "gpu": str(i % 8),
+            "UUID": f"GPU-{i}",
+            "modelName": model,
+            dcgm.DCGM_NODE_LABEL: f"node-{i // 8}",
+        }
+        for i in range(count)
+    ]
+
+
+def _series(values, gpus=None):
+    values = np.asarray(values, dtype=float)
+    return dcgm.Series(gpus or _gpus(len(values)), TIMES, values)
+
+
+def _found(found):
+    return sorted((fault.node, fault.code, fault.log.split(":")[0]) for fault in found)
+
+
+def _counters(rates):
+    """Replay counters of GPUs increasing at `rates` per second"""
+    return np.cumsum(np.outer(rates, np.full(len(TIMES), STEP)), axis=1)
+
+
+def test_pcie_replays_flag_sustained_rates():
+    replays = _series(_counters([0, 0.5, 3, 0]))
+    found = dcgm.pcie_replays(replays, STEP)
+    assert _found(found) == [("node-0", dcgm.PCIE_REPLAYS, "GPU 2 (GPU-2)")]
+    assert found[0].source == faults.SOURCE_DCGM
+    assert found[0].ts == int(TIMES[-1] * 10**9)
+
+
+def test_pcie_replays_ignore_bursts_and_counter_resets():
+    counters = _counters([0, 0])
+    # a burst shorter than the window averages below the rate
+    counters[0, 10:] += 100
+    # a driver reload resets the counter
+    counters[1] = 10_000
+    counters[1, 12:] = 0
+    assert dcgm.pcie_replays(_series(counters), STEP) == []
+
+
+def _temperatures(count, hot=(), spike=()):
+    rng = np.random.default_rng(0)
+    temps = 60 + rng.normal(0, 1, (count, len(TIMES)))
+    for i in hot:
+        temps[i] += 25
+    for i in spike:
+        temps[i, -2:] += 25
+    return temps
+
+
+def test_thermal_outliers_flag_gpus_hotter_than_their_peers():
+    found = dcgm.thermal_outliers(_series(_temperatures(16, hot=[5], spike=[9])))
+    # the short spike on GPU 9 is not sustained
+    assert _found(found) == [("node-0", dcgm.THERMAL_OUTLIER, "GPU 5 (GPU-5)")]
+
+
+def test_thermal_outliers_compare_gpus_of_the_same_model():
+    temps = _temperatures(16)
+    # a hotter model is not an outlier against itself
+    temps[8:] += 20
+    gpus = _gpus(8) + _gpus(8, model="NVIDIA A100-SXM4-80GB")
+    assert dcgm.thermal_outliers(_series(temps, gpus)) == []
+
+
+def test_thermal_outliers_need_enough_peers():
+    assert dcgm.thermal_outliers(_series(_temperatures(3, hot=[0]))) == []
+
+
+def test_thermal_outliers_ignore_missing_samples():
+    temps = _temperatures(8, hot=[1])
+    # a GPU that stopped reporting, and a scrape no GPU answered
+    temps[2, 5:] = np.nan
+    temps[:, 3] = np.nan
+    found = dcgm.thermal_outliers(_series(temps))
+    assert _found(found) == [("node-0", dcgm.THERMAL_OUTLIER, "GPU 1 (GPU-1)")]
+
+
+def test_memory_errors():
+    remap_failure = np.zeros((4, len(TIMES)))
+    remap_failure[1, -3:] = 1
+    uncorrectable = np.full((4, len(TIMES)), 2.0)
+    uncorrectable[3, 10:] = 4
+    # rows remapped before the window are not new errors
+    uncorrectable[2] = 7
+    found = dcgm.memory_errors(_series(remap_failure), _series(uncorrectable))
+    assert _found(found) == [
+        ("node-0", dcgm.ROW_REMAP_FAILED, "GPU 1 (GPU-1)"),
+        ("node-0", dcgm.UNCORRECTABLE_ROWS, "GPU 3 (GPU-3)"),
+    ]
+    assert dcgm.memory_errors(None, None) == []
+
+
+def test_faults_need_a_node():
+    gpus = _gpus(4)
+    del gpus[2][dcgm.DCGM_NODE_LABEL]
+    assert dcgm.pcie_replays(_series(_counters([0, 0, 3, 0]), gpus), STEP) == []
+
+
+def _result(name, values, **labels):
+    return {
+        "metric": {"__name__": name, **labels},
+        "values": [[t, str(v)] for t, v in values],
+    }
+
+
+def test_to_series_aligns_samples_on_the_grid():
+    result = [
+        _result(dcgm.GPU_TEMP, [(TIMES[0], 60), (TIMES[2] + 1, 61)], gpu="0"),
+        # out of the window
+        _result(dcgm.GPU_TEMP, [(TIMES[-1] + STEP, 70)], gpu="1"),
+        _result(dcgm.PCIE_REPLAY_COUNTER, [(TIMES[1], 5)], gpu="0"),
+    ]
+    series = dcgm.to_series(result, TIMES[0], TIMES[-1], STEP)
+    assert sorted(series) == [dcgm.GPU_TEMP, dcgm.PCIE_REPLAY_COUNTER]
+    temps = series[dcgm.GPU_TEMP]
+    assert [gpu["gpu"] for gpu in temps.gpus] == ["0", "1"]
+    np.testing.assert_array_equal(temps.times, TIMES)
+    assert temps.values[0, 0] == 60 and temps.values[0, 2] == 61
+    assert np.isnan(temps.values[0, 1])
+    assert np.isnan(temps.values[1]).all()
+
+
+def test_analyze_runs_every_check():
+    gpus = _gpus(16)
+    temps = _temperatures(16, hot=[12])
+    replays = _counters([0] * 16)
+    replays[3] += _counters([2])[0]
+    remap_failure = np.zeros((16, len(TIMES)))
+    remap_failure[7, -1] = 1
+    result = []
+    for name, values in [
+        (dcgm.GPU_TEMP, temps),
+        (dcgm.PCIE_REPLAY_COUNTER, replays),
+        (dcgm.ROW_REMAP_FAILURE, remap_failure),
+    ]:
+        for gpu, row in zip(gpus, values):
+            result.append(_result(name, zip(TIMES, row), **gpu))
+    series = dcgm.to_series(result, TIMES[0], TIMES[-1], STEP)
+    assert _found(dcgm.analyze(series, STEP)) == [
+        ("node-0", dcgm.PCIE_REPLAYS, "GPU 3 (GPU-3)"),
+        ("node-0", dcgm.ROW_REMAP_FAILED, "GPU 7 (GPU-7)"),
+        ("node-1", dcgm.THERMAL_OUTLIER, "GPU 4 (GPU-12)"),
+    ]
+    assert dcgm.analyze({}, STEP) == []
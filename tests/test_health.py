@@ -0,0 +1,101 @@
+from konduktor.controller import health
+
+
+def _tests(faulty=(), unschedulable=()):
+    """Single and pair tests that fail on `faulty` nodes and cannot measure
+    anything on `unschedulable` ones
+    """
+
+    def single_test(node):
+        if node in unschedulable:
+            return None
+        return node not in faulty
+
+    def pair_test(node_a, node_b):
+        if unschedulable and {node_a, node_b} & set(unschedulable):
+            return None
+        return not {node_a, node_b} & set(faulty)
+
+    return single_test, pair_test
+
+
+def test_inconclusive_tests_neither_clear_nor_blame():
+    single_test, pair_test = _tests(faulty={"bad"}, unschedulable={"pending"})
+    results = health.check(
+        ["good", "bad", "pending"], ["anchor-0", "anchor-1"], single_test, pair_test
+    )
+    assert results == {"good": True, "bad": False, "pending": None}
+
+
+def test_inconclusive_pair_tests():
+    single_test, _ = _tests()
+    results = health.check(["a", "b"], ["anchor"], single_test, lambda *_: None)
+    assert results == {"a": None, "b": None}
+
+
+def test_errors_are_inconclusive():
+    def single_test(node):
+        raise RuntimeError("api unavailable")
+
+    results = health.check(["a"], ["anchor"], single_test, lambda *_: True)
+    assert results == {"a": None}
+
+
+def test_suspects_failing_together_without_partners_are_inconclusive():
+    single_test, _ = _tests()
+    results = health.check(["a", "b"], [], single_test, lambda *_: False)
+    assert results == {"a": None, "b": None}
+
+
+def _recording(pair_test):
+    """`pair_test` that also records the pairs it was called with"""
+    pairs = []
+
+    def test(node_a, node_b):
+        pairs.append(frozenset((node_a, node_b)))
+        return pair_test(node_a, node_b)
+
+    return test, pairs
+
+
+def test_suspects_are_paired_with_known_good_nodes():
+    single_test, pair_test = _tests(faulty={"bad"})
+    pair_test, pairs = _recording(pair_test)
+    results = health.check(
+        ["a", "bad"], ["anchor-0", "anchor-1"], single_test, pair_test
+    )
+    assert results == {"a": True, "bad": False}
+    # the single node test already failed `bad`
+    assert pairs == [frozenset(("a", "anchor-0"))]
+
+
+def test_suspects_without_anchors_are_paired_together():
+    single_test, pair_test = _tests()
+    pair_test, pairs = _recording(pair_test)
+    results = health.check(["a", "b", "c", "d"], [], single_test, pair_test)
+    assert results == dict.fromkeys("abcd", True)
+    assert sorted(map(sorted, pairs)) == [["a", "b"], ["c", "d"]]
+
+
+def test_failed_suspect_pairs_are_retested_with_new_anchors():
+    def pair_test(node_a, node_b):
+        return "bad-nic" not in (node_a, node_b)
+
+    single_test, _ = _tests()
+    pair_test, pairs = _recording(pair_test)
+    results = health.check(["bad-nic", "a", "b", "c"], [], single_test, pair_test)
+    assert results == {"bad-nic": False, "a": True, "b": True, "c": True}
+    # `bad-nic` and `a` failed together, and were then each tested against
+    # nodes that passed
+    assert pairs[:2] == [frozenset(("bad-nic", "a")), frozenset(("b", "c"))]
+    assert all(len(pair & {"b", "c"}) == 1 for pair in pairs[2:])
+
+
+def test_every_suspect_is_tested_once_when_all_pass():
+    single_test, pair_test = _tests()
+    pair_test, pairs = _recording(pair_test)
+    suspects = [f"node-{i}" for i in range(64)]
+    results = health.check(suspects, ["anchor"], single_test, pair_test)
+    assert all(results.values())
+    tested = [node for pair in pairs for node in pair if node != "anchor"]
+    assert sorted(tested) == sorted(suspects)
@@ -0,0 +1,77 @@
+import threading
+
+import pytest
+
+from konduktor import kube_client
+from konduktor.controller import informer, replay
+
+
+class ScriptedCoreApi(replay.FakeCoreApi):
+    """Core API whose node listings first raise `errors`, and that stops the
+    informer after `lists` successful listings
+    """
+
+    def __init__(self, nodes, errors, lists, stop):
+        super().__init__(nodes)
+        self.errors = list(errors)
+        self.lists = lists
+        self.stop = stop
+        self.node_informer = informer.NodeInformer()
+        # whether the informer was synced at each listing
+        self.synced = []
+
+    def list_node(self, **kwargs):
+        self.synced.append(self.node_informer.synced.is_set())
+        if self.errors:
+            raise self.errors.pop(0)
+        self.lists -= 1
+        if not self.lists:
+            self.stop.set()
+        return super().list_node(**kwargs)
+
+
+class FailingWatch:
+    """Watch that deletes `node`, then fails with `error`"""
+
+    def __init__(self, node, error):
+        self.node = node
+        self.error = error
+        self.resource_version = None
+
+    def stream(self, func, **kwargs):
+        yield {"type": "DELETED", "object": self.node}
+        raise self.error
+
+    def stop(self):
+        pass
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        RuntimeError("connection reset"),
+        ValueError("undecodable event"),
+        kube_client.api_exception()(status=500, reason="InternalError"),
+    ],
+)
+def test_failed_watch_relists_and_is_unsynced_meanwhile(monkeypatch, error):
+    stop = threading.Event()
+    core_api = ScriptedCoreApi(
+        ["node-a", "node-b"], [RuntimeError("connection refused")], 2, stop
+    )
+    node_informer = core_api.node_informer
+    monkeypatch.setattr(informer, "RETRY_SECONDS", 0.01)
+    monkeypatch.setattr(kube_client, "core_api", lambda: core_api)
+    monkeypatch.setattr(
+        kube_client, "watch", lambda: FailingWatch(core_api._node("node-a"), error)
+    )
+    thread = threading.Thread(target=node_informer.run, args=(stop,), daemon=True)
+    thread.start()
+    thread.join(10)
+    # survived the failed listing and the failed watch, and was not synced
+    # again until the second listing
+    assert not thread.is_alive()
+    assert core_api.synced == [False, False, False]
+    assert node_informer.synced.is_set()
+    # the node the watch deleted was listed again
+    assert sorted(node_informer.node_names()) == ["node-a", "node-b"]
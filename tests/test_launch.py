@@ -0,0 +1,149 @@
+import asyncio
+import time
+
+import pytest
+import requests
+
+from konduktor import kube_client, loki_client
+from konduktor.controller import faults, launch, parse, replay, shard
+
+SECOND = 10**9
+NODE_A = {"k8s_node_name": "node-a"}
+
+
+class RecordingBackend:
+    def __init__(self):
+        self.saved = []
+
+    def load(self):
+        return None
+
+    def save(self, snapshot):
+        self.saved.append(snapshot)
+
+
+@pytest.fixture
+def cluster(monkeypatch):
+    loki = replay.FakeLoki([])
+    monkeypatch.setattr(parse, "LOG_ENDPOINT", loki.start())
+    monkeypatch.setattr(kube_client, "_core_api", replay.FakeCoreApi(["node-a"]))
+    monkeypatch.setattr(launch, "KONDUKTOR_CONTROLLER_INGEST_MODE", "poll")
+    yield
+    loki.stop()
+
+
+def test_classify_survives_failing_classifiers(monkeypatch):
+    def classifier(stream, ts, line):
+        if line == "bad":
+            raise ValueError("unparseable")
+        return faults.Fault("node-a", faults.SOURCE_DMESG, "Xid79", ts, line)
+
+    monkeypatch.setitem(
+        launch.SOURCES, faults.SOURCE_DMESG, (parse.dmesg_query, classifier)
+    )
+
+    async def classify():
+        controller = launch.Controller()
+        controller.state.backend = None
+        worker = asyncio.create_task(controller.classify())
+        now = time.time_ns()
+        for i, line in enumerate(["bad", "good"]):
+            await controller.lines.put((faults.SOURCE_DMESG, NODE_A, now + i, line))
+        await asyncio.wait_for(controller.lines.join(), 5)
+        assert not worker.done()
+        worker.cancel()
+        return await controller.faults.get()
+
+    assert asyncio.run(classify()) == "node-a"
+
+
+def test_poll_retries_when_listing_nodes_fails(cluster, monkeypatch):
+    calls = []
+
+    def list_nodes():
+        calls.append(None)
+        if len(calls) == 1:
+            raise kube_client.api_exception()(status=503, reason="Unavailable")
+        return ["node-a"]
+
+    monkeypatch.setattr(launch.node_control, "list_nodes", list_nodes)
+    monkeypatch.setattr(launch, "KONDUKTOR_CONTROLLER_LOG_POLL_SECONDS", 0.05)
+
+    async def poll():
+        controller = launch.Controller(node_shard=shard.Shard(0, 1))
+        controller.state.backend = None
+        ingest = asyncio.create_task(controller.ingest_poll())
+        while len(calls) < 3:
+            assert not ingest.done()
+            await asyncio.sleep(0.01)
+        controller.stop.set()
+        await asyncio.wait_for(ingest, 5)
+
+    asyncio.run(poll())
+
+
+def test_poll_reads_the_window_of_a_failed_poll(monkeypatch):
+    monkeypatch.setattr(launch, "KONDUKTOR_CONTROLLER_LOG_POLL_SECONDS", 0.05)
+    monkeypatch.setattr(parse, "LOGS_SINCE", 1)
+    monkeypatch.setattr(loki_client, "MAX_RETRIES", 0)
+    line = "[1] NVRM: Xid (PCI:0000:4e:00): 79, pid=1, GPU has fallen off the bus."
+    stream = {"k8s_daemonset_name": "dmesg", **NODE_A}
+    loki = replay.FakeLoki([(time.time_ns() - SECOND // 2, stream, line)])
+    monkeypatch.setattr(parse, "LOG_ENDPOINT", loki.start())
+    # loki is down for longer than a poll's window
+    down_until = time.monotonic() + 1.5
+    get = loki_client.get
+
+    def flaky_get(url, params, stream=False):
+        if time.monotonic() < down_until:
+            raise requests.ConnectionError("loki is down")
+        return get(url, params, stream)
+
+    monkeypatch.setattr(loki_client, "get", flaky_get)
+
+    async def poll():
+        controller = launch.Controller()
+        controller.state.backend = None
+        ingest = asyncio.create_task(controller.ingest_poll())
+        deadline = time.monotonic() + 5
+        while controller.lines.empty() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        controller.stop.set()
+        await asyncio.wait_for(ingest, 5)
+        return [
+            controller.lines.get_nowait()[3] for _ in range(controller.lines.qsize())
+        ]
+
+    try:
+        assert asyncio.run(poll()) == [line]
+    finally:
+        loki.stop()
+
+
+def test_controller_stops_and_flushes_when_a_worker_dies(cluster, monkeypatch):
+    async def correlate(self):
+        raise RuntimeError("bug")
+
+    monkeypatch.setattr(launch.Controller, "correlate", correlate)
+    backend = RecordingBackend()
+
+    async def run():
+        controller = launch.Controller()
+        controller.state.backend = backend
+        controller.state.advance(faults.SOURCE_DMESG, NODE_A, time.time_ns(), "line")
+        return await asyncio.wait_for(controller.run(), 5)
+
+    assert asyncio.run(run()) is False
+    assert len(backend.saved) == 1
+
+
+def test_controller_stops_cleanly(cluster):
+    async def run():
+        controller = launch.Controller()
+        controller.state.backend = None
+        run = asyncio.create_task(controller.run())
+        await asyncio.sleep(0.1)
+        controller.stop.set()
+        return await asyncio.wait_for(run, 5)
+
+    assert asyncio.run(run()) is True
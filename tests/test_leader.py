@@ -0,0 +1,104 @@
+import asyncio
+import threading
+import time
+
+from konduktor import kube_client
+from konduktor.controller import faults, launch, leader, parse, replay
+
+
+def _wait(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_lease_is_held_by_one_replica():
+    api = leader.FakeCoordinationApi()
+    first = leader.LeaseLock("lease", "replica-0", api, duration=60)
+    second = leader.LeaseLock("lease", "replica-1", api, duration=60)
+    assert first.try_acquire()
+    assert not second.try_acquire()
+    # renewing keeps it
+    assert first.try_acquire()
+    assert first.held() and not second.held()
+    first.release()
+    assert second.try_acquire()
+    assert not first.held()
+
+
+def test_every_shard_is_led_and_fails_over():
+    api = leader.FakeCoordinationApi()
+    replicas = []
+    for i in range(3):
+        stop = threading.Event()
+        elector = leader.Elector(2, f"replica-{i}", api=api, duration=1)
+        elector.start(stop)
+        replicas.append((elector, stop))
+    try:
+        _wait(lambda: sum(e.acquired.is_set() for e, _ in replicas) == 2)
+        leaders = {e.shard: (e, stop) for e, stop in replicas if e.acquired.is_set()}
+        assert set(leaders) == {0, 1}
+        standby = next(e for e, _ in replicas if not e.acquired.is_set())
+
+        # a crashed leader never releases its Lease, it expires instead
+        crashed, crashed_stop = leaders[0]
+        crashed.locks[0].release = lambda: None  # type: ignore
+        crashed_stop.set()
+        _wait(lambda: standby.shard == 0)
+    finally:
+        for _, stop in replicas:
+            stop.set()
+
+
+def test_elector_steps_down_when_it_cannot_renew():
+    api = leader.FakeCoordinationApi()
+    stop = threading.Event()
+    elector = leader.Elector(1, "replica-0", api=api, duration=1)
+    elector.start(stop)
+    try:
+        _wait(elector.acquired.is_set)
+
+        def unavailable(*args, **kwargs):
+            raise kube_client.api_exception()(status=503, reason="Unavailable")
+
+        api.read_namespaced_lease = unavailable  # type: ignore
+        _wait(elector.lost.is_set)
+    finally:
+        stop.set()
+
+
+class RecordingBackend:
+    def __init__(self):
+        self.saved = []
+
+    def load(self):
+        return None
+
+    def save(self, snapshot):
+        self.saved.append(snapshot)
+
+
+def test_controller_stops_without_flushing_once_leadership_is_lost(monkeypatch):
+    loki = replay.FakeLoki([])
+    monkeypatch.setattr(parse, "LOG_ENDPOINT", loki.start())
+    monkeypatch.setattr(kube_client, "_core_api", replay.FakeCoreApi(["node-a"]))
+    monkeypatch.setattr(launch, "KONDUKTOR_CONTROLLER_INGEST_MODE", "poll")
+    elector = leader.Elector(1, "replica-0", api=leader.FakeCoordinationApi())
+    backend = RecordingBackend()
+
+    async def run():
+        controller = launch.Controller(elector=elector)
+        controller.state.backend = backend
+        run = asyncio.create_task(controller.run())
+        await asyncio.sleep(0.1)
+        # classified before leadership was lost, but never flushed
+        controller.state.advance(faults.SOURCE_DMESG, {}, time.time_ns(), "line")
+        elector.lost.set()
+        await asyncio.wait_for(run, 5)
+
+    try:
+        asyncio.run(run())
+    finally:
+        loki.stop()
+    assert backend.saved == []
@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+from konduktor.dashboard.backend import log_buffer
+
+
+def _labels(pod):
+    return {"k8s_namespace_name": "default", "k8s_pod_name": pod}
+
+
+def test_evicted_label_sets_are_dropped():
+    buffer = log_buffer.LogBuffer(max_bytes=64 * 1024)
+    # short lived pods, each logging a few lines
+    for i in range(5000):
+        buffer.append(i, _labels(f"pod-{i // 4}"), f"line {i}")
+    assert buffer.nbytes <= buffer.max_bytes
+    pods = {labels["k8s_pod_name"] for _, labels, _ in buffer.newest(len(buffer))}
+    # only the pods with lines left in the buffer are interned
+    assert len(buffer._label_sets) == len(pods) < 1250
+    # lines keep their labels across the renumbering
+    for ts, labels, line in buffer.newest(len(buffer)):
+        assert line == f"line {ts}"
+        assert labels == _labels(f"pod-{ts // 4}")
+    # interned labels are reused after compaction
+    ts, labels, _ = buffer.newest(1)[0]
+    buffer.append(ts + 1, labels, "again")
+    assert buffer.newest(1)[0][1] is buffer._label_sets[-1]
+
+
+def test_label_sets_count_towards_the_cap():
+    buffer = log_buffer.LogBuffer(max_bytes=32 * 1024)
+    # every line has its own, large label set
+    for i in range(1000):
+        buffer.append(i, {"k8s_pod_name": f"pod-{i}", "trace": "x" * 200}, "ok")
+    assert buffer.nbytes <= buffer.max_bytes
+    assert len(buffer) < 1000
+    assert buffer.complete_since > 0
+
+
+def _filled(lines=10_000):
+    buffer = log_buffer.LogBuffer()
+    for i in range(lines):
+        buffer.append(
+            i, _labels("pod"), f"line {i} é {'match' if i % 1000 == 0 else ''}"
+        )
+    return buffer
+
+
+def test_search_returns_the_newest_matches_with_ranges():
+    buffer = _filled()
+    pattern = log_buffer.search_pattern("MATCH")
+    matches, complete = buffer.search(pattern, 3)
+    assert complete
+    assert [entry[0] for entry, _ in matches] == [7000, 8000, 9000]
+    entry, ranges = matches[-1]
+    # character, not byte, offsets
+    start, end = ranges[0]
+    assert entry[2][start:end] == "match"
+
+
+def test_search_stops_at_the_deadline():
+    buffer = _filled()
+    pattern = log_buffer.search_pattern("match")
+    matches, complete = buffer.search(pattern, 100, deadline=time.monotonic() - 1)
+    assert (matches, complete) == ([], False)
+
+
+def test_search_windows_are_bounded(monkeypatch):
+    monkeypatch.setattr(log_buffer, "_SEARCH_WINDOW_LINES", 100)
+    monkeypatch.setattr(log_buffer, "_SEARCH_MAX_WINDOW_LINES", 400)
+    buffer = _filled()
+    scanned = []
+
+    class Pattern:
+        def finditer(self, text, first, last):
+            scanned.append(text[first:last].count(b"\n") + 1)
+            return iter(())
+
+    matches, complete = buffer.search(Pattern(), 10)
+    assert complete and not matches
+    # windows double, up to the max, and cover every line once
+    assert scanned[:4] == [100, 200, 400, 400]
+    assert max(scanned) == 400
+    assert sum(scanned) == 10_000
+
+
+def test_search_queries_are_bounded():
+    with pytest.raises(ValueError):
+        log_buffer.search_pattern("a" * (log_buffer.MAX_SEARCH_QUERY_CHARS + 1))
+    assert log_buffer.search_pattern("a.b").search(b"a.b")
+    assert not log_buffer.search_pattern("a.b").search(b"axb")
+    assert log_buffer.search_pattern("a.b", regex=True).search(b"axb")
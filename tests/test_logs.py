@@ -0,0 +1,132 @@
+import asyncio
+import json
+import subprocess
+import sys
+
+import aiohttp
+from aiohttp import web
+
+from konduktor.dashboard.backend import logs
+
+POD_A = {"k8s_namespace_name": "default", "k8s_pod_name": "pod-a"}
+POD_B = {"k8s_namespace_name": "default", "k8s_pod_name": "pod-b"}
+
+
+def _message(*entries):
+    return json.dumps(
+        {
+            "streams": [
+                {"stream": labels, "values": [[str(ts), line]]}
+                for ts, labels, line in entries
+            ]
+        }
+    )
+
+
+async def _tail(connections, expected_lines):
+    """Tails a fake Loki that sends each of `connections`' messages on a
+    connection of its own, then closes it
+
+    Returns:
+        the lines received, and the query parameters of every connection
+    """
+    requests = []
+
+    async def handler(request):
+        requests.append(dict(request.query))
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        messages = connections[min(len(requests), len(connections)) - 1]
+        for message in messages:
+            await ws.send_str(message)
+        await ws.close()
+        return ws
+
+    app = web.Application()
+    app.router.add_get(logs.TAIL_URL, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    logs.LOKI_ENDPOINT = f"http://127.0.0.1:{port}"
+    lines = []
+    tail = logs.tail_logs(["default"], 1000)
+
+    async def read():
+        async for entries in tail:
+            lines.extend(entries)
+            if len(lines) >= expected_lines:
+                break
+
+    try:
+        await asyncio.wait_for(read(), 10)
+    finally:
+        await tail.aclose()
+        await logs.close()
+        await runner.cleanup()
+    return lines, requests
+
+
+def test_tail_resumes_after_the_newest_line(monkeypatch):
+    monkeypatch.setattr(logs, "LOKI_ENDPOINT", logs.LOKI_ENDPOINT)
+    monkeypatch.setattr(logs.loki_client, "backoff", lambda attempt: 0)
+    connections = [
+        [
+            _message((1000, POD_A, "first"), (1001, POD_B, "second")),
+            _message((1002, POD_A, "third")),
+        ],
+        # Loki resends the lines at the timestamp the tail resumed from
+        [_message((1002, POD_A, "third"), (1002, POD_B, "fourth"))],
+        [_message((1003, POD_A, "fifth"))],
+    ]
+    lines, requests = asyncio.run(_tail(connections, 5))
+    assert [line for _, _, line in lines] == [
+        "first",
+        "second",
+        "third",
+        "fourth",
+        "fifth",
+    ]
+    assert lines[1] == (1001, POD_B, "second")
+    assert [request["start"] for request in requests] == ["1000", "1002", "1002"]
+    assert requests[0]["query"] == '{k8s_namespace_name=~"default"}'
+
+
+def test_tail_reconnects_after_failures(monkeypatch):
+    monkeypatch.setattr(logs, "LOKI_ENDPOINT", "http://127.0.0.1:1")
+    attempts = []
+
+    def backoff(attempt):
+        attempts.append(attempt)
+        if len(attempts) == 3:
+            raise aiohttp.ClientError("giving up")
+        return 0
+
+    monkeypatch.setattr(logs.loki_client, "backoff", backoff)
+
+    async def tail():
+        try:
+            async for _ in logs.tail_logs(["default"], 1000):
+                pass
+        finally:
+            await logs.close()
+
+    try:
+        asyncio.run(tail())
+    except aiohttp.ClientError:
+        pass
+    # the backoff grows while Loki is unreachable
+    assert attempts == [0, 1, 2]
+
+
+def test_dashboard_does_not_import_the_controller():
+    code = (
+        "import sys\n"
+        "from konduktor.dashboard.backend import logs, sockets\n"
+        "print([m for m in sys.modules if m.startswith('konduktor.controller')])\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
@@ -0,0 +1,208 @@
+import json
+import random
+import time
+
+import pytest
+
+from konduktor import loki_client
+from konduktor.controller import parse, replay
+
+SECOND = 10**9
+NODE_A = {"k8s_node_name": "node-a"}
+NODE_B = {"k8s_node_name": "node-b"}
+QUERY = '{k8s_node_name=~".+"}'
+
+
+def _serve(entries):
+    loki = replay.FakeLoki(entries)
+    return loki, f"{loki.start()}{parse.QUERY_URL}"
+
+
+def test_query_range_reads_past_the_default_limit():
+    now = time.time_ns()
+    entries = [(now - SECOND + i, NODE_A, f"line {i}") for i in range(250)]
+    loki, url = _serve(entries)
+    try:
+        lines = [
+            line for _, _, line in loki_client.query_range(url, QUERY, now - 5 * SECOND)
+        ]
+    finally:
+        loki.stop()
+    assert lines == [line for _, _, line in entries]
+
+
+def test_query_range_pages_through_shared_timestamps():
+    now = time.time_ns()
+    # three lines per timestamp, alternating streams
+    entries = [
+        (now - SECOND + i // 3, NODE_A if i % 2 else NODE_B, f"line {i}")
+        for i in range(40)
+    ]
+    loki, url = _serve(entries)
+    try:
+        got = list(loki_client.query_range(url, QUERY, now - 5 * SECOND, limit=4))
+    finally:
+        loki.stop()
+    assert sorted(line for _, _, line in got) == sorted(line for _, _, line in entries)
+    assert len(got) == len(entries)
+
+
+def test_query_range_skips_timestamps_over_the_limit():
+    now = time.time_ns()
+    crowded = [(now - 2 * SECOND, NODE_A, f"crowded {i}") for i in range(5)]
+    after = [(now - SECOND, NODE_A, "after")]
+    loki, url = _serve(crowded + after)
+    try:
+        got = list(loki_client.query_range(url, QUERY, now - 5 * SECOND, limit=3))
+    finally:
+        loki.stop()
+    assert [line for _, _, line in got][-1] == "after"
+    assert len(got) == 4
+
+
+def test_query_range_many_shares_the_window():
+    now = time.time_ns()
+    entries = [
+        (now - SECOND, NODE_A, "a"),
+        (now - SECOND, NODE_B, "b"),
+    ]
+    loki, url = _serve(entries)
+    try:
+        results = loki_client.query_range_many(
+            url,
+            ['{k8s_node_name="node-a"}', '{k8s_node_name="node-b"}'],
+            now - 5 * SECOND,
+            now,
+        )
+    finally:
+        loki.stop()
+    assert results == [[(NODE_A, now - SECOND, "a")], [(NODE_B, now - SECOND, "b")]]
+
+
+def test_query_range_stops_when_loki_is_down(monkeypatch):
+    monkeypatch.setattr(loki_client, "MAX_RETRIES", 0)
+    loki, url = _serve([])
+    loki.stop()
+    assert list(loki_client.query_range(url, QUERY, time.time_ns() - SECOND)) == []
+    # so that callers retry the window
+    assert loki_client.query_range_many(url, [QUERY], time.time_ns() - SECOND) == [None]
+
+
+# lines that look like the end of a value, or of a stream's values, and
+# multi-byte characters that chunks split in the middle of
+TRICKY_LINES = [
+    "plain",
+    'quoted "]" in a line',
+    'ends like the values "]]',
+    'escaped \\" quote and \\n newline',
+    "gpu \u00e9t\u00e9 \U0001f525 \u65e5\u672c",
+    "",
+]
+
+
+def _response(streams):
+    return json.dumps(
+        {
+            "status": "success",
+            "data": {
+                "resultType": "streams",
+                "result": [
+                    {"stream": labels, "values": values} for labels, values in streams
+                ],
+                "stats": {"summary": {"bytesProcessedPerSecond": 1}},
+            },
+        },
+        ensure_ascii=False,
+    ).encode()
+
+
+def _expected(body):
+    return [
+        (stream["stream"], int(ts), line)
+        for stream in json.loads(body)["data"]["result"]
+        for ts, line in stream["values"]
+    ]
+
+
+def _decode(chunks):
+    decoder = loki_client.EntryDecoder()
+    entries = []
+    for chunk in chunks:
+        entries.extend(decoder.feed(chunk))
+    entries.extend(decoder.close())
+    return entries
+
+
+TRICKY = _response(
+    [
+        (NODE_A, [[str(1000 + i), line] for i, line in enumerate(TRICKY_LINES)]),
+        (NODE_B, [["2000", "b"]]),
+        ({}, []),
+    ]
+)
+
+
+def test_decoder_at_every_chunk_boundary():
+    expected = _expected(TRICKY)
+    for cut in range(len(TRICKY) + 1):
+        assert _decode([TRICKY[:cut], TRICKY[cut:]]) == expected, cut
+
+
+def test_decoder_byte_by_byte():
+    assert _decode(TRICKY[i : i + 1] for i in range(len(TRICKY))) == _expected(TRICKY)
+
+
+def test_decoder_random_chunks():
+    rng = random.Random(0)
+    streams = [
+        (
+            {"k8s_node_name": f"node-{n}"},
+            [
+                [str(n * 10**6 + i), rng.choice(TRICKY_LINES) * rng.randint(1, 50)]
+                for i in range(200)
+            ],
+        )
+        for n in range(10)
+    ]
+    body = _response(streams)
+    expected = _expected(body)
+    for _ in range(20):
+        chunks = []
+        pos = 0
+        while pos < len(body):
+            size = rng.randint(1, 4096)
+            chunks.append(body[pos : pos + size])
+            pos += size
+        assert _decode(chunks) == expected
+
+
+def test_decoder_reads_values_before_labels():
+    body = (
+        b'{"data": {"result": [{"values": [["1", "x"], ["2", "y\\"]"]], '
+        b'"stream": {"k8s_node_name": "node-a"}}]}}'
+    )
+    for cut in range(len(body) + 1):
+        entries = _decode([body[:cut], body[cut:]])
+        assert entries == [(NODE_A, 1, "x"), (NODE_A, 2, 'y"]')], cut
+
+
+def test_decoder_shares_labels_within_a_stream():
+    entries = _decode([TRICKY])
+    assert entries[0][0] is entries[1][0]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        # truncated inside a value, between values and before the result ends
+        TRICKY[: TRICKY.index(b"quoted") + 3],
+        TRICKY[: TRICKY.index(b'"2000"')],
+        TRICKY[: TRICKY.index(b', "stats"') - 1],
+        # not a query_range response
+        b'{"status": "error"}',
+        b'{"data": {"result": [["1", "x"]]}}',
+    ],
+)
+def test_decoder_rejects_truncated_and_malformed_responses(body):
+    with pytest.raises(ValueError):
+        _decode([body[:7], body[7:]])
@@ -0,0 +1,149 @@
+# ruff: noqa: E501
+import kubernetes
+import pytest
+
+from konduktor import kube_client
+from konduktor.controller import nccl, node
+
+# tail of all_reduce_perf output, as printed by nccl-tests
+OUTPUT = """\
+# nThread 1 nGpus 8 minBytes 536870912 maxBytes 8589934592 step: 2(factor) \
+warmup iters: 5 iters: 20 agg iters: 1 validation: 1 graph: 0
+#
+# Using devices
+#  Rank  0 Group  0 Pid     41 on nccl-test-0 device  0 [0x18] NVIDIA H100 80GB HBM3
+#
+#                                                              out-of-place                       in-place
+#       size         count      type   redop    root     time   algbw   busbw #wrong     time   algbw   busbw #wrong
+#        (B)    (elements)                               (us)  (GB/s)  (GB/s)            (us)  (GB/s)  (GB/s)
+   536870912     134217728     float     sum      -1   2786.1  192.70  337.22      0   2779.4  193.16  338.03      0
+  1073741824     268435456     float     sum      -1   5362.0  200.25  350.44      0   5360.8  200.30  350.52      0
+  2147483648     536870912     float     sum      -1    10497  204.58  358.02      0    10496  204.61  358.06      0
+  4294967296    1073741824     float     sum      -1    20723  207.25  362.70      0    20724  207.25  362.69      0
+  8589934592    2147483648     float     sum      -1    41192  208.53  364.93      0    41190  208.54  364.95      0
+# Out of bounds values : 0 OK
+# Avg bus bandwidth    : 355.254
+#
+"""
+
+
+def test_parse_busbw():
+    assert nccl.parse_busbw(OUTPUT) == pytest.approx(355.254)
+
+
+def test_parse_busbw_of_an_unfinished_test():
+    unfinished = OUTPUT.split("# Out of bounds")[0]
+    assert nccl.parse_busbw(unfinished) is None
+    assert nccl.parse_busbw("") is None
+
+
+def test_launcher_waits_for_every_worker():
+    command = nccl._command("test", 2)
+    for host in ("test-0.test", "test-1.test"):
+        assert command.index(host) < command.index("mpirun")
+    assert "/usr/sbin/sshd" in command
+    # single node tests need neither ssh nor mpirun
+    assert "mpirun" not in nccl._command("test", 1)
+
+
+def test_multi_node_pods_are_ready_once_sshd_listens(monkeypatch):
+    monkeypatch.setattr(nccl, "NCCL_TEST_SSH_SECRET", "nccl-ssh")
+    spec = nccl._job("test", ["a", "b"])["spec"]["template"]["spec"]
+    (container,) = spec["containers"]
+    assert container["readinessProbe"]["tcpSocket"]["port"] == 22
+    assert container["volumeMounts"][0]["mountPath"] == "/root/.ssh"
+    assert spec["volumes"][0]["secret"]["secretName"] == "nccl-ssh"
+    single = nccl._job("test", ["a"])["spec"]["template"]["spec"]
+    assert "readinessProbe" not in single["containers"][0]
+    assert not single["volumes"]
+
+
+class FakeApi:
+    """Core and batch API that records created and deleted test resources"""
+
+    def __init__(self, fail_job=False, phase="Succeeded", log=""):
+        self.fail_job = fail_job
+        # of the finished test pods, and the launcher's output
+        self.phase = phase
+        self.log = log
+        self.created = []
+        self.deleted = []
+
+    def create_namespaced_service(self, namespace, body, **kwargs):
+        self.created.append(("service", body["metadata"]["name"]))
+
+    def create_namespaced_job(self, namespace, body, **kwargs):
+        if self.fail_job:
+            raise kube_client.api_exception()(status=403, reason="Forbidden")
+        self.created.append(("job", body["metadata"]["name"]))
+
+    def list_namespaced_pod(self, namespace, label_selector, **kwargs):
+        pod = kubernetes.client.V1Pod(
+            metadata=kubernetes.client.V1ObjectMeta(name="test-0"),
+            status=kubernetes.client.V1PodStatus(phase=self.phase),
+        )
+        return kubernetes.client.V1PodList(items=[pod, pod])
+
+    def read_namespaced_pod_log(self, name, namespace, **kwargs):
+        return self.log
+
+    def delete_namespaced_service(self, name, namespace, **kwargs):
+        self.deleted.append(("service", name))
+
+    def delete_namespaced_job(self, name, namespace, **kwargs):
+        if ("job", name) not in self.created:
+            raise kube_client.api_exception()(status=404, reason="Not Found")
+        self.deleted.append(("job", name))
+
+
+@pytest.fixture
+def api(monkeypatch):
+    def make(**kwargs):
+        fake = FakeApi(**kwargs)
+        monkeypatch.setattr(kube_client, "core_api", lambda: fake)
+        monkeypatch.setattr(kube_client, "batch_api", lambda: fake)
+        return fake
+
+    return make
+
+
+def test_service_is_deleted_if_the_job_cannot_be_created(api):
+    fake = api(fail_job=True)
+    with pytest.raises(kube_client.api_exception()):
+        nccl.run_test(["a", "b"])
+    assert [kind for kind, _ in fake.created] == ["service"]
+    assert fake.deleted == fake.created
+
+
+def test_unscheduled_pods_are_inconclusive(api, monkeypatch):
+    fake = api()
+    monkeypatch.setattr(nccl, "_wait_for_pods", lambda name, num_nodes: False)
+
+    def wait_for_launcher(name):
+        raise AssertionError("launcher waited for before the pods were ready")
+
+    monkeypatch.setattr(nccl, "_wait_for_launcher", wait_for_launcher)
+    assert nccl.run_test(["a", "b"]) is None
+    assert sorted(fake.deleted) == sorted(fake.created)
+    assert len(fake.created) == 2
+
+
+@pytest.mark.parametrize(
+    "phase,log,busbw",
+    [
+        ("Succeeded", OUTPUT, 355.254),
+        # crashed mid test, e.g. on an NCCL error
+        ("Failed", OUTPUT.split("# Out of bounds")[0] + "NCCL error", 0.0),
+        # failed after reporting the bandwidth
+        ("Failed", OUTPUT, 355.254),
+    ],
+)
+def test_result_of_a_finished_launcher(api, phase, log, busbw):
+    api(phase=phase, log=log)
+    assert nccl.run_test(["a", "b"]) == pytest.approx(busbw)
+
+
+def test_crashed_tests_fail_the_node(api):
+    api(phase="Failed", log="NCCL WARN Cuda failure 'unspecified launch failure'")
+    assert node.nccl_single_test("a") is False
+    assert node.nccl_pair_test("a", "b") is False
@@ -0,0 +1,184 @@
+import time
+
+import numpy as np
+import pytest
+
+from konduktor.dashboard.backend import queue_stats
+
+NOW = 1_700_000_000.0
+
+
+def _iso(ts):
+    return time.strftime(queue_stats._TIME_FORMAT, time.gmtime(ts))
+
+
+def _job(name, created, priority=0, queue="user-queue", admitted=None, cluster=None):
+    """Workload created `created` seconds before `NOW`, admitted `admitted`
+    seconds after its creation to `cluster`, or pending
+    """
+    job = {
+        "metadata": {
+            "name": name,
+            "namespace": "team-a",
+            "creationTimestamp": _iso(NOW - created),
+        },
+        "spec": {"queueName": queue, "priority": priority},
+        "status": {},
+    }
+    if admitted is not None:
+        job["status"] = {
+            "admission": {"clusterQueue": cluster or "cluster-queue"},
+            "conditions": [
+                {
+                    "type": "Admitted",
+                    "status": "True",
+                    "lastTransitionTime": _iso(NOW - created + admitted),
+                }
+            ],
+        }
+    return job
+
+
+def _columns(*jobs, capacity=queue_stats.INITIAL_CAPACITY):
+    columns = queue_stats.QueueColumns(capacity=capacity)
+    for job in jobs:
+        columns.update(job["metadata"]["name"], job)
+    return columns
+
+
+def _by_name(stats, key, name_key="name"):
+    return {queue[name_key]: queue for queue in stats[key]}
+
+
+def test_counts_and_wait_percentiles():
+    waits = [10, 20, 30, 40, 1000]
+    jobs = [
+        _job(f"done-{i}", created=2000, admitted=wait) for i, wait in enumerate(waits)
+    ]
+    jobs += [_job("pending-0", created=300), _job("pending-1", created=100)]
+    stats = _columns(*jobs).stats(now=NOW)
+    assert (stats["total"], stats["admitted"], stats["pending"]) == (7, 5, 2)
+    (local,) = stats["localQueues"]
+    assert local["localQueueName"] == "user-queue"
+    assert local["clusterQueue"] == "cluster-queue"
+    # nearest rank percentiles
+    assert local["waitSeconds"] == {"p50": 30, "p90": 40, "p99": 40, "max": 1000}
+    assert local["pendingSeconds"] == {"p50": 100, "p90": 100, "p99": 100, "max": 300}
+
+
+def test_percentiles_match_numpy_per_group():
+    rng = np.random.default_rng(0)
+    groups = rng.integers(0, 5, 1000)
+    values = rng.exponential(600, 1000)
+    counts, percentiles = queue_stats._percentiles(groups, values, 6)
+    assert counts.tolist() == np.bincount(groups, minlength=6).tolist()
+    for group in range(5):
+        expected = np.percentile(
+            values[groups == group], [50, 90, 99, 100], method="inverted_cdf"
+        )
+        got = [percentiles[name][group] for name, _ in queue_stats.PERCENTILES]
+        # inverted_cdf rounds ranks up, nearest rank rounds them down
+        assert got[-1] == expected[-1]
+        for value, bound in zip(got, expected):
+            assert value <= bound
+    # an empty group has no percentiles
+    assert all(np.isnan(column[5]) for column in percentiles.values())
+
+
+def test_pending_workloads_are_routed_through_their_local_queue():
+    stats = _columns(
+        _job("admitted", created=100, admitted=10, cluster="gpu-queue"),
+        _job("pending", created=50),
+        _job("elsewhere", created=50, queue="other-queue"),
+    ).stats(now=NOW)
+    cluster_queues = _by_name(stats, "clusterQueues")
+    assert cluster_queues["gpu-queue"]["admitted"] == 1
+    assert cluster_queues["gpu-queue"]["pending"] == 1
+    # never admitted anywhere, so its ClusterQueue is not known
+    assert cluster_queues[queue_stats.UNKNOWN]["pending"] == 1
+    local_queues = _by_name(stats, "localQueues", "localQueueName")
+    assert local_queues["other-queue"]["clusterQueue"] == queue_stats.UNKNOWN
+
+
+def test_unknown_times_are_counted_but_not_waited():
+    job = _job("admitted", created=100, admitted=10)
+    job["status"]["conditions"] = []
+    stats = _columns(job).stats(now=NOW)
+    (local,) = stats["localQueues"]
+    assert local["admitted"] == 1
+    assert local["waitSeconds"] is None
+
+
+def test_priority_inversions():
+    stats = _columns(
+        # waited while `low` was admitted
+        _job("high", created=1000, priority=100),
+        _job("low", created=2000, priority=0, admitted=1500),
+        # created after `low` was admitted
+        _job("late", created=100, priority=100),
+        # higher priority than anything admitted since it was created
+        _job("lowest", created=1000, priority=-1),
+    ).stats(now=NOW)
+    inversions = _by_name(stats, "clusterQueues")["cluster-queue"]["priorityInversions"]
+    assert inversions["count"] == 1
+    (workload,) = inversions["workloads"]
+    assert workload["pending"] == "team-a/high"
+    assert workload["admitted"] == "team-a/low"
+    assert workload["admittedAt"] == NOW - 2000 + 1500
+
+
+def test_inversions_are_listed_by_priority(monkeypatch):
+    monkeypatch.setattr(queue_stats, "MAX_INVERSIONS", 2)
+    jobs = [_job("low", created=2000, priority=0, admitted=1500)]
+    jobs += [_job(f"high-{i}", created=1000, priority=i + 1) for i in range(5)]
+    stats = _columns(*jobs).stats(now=NOW)
+    inversions = _by_name(stats, "clusterQueues")["cluster-queue"]["priorityInversions"]
+    assert inversions["count"] == 5
+    assert [workload["priority"] for workload in inversions["workloads"]] == [5, 4]
+
+
+def test_updates_removals_and_growth():
+    columns = _columns(capacity=2)
+    for i in range(5):
+        columns.update(f"uid-{i}", _job(f"job-{i}", created=100))
+    assert len(columns) == 5
+    assert len(columns.used) >= 5
+    # admission updates the workload's slot in place
+    columns.update("uid-0", _job("job-0", created=100, admitted=10))
+    columns.remove("uid-1")
+    columns.remove("missing")
+    stats = columns.stats(now=NOW)
+    assert (stats["total"], stats["admitted"], stats["pending"]) == (4, 1, 3)
+    # freed slots are reused
+    capacity = len(columns.used)
+    columns.update("uid-5", _job("job-5", created=100))
+    assert len(columns.used) == capacity
+
+
+def test_copy_is_independent():
+    columns = _columns(_job("pending", created=100))
+    copied = columns.copy()
+    columns.update("admitted", _job("admitted", created=100, admitted=10))
+    columns.remove("pending")
+    assert copied.stats(now=NOW)["pending"] == 1
+    assert copied.stats(now=NOW)["admitted"] == 0
+
+
+def test_empty():
+    stats = queue_stats.QueueColumns().stats(now=NOW)
+    assert stats == {
+        "total": 0,
+        "admitted": 0,
+        "pending": 0,
+        "localQueues": [],
+        "clusterQueues": [],
+    }
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [("2024-01-02T03:04:05Z", 1704164645.0), (None, None), ("", None)],
+)
+def test_timestamp(value, expected):
+    ts = queue_stats._timestamp(value)
+    assert np.isnan(ts) if expected is None else ts == expected
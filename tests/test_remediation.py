@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+from konduktor.controller import remediation
+
+
+def test_guard_caps_each_pool():
+    guard = remediation.BlastRadiusGuard(0.2, 3600)
+    assert [guard.reserve("a", 10) for _ in range(3)] == [True, True, False]
+    # pools are counted apart, and the smallest may taint a node
+    assert guard.reserve("b", 1)
+    assert not guard.reserve("b", 1)
+    guard.release("a")
+    assert guard.reserve("a", 10)
+
+
+def test_guard_splits_the_allowance_across_shards():
+    guard = remediation.BlastRadiusGuard(0.2, 3600, shards=4)
+    assert guard.limit(100) == 5
+    # every shard may still taint one node
+    assert guard.limit(10) == 1
+    assert [guard.reserve("a", 100) for _ in range(6)] == [True] * 5 + [False]
+
+
+def test_guard_forgets_taints_outside_the_window(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    guard = remediation.BlastRadiusGuard(0.1, 60)
+    assert guard.reserve("a", 10)
+    assert not guard.reserve("a", 10)
+    now[0] += 61
+    assert guard.reserve("a", 10)
+
+
+def test_guard_dump_and_restore(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    guard = remediation.BlastRadiusGuard(0.2, 60)
+    guard.reserve("a", 10)
+    now[0] += 30
+    guard.reserve("a", 10)
+    guard.reserve("b", 10)
+    dumped = guard.dump()
+    assert dumped == {"a": [1000.0, 1030.0], "b": [1030.0]}
+
+    restored = remediation.BlastRadiusGuard(0.2, 60)
+    restored.restore(dumped)
+    assert not restored.reserve("a", 10)
+    assert restored.reserve("b", 10)
+    # the first taint left the window while the controller was down
+    now[0] += 40
+    restored = remediation.BlastRadiusGuard(0.2, 60)
+    restored.restore(dumped)
+    assert restored.dump() == {"a": [1030.0], "b": [1030.0]}
+
+
+def test_executor_blocks_beyond_the_allowance():
+    tainted = []
+
+    def taint(node):
+        tainted.append(node)
+        return True
+
+    async def flood():
+        executor = remediation.RemediationExecutor(
+            taint,
+            lambda: {f"node-{i}": "pool" for i in range(20)},
+            rate=1000,
+            max_pool_fraction=0.2,
+            shards=2,
+            audit=remediation.AuditLog(""),
+        )
+        tasks = [await executor.submit(f"node-{i}") for i in range(5)]
+        return await asyncio.gather(*tasks)
+
+    results = asyncio.run(flood())
+    assert (
+        results == [remediation.RESULT_PATCHED] * 2 + [remediation.RESULT_BLOCKED] * 3
+    )
+    assert tainted == ["node-0", "node-1"]
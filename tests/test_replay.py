@@ -0,0 +1,24 @@
+import logging
+
+import pytest
+
+from konduktor import loki_client
+from konduktor.controller import replay
+
+# seconds from a fault line being queryable to its node being tainted
+MAX_P99_LATENCY_SECONDS = 15
+
+
+@pytest.mark.parametrize("mode", ["poll", "tail"])
+def test_replay(monkeypatch, mode):
+    # pages of a few lines so every poll pages through its window
+    monkeypatch.setattr(loki_client, "QUERY_LIMIT", 10)
+    replay._quiet(logging.ERROR)
+    entries, faulty = replay.synthetic(num_nodes=32, seconds=300)
+    report = replay.replay(
+        entries, faulty, speed=60, mode=mode, correlation_window=5, settle=2
+    )
+    assert report.ingested == report.classified
+    assert report.precision == 1
+    assert report.recall == 1
+    assert report.latency(99) < MAX_P99_LATENCY_SECONDS
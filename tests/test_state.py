@@ -0,0 +1,217 @@
+import asyncio
+import time
+
+import kubernetes
+
+from konduktor import kube_client, loki_client
+from konduktor.controller import (
+    correlate,
+    faults,
+    launch,
+    parse,
+    remediation,
+    replay,
+    state,
+    tail,
+)
+
+SECOND = 10**9
+NODE_A = {"k8s_node_name": "node-a"}
+NODE_B = {"k8s_node_name": "node-b"}
+
+
+def _state(path, guard=None) -> state.ControllerState:
+    return state.ControllerState(
+        faults.FaultStore(),
+        correlate.Correlator(),
+        state.FileBackend(str(path)),
+        guard=guard,
+    )
+
+
+def test_cursors_are_kept_per_stream_across_restarts(tmp_path):
+    path = tmp_path / "state.json"
+    now = time.time_ns()
+    saved = _state(path)
+    assert saved.advance(faults.SOURCE_DMESG, NODE_A, now, "ok")
+    # node-b's older line is classified after node-a's
+    assert saved.advance(faults.SOURCE_DMESG, NODE_B, now - SECOND, "Xid 79")
+    saved.save(saved.snapshot())
+
+    restored = _state(path)
+    restored.load()
+    cursor = restored.resume_cursor(faults.SOURCE_DMESG)
+    assert cursor is not None
+    assert cursor.floor == now - tail.LOOKBACK_SECONDS * SECOND
+    assert not restored.advance(faults.SOURCE_DMESG, NODE_A, now, "ok")
+    assert not restored.advance(faults.SOURCE_DMESG, NODE_B, now - SECOND, "Xid 79")
+    assert restored.advance(faults.SOURCE_DMESG, NODE_B, now - SECOND // 2, "late")
+
+
+def test_blast_radius_is_kept_across_restarts(tmp_path):
+    path = tmp_path / "state.json"
+    guard = remediation.BlastRadiusGuard(0.1, 3600)
+    saved = _state(path, guard)
+    assert guard.reserve("pool-a", 10)
+    saved.save(saved.snapshot())
+
+    guard = remediation.BlastRadiusGuard(0.1, 3600)
+    _state(path, guard).load()
+    # the restarted controller already used pool-a's allowance
+    assert not guard.reserve("pool-a", 10)
+    assert guard.reserve("pool-b", 10)
+
+
+def test_stale_cursors_are_not_resumed(tmp_path):
+    saved = _state(tmp_path / "state.json")
+    old = time.time_ns() - (state.MAX_RESUME_SECONDS + 60) * SECOND
+    saved.advance(faults.SOURCE_POD, NODE_A, old, "ok")
+    assert saved.resume_cursor(faults.SOURCE_POD) is None
+
+
+def test_poll_resumes_every_line_since_the_cursor(monkeypatch):
+    monkeypatch.setattr(loki_client, "QUERY_LIMIT", 10)
+    now = time.time_ns()
+    # a synthetic cluster's logs from the last ~17 minutes, while we were down
+    entries, _ = replay.synthetic(num_nodes=8, seconds=600)
+    start_ns = now - 20 * 60 * SECOND
+    loki = replay.FakeLoki(replay._replayed(entries, start_ns, 0.6))
+    expected = sum(len(loki.lines(query(None))) for query, _ in launch.SOURCES.values())
+    monkeypatch.setattr(parse, "LOG_ENDPOINT", loki.start())
+
+    async def resume():
+        controller = launch.Controller()
+        controller.state.backend = None
+        for source in launch.SOURCES:
+            controller.state.advance(source, NODE_A, start_ns - 1, "before")
+        ingest = asyncio.create_task(controller.ingest_poll())
+        deadline = time.monotonic() + 10
+        while controller.lines.qsize() < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        controller.stop.set()
+        await ingest
+        return controller.lines.qsize()
+
+    try:
+        assert expected > loki_client.QUERY_LIMIT * 2
+        assert asyncio.run(resume()) == expected
+    finally:
+        loki.stop()
+
+
+class FakeConfigMapApi:
+    """ConfigMaps with writes checked against resourceVersions"""
+
+    def __init__(self):
+        self.config_maps = {}
+        self.version = 0
+
+    def _stored(self, name, body):
+        self.version += 1
+        metadata = body["metadata"]
+        self.config_maps[name] = kubernetes.client.V1ConfigMap(
+            metadata=kubernetes.client.V1ObjectMeta(
+                name=name,
+                namespace=metadata["namespace"],
+                resource_version=str(self.version),
+            ),
+            data=body["data"],
+        )
+        return self.config_maps[name]
+
+    def read_namespaced_config_map(self, name, namespace, **kwargs):
+        if name not in self.config_maps:
+            raise kube_client.api_exception()(status=404, reason="NotFound")
+        return self.config_maps[name]
+
+    def create_namespaced_config_map(self, namespace, body, **kwargs):
+        name = body["metadata"]["name"]
+        if name in self.config_maps:
+            raise kube_client.api_exception()(status=409, reason="AlreadyExists")
+        return self._stored(name, body)
+
+    def replace_namespaced_config_map(self, name, namespace, body, **kwargs):
+        current = self.config_maps[name]
+        if body["metadata"]["resourceVersion"] != current.metadata.resource_version:
+            raise kube_client.api_exception()(status=409, reason="Conflict")
+        return self._stored(name, body)
+
+
+def test_configmap_is_not_overwritten_by_a_replica_that_lost_its_shard(
+    monkeypatch,
+):
+    monkeypatch.setattr(kube_client, "_core_api", FakeConfigMapApi())
+    now = time.time_ns()
+    old_leader = state.ControllerState(
+        faults.FaultStore(),
+        correlate.Correlator(),
+        state.ConfigMapBackend(),
+        # its Lease was taken over
+        owns=lambda: False,
+    )
+    old_leader.load()
+    old_leader.advance(faults.SOURCE_DMESG, NODE_A, now - SECOND, "old")
+    old_leader.save(old_leader.snapshot())
+
+    new_leader = state.ControllerState(
+        faults.FaultStore(), correlate.Correlator(), state.ConfigMapBackend()
+    )
+    new_leader.load()
+    new_leader.advance(faults.SOURCE_DMESG, NODE_A, now, "new")
+    new_leader.save(new_leader.snapshot())
+
+    old_leader.advance(faults.SOURCE_DMESG, NODE_B, now, "stale")
+    old_leader.save(old_leader.snapshot())
+    # not retried on the next flush either
+    assert not old_leader.dirty
+
+    restored = state.ControllerState(
+        faults.FaultStore(), correlate.Correlator(), state.ConfigMapBackend()
+    )
+    restored.load()
+    assert restored.cursors[faults.SOURCE_DMESG].ts == now
+    assert not restored.advance(faults.SOURCE_DMESG, NODE_A, now, "new")
+    assert restored.advance(faults.SOURCE_DMESG, NODE_B, now, "stale")
+
+
+def test_configmap_written_by_someone_else_is_overwritten_by_its_owner(
+    monkeypatch,
+):
+    api = FakeConfigMapApi()
+    monkeypatch.setattr(kube_client, "_core_api", api)
+    now = time.time_ns()
+    controller_state = state.ControllerState(
+        faults.FaultStore(),
+        correlate.Correlator(),
+        state.ConfigMapBackend(),
+        owns=lambda: True,
+    )
+    controller_state.load()
+    controller_state.advance(faults.SOURCE_DMESG, NODE_A, now - SECOND, "first")
+    controller_state.save(controller_state.snapshot())
+
+    # edited by hand, which changes its resourceVersion
+    edited = api.config_maps[state.STATE_CONFIGMAP]
+    api.replace_namespaced_config_map(
+        state.STATE_CONFIGMAP,
+        state.STATE_NAMESPACE,
+        {
+            "metadata": {
+                "namespace": state.STATE_NAMESPACE,
+                "resourceVersion": edited.metadata.resource_version,
+            },
+            "data": edited.data,
+        },
+    )
+    controller_state.advance(faults.SOURCE_DMESG, NODE_A, now, "second")
+    controller_state.save(controller_state.snapshot())
+    # the conflicting write is retried on the next flush
+    assert controller_state.dirty
+    controller_state.save(controller_state.snapshot())
+    assert not controller_state.dirty
+
+    restored = state.ControllerState(
+        faults.FaultStore(), correlate.Correlator(), state.ConfigMapBackend()
+    )
+    restored.load()
+    assert restored.cursors[faults.SOURCE_DMESG].ts == now
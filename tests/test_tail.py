@@ -0,0 +1,166 @@
+import json
+import threading
+import time
+import urllib.parse
+
+import pytest
+import websocket
+
+from konduktor.controller import replay, tail
+
+SECOND = 10**9
+NODE_A = {"k8s_node_name": "node-a"}
+NODE_B = {"k8s_node_name": "node-b"}
+XID = "NVRM: Xid (PCI:0000:b5:00): 79, GPU has fallen off the bus."
+
+
+def test_cursor_accepts_late_lines_of_other_streams():
+    cursor = tail.LogCursor(1000)
+    assert cursor.advance(NODE_A, 2000, "ok")
+    # node-b's line arrives after node-a's newer line
+    assert cursor.advance(NODE_B, 1500, XID)
+    assert not cursor.advance(NODE_B, 1500, XID)
+    assert not cursor.advance(NODE_A, 2000, "ok")
+
+
+def test_cursor_orders_lines_within_a_stream():
+    cursor = tail.LogCursor(1000)
+    assert cursor.advance(NODE_A, 2000, "first")
+    assert cursor.advance(NODE_A, 2000, "second")
+    assert not cursor.advance(NODE_A, 1999, "older")
+    assert cursor.advance(NODE_A, 2001, "newer")
+
+
+def test_cursor_drops_lines_older_than_the_lookback():
+    cursor = tail.LogCursor(0, lookback=100)
+    assert cursor.advance(NODE_A, 1000, "ok")
+    assert cursor.floor == 900
+    assert not cursor.advance(NODE_B, 899, XID)
+    assert cursor.advance(NODE_B, 900, XID)
+    assert not tail.LogCursor(1000).advance(NODE_A, 999, "before start")
+
+
+def test_cursor_prunes_streams_behind_the_floor():
+    cursor = tail.LogCursor(0, lookback=100)
+    cursor.advance(NODE_B, 10, XID)
+    cursor.advance(NODE_A, 1000, "ok")
+    assert [key for key, _, _ in cursor.to_dict()["streams"]] == [
+        json.dumps(NODE_A, sort_keys=True)
+    ]
+
+
+def test_cursor_round_trips():
+    cursor = tail.LogCursor(1000)
+    cursor.advance(NODE_A, 2000, "ok")
+    cursor.advance(NODE_B, 1500, XID)
+    restored = tail.LogCursor.from_dict(json.loads(json.dumps(cursor.to_dict())))
+    assert restored.ts == 2000
+    assert restored.floor == cursor.floor
+    assert not restored.advance(NODE_B, 1500, XID)
+    assert not restored.advance(NODE_A, 2000, "ok")
+    assert restored.advance(NODE_B, 1600, XID)
+    # copies are independent
+    copy = restored.copy()
+    assert copy.advance(NODE_A, 2001, "ok")
+    assert restored.advance(NODE_A, 2001, "ok")
+
+
+def test_cursor_reads_the_single_cursor_format():
+    key = json.dumps(NODE_A, sort_keys=True)
+    cursor = tail.LogCursor.from_dict({"ts": 2000, "seen": [[key, "ok"]]})
+    assert cursor.ts == 2000
+    assert not cursor.advance(NODE_A, 2000, "ok")
+    assert cursor.advance(NODE_B, 1500, XID)
+
+
+class FakeWebSocket:
+    """Tail websocket that sends `messages`, then closes"""
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.closed = False
+
+    def recv(self):
+        return self.messages.pop(0) if self.messages else ""
+
+    def close(self):
+        self.closed = True
+
+
+def _message(*entries):
+    return json.dumps(
+        {
+            "streams": [
+                {"stream": stream, "values": [[str(ts), line]]}
+                for stream, ts, line in entries
+            ]
+        }
+    )
+
+
+@pytest.fixture
+def fast_fallback(monkeypatch):
+    monkeypatch.setattr(tail, "FALLBACK_SECONDS", 0.2)
+    monkeypatch.setattr(tail, "FALLBACK_POLL_SECONDS", 0.05)
+
+
+def test_tailer_recovers_late_lines_after_reconnecting(monkeypatch, fast_fallback):
+    now = time.time_ns()
+    late, newer = now - 2 * SECOND, now - SECOND
+    loki = replay.FakeLoki(
+        [
+            (newer, NODE_A, "ok"),
+            (late, NODE_B, XID),
+        ]
+    )
+    endpoint = loki.start()
+    stop = threading.Event()
+    urls = []
+
+    def create_connection(url, timeout):
+        urls.append(url)
+        if len(urls) == 1:
+            # node-a's newer line arrives before the tail breaks
+            return FakeWebSocket([_message((NODE_A, newer, "ok"))])
+        stop.set()
+        raise websocket.WebSocketException("unavailable")
+
+    monkeypatch.setattr(websocket, "create_connection", create_connection)
+    lines = []
+    tailer = tail.LokiTailer(
+        '{k8s_node_name=~".+"}',
+        lambda stream, ts, line: lines.append((stream, ts, line)),
+        start_ns=now - 10 * SECOND,
+        endpoint=endpoint,
+    )
+    try:
+        tailer.run(stop)
+    finally:
+        loki.stop()
+    # polling picked up node-b's late line, and node-a's line only once
+    assert lines == [(NODE_A, newer, "ok"), (NODE_B, late, XID)]
+    # the tail reconnects from the lookback, not from the newest line
+    start = urllib.parse.parse_qs(urllib.parse.urlparse(urls[1]).query)["start"]
+    assert int(start[0]) == tailer.cursor.floor < late
+
+
+def test_poll_pages_through_full_pages(monkeypatch, fast_fallback):
+    monkeypatch.setattr(tail, "FALLBACK_LIMIT", 10)
+    now = time.time_ns()
+    entries = [
+        (now - SECOND + i, NODE_A if i % 2 else NODE_B, f"line {i}") for i in range(35)
+    ]
+    loki = replay.FakeLoki(entries)
+    endpoint = loki.start()
+    lines = []
+    tailer = tail.LokiTailer(
+        '{k8s_node_name=~".+"}',
+        lambda stream, ts, line: lines.append(line),
+        start_ns=now - 10 * SECOND,
+        endpoint=endpoint,
+    )
+    try:
+        tailer._poll(threading.Event())
+    finally:
+        loki.stop()
+    assert lines == [line for _, _, line in entries]
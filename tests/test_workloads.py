@@ -0,0 +1,129 @@
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+from konduktor import kube_client
+from konduktor.dashboard.backend import workloads
+
+
+def _workload(name, resource_version):
+    return {
+        "metadata": {
+            "uid": f"uid-{name}",
+            "name": name,
+            "namespace": "default",
+            "resourceVersion": resource_version,
+            "creationTimestamp": "2024-01-01T00:00:00Z",
+        },
+        "spec": {"queueName": "user-queue", "priority": 0},
+        "status": {},
+    }
+
+
+class FakeCrdApi:
+    """Custom objects API listing `items`, that stops the cache after
+    `lists` listings
+    """
+
+    def __init__(self, cache, items, lists, stop):
+        self.cache = cache
+        self.items = items
+        self.lists = lists
+        self.stop = stop
+        # (synced, etag) of the cache at each listing
+        self.seen = []
+
+    def list_cluster_custom_object(self, **kwargs):
+        self.seen.append((self.cache.synced.is_set(), self.cache.etag))
+        self.lists -= 1
+        if not self.lists:
+            self.stop.set()
+        return {"items": list(self.items), "metadata": {"resourceVersion": "10"}}
+
+
+class FailingWatch:
+    """Watch that adds `workload`, then fails with `error`"""
+
+    def __init__(self, workload, error):
+        self.workload = workload
+        self.error = error
+        self.resource_version = None
+
+    def stream(self, func, **kwargs):
+        yield {"type": "ADDED", "object": self.workload}
+        raise self.error
+
+    def stop(self):
+        pass
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        RuntimeError("connection reset"),
+        KeyError("metadata"),
+        kube_client.api_exception()(status=500, reason="InternalError"),
+    ],
+)
+def test_failed_watch_relists_and_is_unsynced_meanwhile(monkeypatch, error):
+    cache = workloads.WorkloadCache()
+    stop = threading.Event()
+    crd_api = FakeCrdApi(cache, [_workload("a", "10")], 2, stop)
+    monkeypatch.setattr(workloads, "RETRY_SECONDS", 0.01)
+    monkeypatch.setattr(kube_client, "crd_api", lambda: crd_api)
+    monkeypatch.setattr(
+        kube_client, "watch", lambda: FailingWatch(_workload("b", "11"), error)
+    )
+    thread = threading.Thread(target=cache.run, args=(stop,), daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    # the failed watch left the cache unsynced until it was listed again
+    assert crd_api.seen == [(False, None), (False, None)]
+    assert cache.synced.is_set()
+    assert cache.etag == '"10"'
+    assert [row["name"] for row in cache.snapshot()[0]] == ["a"]
+
+
+@pytest.fixture
+def main(monkeypatch):
+    # the app creates its API clients on import, which need no cluster
+    monkeypatch.setattr(kube_client, "_configured", True)
+    for api in ("_core_api", "_batch_api", "_crd_api"):
+        monkeypatch.setattr(kube_client, api, None)
+    from konduktor.dashboard.backend import main
+
+    return main
+
+
+@pytest.fixture
+def cache(main, monkeypatch):
+    cache = workloads.WorkloadCache()
+    cache._apply("ADDED", _workload("a", "10"))
+    monkeypatch.setattr(main, "workload_cache", cache)
+    return cache
+
+
+def test_unsynced_cache_is_never_cached(main, cache):
+    client = TestClient(main.app)
+    # the resourceVersion is unchanged while the watch is down
+    response = client.get("/getJobs", headers={"If-None-Match": '"10"'})
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
+    assert response.headers["Cache-Control"] == "no-store"
+    assert cache.changes_since("10") is None
+
+    cache.synced.set()
+    response = client.get("/getJobs")
+    assert response.headers["ETag"] == '"10"'
+    response = client.get("/getJobs", headers={"If-None-Match": '"10"'})
+    assert response.status_code == 304
+    assert cache.changes_since("10") == []
+
+
+def test_queue_stats_report_whether_synced(main, cache):
+    client = TestClient(main.app)
+    assert client.get("/queueStats").json()["synced"] is False
+    cache.synced.set()
+    assert client.get("/queueStats").json()["synced"] is True